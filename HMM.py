@@ -2,92 +2,443 @@
 
 import random
 import argparse
+from array import array
+from collections import Counter, OrderedDict, deque, namedtuple
 import codecs
+import cProfile
+import contextlib
+import copy
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
 import numpy as np
 
 # Sequence - represents a sequence of hidden states and corresponding
-# output variables.
+# output variables. The states and outputs are stored as integer ids into
+# Vocabularies that many sequences share (such as the ones of a Corpus or a
+# model), and are only turned back into strings by stateseq and outputseq.
 
 class Sequence:
-    def __init__(self, stateseq, outputseq):
-        self.stateseq  = stateseq   # sequence of states
-        self.outputseq = outputseq  # sequence of outputs
+    __slots__ = ("state_ids", "output_ids", "states", "symbols")
+
+    def __init__(self, stateseq, outputseq, states=None, symbols=None):
+        """states and symbols are the Vocabularies to intern into, such as
+        the ones of a Corpus or a model, so that many sequences share them;
+        without them the sequence gets its own."""
+        self.states = states if states is not None else Vocabulary()
+        self.symbols = symbols if symbols is not None else Vocabulary()
+        self.state_ids = array('i', [self.states.add(state) for state in stateseq])
+        self.output_ids = array('i', [self.symbols.add(output) for output in outputseq])
+
+    @classmethod
+    def from_ids(cls, state_ids, output_ids, states, symbols):
+        """makes a Sequence from id arrays without re-interning; state_ids
+        may be None for a sequence of outputs alone."""
+        sequence = cls.__new__(cls)
+        sequence.state_ids = state_ids if state_ids is not None else array('i')
+        sequence.output_ids = output_ids
+        sequence.states = states
+        sequence.symbols = symbols
+        return sequence
+
+    @property
+    def stateseq(self):   # sequence of states
+        return [self.states[i] for i in self.state_ids]
+
+    @property
+    def outputseq(self):   # sequence of outputs
+        return [self.symbols[i] for i in self.output_ids]
+
     def __str__(self):
         return ' '.join(self.stateseq)+'\n'+' '.join(self.outputseq)+'\n'
     def __repr__(self):
         return self.__str__()
     def __len__(self):
-        return len(self.outputseq)
+        return len(self.output_ids)
+
+
+# Vocabulary - interns strings (states or symbols) to consecutive integer ids.
+# add is not locked: threads may share a Vocabulary to look ids up, but only
+# its owner (a Corpus, a model or a Sequence) adds to it.
+
+class Vocabulary:
+    def __init__(self, items=()):
+        self.items = list(items)   # id -> item
+        self.index = dict(zip(self.items, range(len(self.items))))   # item -> id
+        if len(self.index) != len(self.items):
+            # repeated items, so intern them one at a time
+            items, self.items, self.index = self.items, [], {}
+            for item in items:
+                self.add(item)
+    def add(self, item):
+        """returns the id of item, assigning the next free id if it is new."""
+        idx = self.index.get(item)
+        if idx is None:
+            idx = len(self.items)
+            self.index[item] = idx
+            self.items.append(item)
+        return idx
+    def get(self, item, default=-1):
+        return self.index.get(item, default)
+    def __getitem__(self, idx):
+        return self.items[idx]
+    def __contains__(self, item):
+        return item in self.index
+    def __iter__(self):
+        return iter(self.items)
+    def __len__(self):
+        return len(self.items)
+
+def iter_sequences(fileobj):
+    """lazily yields the observation sequences of an .obs file, one per
+    non-blank line."""
+    for line in fileobj:
+        emissions = line.strip().split()
+        if emissions:
+            yield emissions
+
+def open_observations(filename):
+    """opens an .obs file for reading; '-' means standard input."""
+    if filename == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(filename, "r")
+
+# Corpus - many sequences in one flat buffer. The output ids of every
+# sequence (and state ids, for a labeled corpus) are concatenated into
+# array('i') buffers, with offsets marking where each sequence starts, and
+# the ids index into one Vocabulary of symbols (and one of states) shared by
+# the whole corpus. Each token then costs 4 bytes rather than a str object
+# and a list slot; indexing returns a Sequence over a slice of the buffers.
+
+class Corpus:
+    def __init__(self, symbols=None, states=None):
+        """symbols is the Vocabulary new outputs are interned into; states,
+        if given, makes the corpus labeled, with a state for every output."""
+        self.symbols = symbols if symbols is not None else Vocabulary()
+        self.states = states
+        self.outputs = array('i')
+        self.labels = array('i') if states is not None else None
+        self.offsets = array('q', [0])
+
+    @classmethod
+    def read(cls, fileobj, symbols=None):
+        """returns an unlabeled Corpus of the sequences of an .obs file."""
+        corpus = cls(symbols)
+        for emissions in iter_sequences(fileobj):
+            corpus.append(emissions)
+        return corpus
+
+    @classmethod
+    def from_arrays(cls, state_ids, output_ids, states, symbols):
+        """returns a labeled Corpus of the rows of two (count, n) id arrays."""
+        count, n = output_ids.shape
+        corpus = cls(symbols, states)
+        corpus.labels.frombytes(np.ascontiguousarray(state_ids, dtype=np.int32).tobytes())
+        corpus.outputs.frombytes(np.ascontiguousarray(output_ids, dtype=np.int32).tobytes())
+        corpus.offsets = array('q', [i * n for i in range(count + 1)])
+        return corpus
+
+    def append(self, outputseq, stateseq=None):
+        if (stateseq is None) != (self.labels is None):
+            raise ValueError("States must be given for every sequence of a labeled corpus, and only then.")
+        if stateseq is not None:
+            if len(stateseq) != len(outputseq):
+                raise ValueError("A sequence needs one state per output.")
+            self.labels.extend(map(self.states.add, stateseq))
+        self.outputs.extend(map(self.symbols.add, outputseq))
+        self.offsets.append(len(self.outputs))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Corpus index out of range")
+        start, end = self.offsets[i], self.offsets[i + 1]
+        labels = self.labels[start:end] if self.labels is not None else None
+        return Sequence.from_ids(labels, self.outputs[start:end], self.states, self.symbols)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def observations(self):
+        """yields the outputs of each sequence as a list of strings."""
+        names = self.symbols.items
+        outputs, offsets = self.outputs, self.offsets
+        for i in range(len(self)):
+            yield [names[j] for j in outputs[offsets[i]:offsets[i + 1]]]
+
+    def encode(self, model):
+        """returns the outputs of each sequence as an array of the model's
+        symbol ids, remapping the corpus vocabulary once rather than every token."""
+        mapping = np.array([model.symbols.get(symbol, model.unknown) for symbol in self.symbols], dtype=np.intp)
+        ids = mapping[np.frombuffer(self.outputs, dtype=np.int32)] if len(self.outputs) else np.zeros(0, np.intp)
+        return np.split(ids, self.offsets[1:-1])
+
+    def nbytes(self):
+        """returns the size of the id and offset buffers."""
+        labels = self.labels if self.labels is not None else array('i')
+        return sum(buffer.itemsize * len(buffer) for buffer in (self.outputs, labels, self.offsets))
+
+
+def read_probabilities(filename):
+    """reads a .trans or .emit file into a dict of dicts of floats."""
+    probabilities = {}
+    with open(filename, "r") as f:
+        for line in f:
+            elem = line.strip().split()
+            state = elem[0]
+            if state not in probabilities:
+                probabilities[state] = {}
+            for i in range(1, len(elem), 2):
+                probabilities[state][elem[i]] = float(elem[i + 1])
+    return probabilities
+
+# Model cache - basename.cache.npz holds the vocabularies and the
+# (row, column, probability) entries of the .trans and .emit files in file
+# order, so both the dicts and the CompiledHMM can be rebuilt without
+# parsing text. Each source file is recorded with its mtime, size and sha1;
+# the cache is used when the mtime and size match, or failing that, the hash.
+# When only the hash matches (the file was touched), the recorded mtime and
+# size are brought up to date, so the file is not hashed again next time.
+
+CACHE_VERSION = 1
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    with open(filename, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha1": digest}
+
+def sources_unchanged(sources):
+    """returns whether every file still has its recorded content; the
+    signatures of files with new mtimes but the same hash are updated in place."""
+    for filename, signature in sources.items():
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        if stat.st_mtime_ns == signature["mtime_ns"] and stat.st_size == signature["size"]:
+            continue
+        current = file_signature(filename)
+        if current["sha1"] != signature["sha1"]:
+            return False
+        signature.update(current)
+    return True
+
+def pack_names(names):
+    """stores a list of names as one byte array; names never contain whitespace."""
+    return np.frombuffer("\n".join(names).encode("utf-8"), dtype=np.uint8)
+
+def unpack_names(packed):
+    text = packed.tobytes().decode("utf-8")
+    return text.split("\n") if text else []
+
+def flatten_rows(rows, columns):
+    """returns the keys, entry counts, column ids and probabilities of a dict of dicts."""
+    keys = list(rows)
+    counts = [len(rows[key]) for key in keys]
+    ids = [columns.index[column] for key in keys for column in rows[key]]
+    probs = [prob for key in keys for prob in rows[key].values()]
+    return (pack_names(keys), np.array(counts, dtype=np.int64),
+            np.array(ids, dtype=np.int32), np.array(probs, dtype=np.float64))
+
+def write_cache(basename, transitions, emissions):
+    """saves basename.cache.npz and returns the CompiledHMM for the model.
+    The cache is best effort: if it cannot be written, loading still works."""
+    compiled = CompiledHMM.from_hmm(HMM(transitions, emissions))
+    trans_keys, trans_counts, trans_ids, trans_probs = flatten_rows(transitions, compiled.states)
+    emit_keys, emit_counts, emit_ids, emit_probs = flatten_rows(emissions, compiled.symbols)
+    sources = {f"{basename}.trans": None, f"{basename}.emit": None}
+    try:
+        for filename in sources:
+            sources[filename] = file_signature(filename)
+    except OSError:
+        return compiled
+    save_cache(basename, dict(meta=json.dumps({"version": CACHE_VERSION, "sources": sources}),
+                              states=pack_names(compiled.states.items),
+                              symbols=pack_names(compiled.symbols.items),
+                              trans_keys=trans_keys, trans_counts=trans_counts,
+                              trans_ids=trans_ids, trans_probs=trans_probs,
+                              emit_keys=emit_keys, emit_counts=emit_counts,
+                              emit_ids=emit_ids, emit_probs=emit_probs))
+    return compiled
+
+def save_cache(basename, arrays):
+    """atomically replaces basename.cache.npz with arrays, if it can."""
+    try:
+        directory = os.path.dirname(os.path.abspath(basename))
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".npz", delete=False) as f:
+            np.savez(f, **arrays)
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, f"{basename}.cache.npz")
+    except OSError:
+        pass
+
+def read_cache(data):
+    """returns (rows, compiled) from an open cache file. rows holds the
+    dicts of the model still flattened, for cache_rows to rebuild them if
+    they are ever needed; decoding only needs the compiled arrays."""
+    data = {key: data[key] for key in data.files}
+    states = Vocabulary(unpack_names(data["states"]))
+    symbols = Vocabulary(unpack_names(data["symbols"]))
+    trans_keys = unpack_names(data["trans_keys"])
+    emit_keys = unpack_names(data["emit_keys"])
+
+    n_states = len(states)
+    start = np.zeros(n_states)
+    transition_matrix = np.zeros((n_states, n_states))
+    emission_matrix = np.zeros((n_states, len(symbols) + 1))
+    trans_rows = np.repeat(np.array([states.get(key) for key in trans_keys], dtype=np.intp), data["trans_counts"])
+    trans_ids, trans_probs = data["trans_ids"], data["trans_probs"]
+    is_start = trans_rows == -1   # the '#' row
+    start[trans_ids[is_start]] = trans_probs[is_start]
+    transition_matrix[trans_rows[~is_start], trans_ids[~is_start]] = trans_probs[~is_start]
+    emit_rows = np.repeat(np.array([states.index[key] for key in emit_keys], dtype=np.intp), data["emit_counts"])
+    emission_matrix[emit_rows, data["emit_ids"]] = data["emit_probs"]
+    compiled = CompiledHMM(states, symbols, start, transition_matrix, emission_matrix)
+    return (data, trans_keys, emit_keys), compiled
+
+def cache_rows(data, trans_keys, emit_keys, states, symbols):
+    """rebuilds the (transitions, emissions) dicts read by read_cache."""
+    def rows(keys, counts, ids, probs, columns):
+        names = [columns[i] for i in ids.tolist()]
+        probs = probs.tolist()
+        result = {}
+        end = 0
+        for key, count in zip(keys, counts.tolist()):
+            start, end = end, end + count
+            result[key] = dict(zip(names[start:end], probs[start:end]))
+        return result
+
+    transitions = rows(trans_keys, data["trans_counts"], data["trans_ids"], data["trans_probs"], states.items)
+    emissions = rows(emit_keys, data["emit_counts"], data["emit_ids"], data["emit_probs"], symbols.items)
+    return transitions, emissions
+
+# number of tagged sentences counted together by train_supervised
+TRAIN_CHUNK = 10000
 
 # HMM model
 class HMM:
-    def __init__(self, transitions={}, emissions={}):
+    def __init__(self, transitions=None, emissions=None):
         """creates a model from transition and emission probabilities
         e.g. {'happy': {'silent': '0.2', 'meow': '0.3', 'purr': '0.5'},
               'grumpy': {'silent': '0.5', 'meow': '0.4', 'purr': '0.1'},
-              'hungry': {'silent': '0.2', 'meow': '0.6', 'purr': '0.2'}}"""
-        self.transitions = transitions
-        self.emissions = emissions
+              'hungry': {'silent': '0.2', 'meow': '0.6', 'purr': '0.2'}}
+        Each model gets its own empty dicts when none are given."""
+        self.cached_rows = None   # the flattened dicts, until unpack builds them
+        self.transitions = transitions if transitions is not None else {}
+        self.emissions = emissions if emissions is not None else {}
+        self.compiled = None  # set by load and update_from, while the dicts are untouched
+
+    # a model loaded from the cache keeps its dicts flattened until they are
+    # first used, since decoding only needs the compiled arrays. Handing out
+    # the dicts drops the compiled arrays, since the caller may edit them.
+    @property
+    def transitions(self):
+        self.unpack()
+        self.compiled = None
+        return self.transition_rows
+
+    @transitions.setter
+    def transitions(self, transitions):
+        self.unpack()
+        self.compiled = None
+        self.transition_rows = transitions
+
+    @property
+    def emissions(self):
+        self.unpack()
+        self.compiled = None
+        return self.emission_rows
+
+    @emissions.setter
+    def emissions(self, emissions):
+        self.unpack()
+        self.compiled = None
+        self.emission_rows = emissions
+
+    def unpack(self):
+        """builds the dicts of a model loaded from the cache."""
+        if self.cached_rows is not None:
+            rows, self.cached_rows = self.cached_rows, None
+            self.transition_rows, self.emission_rows = cache_rows(*rows)
 
     ## part 1 - you do this.
-    def load(self, basename):
+    def load(self, basename, cache=True):
         """reads HMM structure from transition (basename.trans),
         and emission (basename.emit) files,
-        as well as the probabilities."""
-        with open(f"{basename}.trans", "r") as f:
-            for line in f:
-                elem = line.strip().split()
-                state = elem[0]
-                if state not in self.transitions:
-                    self.transitions[state] = {}
-                for i in range(1, len(elem), 2):
-                    next_state = elem[i]
-                    prob = float(elem[i + 1])
-                    self.transitions[state][next_state] = prob
-
-        # Load emissions
-        with open(f"{basename}.emit", "r") as f:
-            for line in f:
-                elem = line.strip().split()
-                state = elem[0]
-                if state not in self.emissions:
-                    self.emissions[state] = {}
-                for i in range(1, len(elem), 2):
-                    next_state = elem[i]
-                    prob = float(elem[i + 1])
-                    self.emissions[state][next_state] = prob
+        as well as the probabilities.
+        With cache set, the parsed model is also saved to basename.cache.npz
+        and read from there on later loads, as long as the source files
+        are unchanged."""
+        loaded = self.load_cache(basename) if cache else None
+        if loaded is None:
+            transitions = read_probabilities(f"{basename}.trans")
+            emissions = read_probabilities(f"{basename}.emit")
+            compiled = None
+            if cache:
+                compiled = write_cache(basename, transitions, emissions)
+        else:
+            rows, compiled = loaded
+            if not self.transitions and not self.emissions:
+                self.cached_rows = rows + (compiled.states, compiled.symbols)
+                self.compiled = compiled
+                return
+            transitions, emissions = cache_rows(*rows, compiled.states, compiled.symbols)
+
+        # the compiled arrays only describe this model if nothing else was loaded before
+        fresh = not self.transitions and not self.emissions
+        for state, row in transitions.items():
+            if state not in self.transitions:
+                self.transitions[state] = {}
+            self.transitions[state].update(row)
+        for state, row in emissions.items():
+            if state not in self.emissions:
+                self.emissions[state] = {}
+            self.emissions[state].update(row)
+        self.compiled = compiled if fresh else None
+
+    def load_cache(self, basename):
+        """returns (rows, compiled) from basename.cache.npz (see read_cache),
+        or None if there is no usable cache for the current source files."""
+        try:
+            with np.load(f"{basename}.cache.npz", allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                recorded = json.dumps(meta["sources"])
+                if meta["version"] != CACHE_VERSION or not sources_unchanged(meta["sources"]):
+                    return None
+                rows, compiled = read_cache(data)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        if json.dumps(meta["sources"]) != recorded:
+            # a source was touched but not changed: record its new mtime
+            save_cache(basename, dict(rows[0], meta=json.dumps(meta)))
+        return rows, compiled
 
 
    ## you do this.
-    def generate(self, n):
+    def generate(self, n, seed=None):
         """return an n-length Sequence by randomly sampling from this HMM."""
-        states = []
-        emissions = []
+        return self.generate_batch(n, 1, seed)[0]
+
+    def generate_batch(self, n, count, seed=None):
+        """return a Corpus of count n-length Sequences sampled together;
+        seed makes the draws reproducible. See Sampler."""
         if "#" not in self.transitions:
             raise ValueError("Initial state '#' not defined.")
-
-        next_states = list(self.transitions["#"].keys())
-        next_probs = list(map(float, self.transitions["#"].values()))
-        current_state = np.random.choice(next_states, p=next_probs)
-
-        for elem in range(n):
-            states.append(current_state)
-            if current_state in self.emissions:
-                possible_emissions = list(self.emissions[current_state].keys())
-                emission_probs = list(map(float, self.emissions[current_state].values()))
-                emission = np.random.choice(possible_emissions, p=emission_probs)
-                emissions.append(emission)
-            else:
-                break
-            if current_state in self.transitions:
-                next_states = list(self.transitions[current_state].keys())
-                next_probs = list(map(float, self.transitions[current_state].values()))
-                current_state = np.random.choice(next_states, p=next_probs)
-            else:
-                break
-
-        return Sequence(states, emissions)
+        return self.compile().sampler().sequences(n, count, np.random.default_rng(seed))
 
     def forward(self, sequence):
         forward_prob = [{}]
@@ -120,52 +471,1626 @@ class HMM:
 
 
     def viterbi(self, sequence):
-        viterbi_prob = [{}]
-        path = {}
-
-        for state in self.emissions:
-            viterbi_prob[0][state] = (
-                    self.transitions["#"].get(state, 0) * self.emissions[state].get(sequence[0], 0)
-            )
-            path[state] = [state]
+        states = list(self.emissions)
+        index = {state: i for i, state in enumerate(states)}
+        # backpointers is a flat T x S table: entry (t-1)*S + i holds the id of
+        # the best previous state for state i at time t. Only the previous row
+        # of probabilities is kept, so memory is linear in the sequence length.
+        backpointers = array('i')
+        viterbi_prob = [self.transitions["#"].get(state, 0) * self.emissions[state].get(sequence[0], 0)
+                        for state in states]
 
         for t in range(1, len(sequence)):
-            viterbi_prob.append({})
-            new_path = {}
-
-            for current_state in self.emissions:
+            new_prob = []
+            for current_state in states:
                 max_prob, best_prev_state = max(
-                    (viterbi_prob[t - 1][prev_state] *
+                    (viterbi_prob[i] *
                      self.transitions[prev_state].get(current_state, 0) *
                      self.emissions[current_state].get(sequence[t], 0), prev_state)
-                    for prev_state in self.emissions
+                    for i, prev_state in enumerate(states)
                 )
-                viterbi_prob[t][current_state] = max_prob
-                new_path[current_state] = path[best_prev_state] + [current_state]
+                new_prob.append(max_prob)
+                backpointers.append(index[best_prev_state])
+            viterbi_prob = new_prob
+
+        max_final_prob, best_final_state = max(zip(viterbi_prob, states))
+        i = index[best_final_state]
+        path = [best_final_state]
+        for t in range(len(sequence) - 1, 0, -1):
+            i = backpointers[(t - 1) * len(states) + i]
+            path.append(states[i])
+        path.reverse()
+        return path
+
+    def forward_batch(self, sequences, numeric="linear"):
+        """runs forward on many sequences at once; see CompiledHMM.forward_batch."""
+        return self.compile().forward_batch(sequences, numeric)
+
+    def viterbi_batch(self, sequences, numeric="linear"):
+        """runs viterbi on many sequences at once; see CompiledHMM.viterbi_batch."""
+        return self.compile().viterbi_batch(sequences, numeric)
+
+    def iter_forward(self, fileobj, numeric="linear"):
+        """streams forward results for an .obs file object; see CompiledHMM.iter_forward."""
+        return self.compile().iter_forward(fileobj, numeric)
+
+    def iter_viterbi(self, fileobj, numeric="linear"):
+        """streams viterbi results for an .obs file object; see CompiledHMM.iter_viterbi."""
+        return self.compile().iter_viterbi(fileobj, numeric)
+
+    def fit(self, sequences, iterations=10, workers=1, basename=None):
+        """re-estimates the probabilities from unlabeled sequences (lists of
+        symbols, or a Corpus) with Baum-Welch, and returns the log likelihood of the data before each
+        iteration. Entries that are zero stay zero, so the structure of the
+        model is kept. The E-step is batched, and split across a process pool
+        when workers > 1. If basename is given, the result is saved there."""
+        model = self.compile()
+        if isinstance(sequences, Corpus):
+            encoded = [ids for ids in sequences.encode(model) if len(ids) > 0]
+        else:
+            encoded = [model.encode(sequence) for sequence in sequences if len(sequence) > 0]
+        history = []
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            for iteration in range(iterations):
+                if pool is None:
+                    counts = model.expected_counts(encoded)
+                else:
+                    shards = [encoded[i::workers] for i in range(workers)]
+                    results = pool.map(expected_counts_task, [(model, shard) for shard in shards])
+                    counts = [sum(parts) for parts in zip(*results)]
+                start_counts, transition_counts, emission_counts, log_likelihood, skipped = counts
+                history.append(log_likelihood)
+                model = model.reestimate(start_counts, transition_counts, emission_counts)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.update_from(model)
+        if basename is not None:
+            self.save(basename)
+        return history
+
+    def train_supervised(self, path, smoothing=0.0, workers=1, chunk_size=TRAIN_CHUNK):
+        """builds the model from a tagged corpus, replacing transitions and
+        emissions with (count + smoothing) / (total + smoothing * outcomes)
+        estimates, and returns the number of sentences and tokens read.
+        The corpus is streamed in shards of chunk_size sentences, counted
+        across a process pool when workers > 1, and the counts merged."""
+        tags = Vocabulary(["#"])
+        words = Vocabulary()
+        trans_keys, trans_counts, emit_keys, emit_counts = [], [], [], []
+        sentences = 0
+
+        def merge(result):
+            shard_tags, shard_words, transitions, emissions = result
+            tag_map = np.array([tags.add(tag) for tag in shard_tags], dtype=np.int64)
+            word_map = np.array([words.add(word) for word in shard_words], dtype=np.int64)
+            for keys, counts, first_map, second_map, into in ((trans_keys, trans_counts, tag_map, tag_map, transitions),
+                                                              (emit_keys, emit_counts, tag_map, word_map, emissions)):
+                if into:
+                    pair_keys, pair_counts = remap_pairs(into, first_map, second_map)
+                    keys.append(pair_keys)
+                    counts.append(pair_counts)
+
+        with open(path, "r") as f:
+            chunks = chunked(iter_tagged(f), chunk_size)
+            if workers > 1:
+                with multiprocessing.Pool(workers) as pool:
+                    for chunk, result in pool_map(pool, count_tagged, chunks, 2 * workers):
+                        sentences += len(chunk)
+                        merge(result)
+            else:
+                for chunk in chunks:
+                    sentences += len(chunk)
+                    merge(count_tagged(chunk))
+
+        n_tags = len(tags)
+        transition_counts = np.zeros((n_tags, n_tags))
+        keys, counts = merge_pairs(trans_keys, trans_counts)
+        transition_counts[keys >> PAIR_SHIFT, keys & PAIR_MASK] = counts
+        transition_counts = transition_counts[:, 1:]   # nothing moves back to '#'
+        keys, counts = merge_pairs(emit_keys, emit_counts)
+
+        self.transitions = {}
+        for i, tag in enumerate(tags):
+            row = transition_counts[i]
+            total = row.sum() + smoothing * len(row)
+            # a tag never followed by another (such as the sentence-final '.')
+            # still gets a row, empty, so the dict methods know the tag
+            self.transitions[tag] = {}
+            if total > 0:
+                self.transitions[tag] = dict(zip(tags.items[1:], ((row + smoothing) / total).tolist()))
+                if smoothing == 0:
+                    self.transitions[tag] = {next_tag: prob for next_tag, prob in self.transitions[tag].items() if prob > 0}
+
+        self.emissions = {}
+        emit_tags, emit_words = keys >> PAIR_SHIFT, keys & PAIR_MASK
+        tag_totals = np.bincount(emit_tags, weights=counts, minlength=n_tags)
+        bounds = np.searchsorted(emit_tags, np.arange(n_tags + 1))
+        for i in range(1, n_tags):
+            total = tag_totals[i] + smoothing * len(words)
+            if smoothing > 0:
+                row = np.zeros(len(words))
+                row[emit_words[bounds[i]:bounds[i + 1]]] = counts[bounds[i]:bounds[i + 1]]
+                self.emissions[tags[i]] = dict(zip(words.items, ((row + smoothing) / total).tolist()))
+            else:
+                seen = emit_words[bounds[i]:bounds[i + 1]].tolist()
+                probs = (counts[bounds[i]:bounds[i + 1]] / total).tolist()
+                self.emissions[tags[i]] = dict(zip([words[w] for w in seen], probs))
+        self.compiled = None
+        return sentences, int(counts.sum())
+
+    def update_from(self, model):
+        """copies the probabilities of a CompiledHMM back into the dicts,
+        for the entries they already have."""
+        index, symbol_index = model.states.index, model.symbols.index
+        for state, row in self.transitions.items():
+            for next_state in row:
+                if state == "#":
+                    row[next_state] = float(model.start[index[next_state]])
+                else:
+                    row[next_state] = float(model.transitions[index[state], index[next_state]])
+        for state, row in self.emissions.items():
+            for symbol in row:
+                row[symbol] = float(model.emissions[index[state], symbol_index[symbol]])
+        self.compiled = model
+
+    def save(self, basename):
+        """writes the model to basename.trans and basename.emit, one
+        'state next probability' entry per line, in the format load reads.
+        A state with an empty row is written as a line of its own."""
+        for filename, probabilities in ((f"{basename}.trans", self.transitions), (f"{basename}.emit", self.emissions)):
+            with open(filename, "w") as f:
+                for state, row in probabilities.items():
+                    if not row:
+                        f.write(f"{state}\n")
+                    for key, prob in row.items():
+                        f.write(f"{state} {key} {prob!r}\n")
+
+    def compile(self, backend="dense", oov=False):
+        """returns a CompiledHMM snapshot of this model, with states and
+        symbols interned to integer ids and the probabilities stored as arrays,
+        or a SparseHMM if backend is 'sparse'.
+        Until transitions or emissions are used, the arrays made by load or
+        update_from are returned instead of compiling the dicts again.
+        With oov set, unknown symbols are scored by an OOVModel instead of
+        getting zero probability in every state (dense backend only)."""
+        if backend == "sparse":
+            if oov:
+                raise ValueError("The unknown-word model needs the dense backend.")
+            return SparseHMM.from_hmm(self)
+        if backend != "dense":
+            raise ValueError(f"Unknown backend '{backend}', expected dense or sparse.")
+        model = self.compiled if self.compiled is not None else CompiledHMM.from_hmm(self)
+        if oov:
+            model = copy.copy(model)
+            model.oov = OOVModel(model)
+        return model
+
+
+NUMERIC_MODES = ("linear", "log", "scaled")
+
+# upper bound on B * S * S elements in one batched viterbi step
+BATCH_ELEMENTS = 1 << 22
+
+# number of lines decoded together when streaming an .obs file
+DECODE_CHUNK = 1000
+
+ForwardResult = namedtuple("ForwardResult", ["observations", "state", "probability"])
+ViterbiResult = namedtuple("ViterbiResult", ["observations", "states"])
+
+# landing cells marked with an X on landermap.docx
+LANDER_SAFE_SPOTS = ["4,3", "3,4", "4,4", "2,5", "5,5"]
+
+def impossible_tokens(lik, numeric):
+    """returns, for each sequence of a (B, T, S) likelihood batch, whether
+    one of its tokens has zero likelihood (-inf in log space) in every state."""
+    floor = -np.inf if numeric == "log" else 0.0
+    return (lik.max(axis=2) <= floor).any(axis=1)
+
+def check_numeric(numeric):
+    if numeric not in NUMERIC_MODES:
+        raise ValueError(f"Unknown numeric mode '{numeric}', expected one of {', '.join(NUMERIC_MODES)}.")
+
+def logsumexp(a, axis=None):
+    """log(sum(exp(a))) along axis, without overflow and with -inf for empty mass."""
+    top = np.max(a, axis=axis, keepdims=True)
+    top = np.where(np.isfinite(top), top, 0)
+    with np.errstate(divide="ignore"):
+        total = np.log(np.sum(np.exp(a - top), axis=axis, keepdims=True)) + top
+    if axis is None:
+        return total.item()
+    return np.squeeze(total, axis=axis)
+
+
+def model_entries(hmm):
+    """interns the states and symbols of an HMM and returns (states, symbols,
+    start, transition entries, emission entries), where the start is a (S,)
+    array and the entries are (row ids, column ids, probabilities) arrays."""
+    states = Vocabulary(s for s in hmm.transitions if s != "#")
+    for state in hmm.emissions:
+        states.add(state)
+    symbols = Vocabulary()
+    for state in hmm.emissions:
+        for symbol in hmm.emissions[state]:
+            symbols.add(symbol)
+
+    start = np.zeros(len(states))
+    for state, prob in hmm.transitions.get("#", {}).items():
+        start[states.index[state]] = prob
+    trans_entries = ([], [], [])
+    for prev_state, row in hmm.transitions.items():
+        if prev_state == "#":
+            continue
+        i = states.index[prev_state]
+        for next_state, prob in row.items():
+            trans_entries[0].append(i)
+            trans_entries[1].append(states.add(next_state))
+            trans_entries[2].append(prob)
+    emit_entries = ([], [], [])
+    for state, row in hmm.emissions.items():
+        i = states.index[state]
+        for symbol, prob in row.items():
+            emit_entries[0].append(i)
+            emit_entries[1].append(symbols.index[symbol])
+            emit_entries[2].append(prob)
+
+    def as_arrays(entries):
+        rows, columns, probs = entries
+        return np.array(rows, dtype=np.intp), np.array(columns, dtype=np.intp), np.array(probs, dtype=np.float64)
+    return states, symbols, start, as_arrays(trans_entries), as_arrays(emit_entries)
+
+def read_only(*arrays):
+    """marks arrays read-only, so a compiled model can be shared between
+    callers and threads without any of them changing it."""
+    for a in arrays:
+        a.flags.writeable = False
+
+def tie_order(states):
+    """HMM.viterbi takes max() over (prob, state) tuples, so ties go to the
+    lexicographically largest state name. Scanning states in this order
+    makes argmax (which keeps the first maximum) agree with it."""
+    return np.array(sorted(range(len(states)), key=lambda i: states[i], reverse=True), dtype=np.intp)
+
+
+# Instrumentation - Stats records the time spent in each phase of a run
+# (load, parse, decode, output, ...) and counters such as sentences, tokens,
+# unknown symbols, underflows and zero-probability sequences. Phases are exclusive: entering one pauses
+# the one around it, so the phase times add up to the run time. NullStats
+# has the same interface and does nothing; models carry NULL_STATS unless
+# instrumented, and only check stats.enabled once per batch.
+
+class Stats:
+    enabled = True
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.counts = Counter()
+        self.stack = []
+        self.mark = time.perf_counter()
+
+    def switch(self):
+        """charges the time since the last switch to the current phase."""
+        now = time.perf_counter()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.mark
+        self.mark = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.switch()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.switch()
+            self.stack.pop()
+
+    def timed(self, name, iterable):
+        """yields the items of iterable, charging the time taken to produce each to phase name."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, self)
+            if item is self:
+                return
+            yield item
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def as_dict(self):
+        return {"seconds": dict(self.seconds), "counts": dict(self.counts)}
+
+    def summary(self):
+        """returns a printable report of the phase times and counters."""
+        total = sum(self.seconds.values())
+        lines = [f"PHASE {name}: {seconds:.4f}s ({seconds / total if total else 0:.1%})"
+                 for name, seconds in self.seconds.most_common()]
+        lines += [f"COUNT {name}: {count}" for name, count in sorted(self.counts.items())]
+        decode = self.seconds.get("decode", 0)
+        if decode and self.counts.get("tokens"):
+            lines.append(f"DECODE RATE: {self.counts['tokens'] / decode:.0f} tokens/s")
+        return "\n".join(lines)
+
+class NullStats:
+    enabled = False
+
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def count(self, name, n=1):
+        pass
+
+NULL_STATS = NullStats()
+
+
+# DecodingModel - what the dense CompiledHMM and the SparseHMM share:
+# symbol encoding, forward and viterbi of one sequence through the batch
+# methods each defines, streaming over .obs files, and instrumented copies.
+
+class DecodingModel:
+    oov = None   # OOVModel estimating unknown symbols, set by HMM.compile(oov=True)
+    beam = None   # states viterbi keeps per step, all if None; set by pruned
+    beam_ratio = None   # and the smallest fraction of the best score they keep
+    stats = NULL_STATS   # counts batches decoded once set by instrumented
+
+    def encode(self, sequence):
+        """maps a sequence of symbols to an array of symbol ids."""
+        get = self.symbols.index.get
+        unknown = self.unknown
+        return np.fromiter((get(symbol, unknown) for symbol in sequence), dtype=np.intp, count=len(sequence))
+
+    def forward(self, sequence, numeric="linear"):
+        """returns the most probable final state and its normalized probability,
+        exactly as HMM.forward does. numeric picks how the recurrence is
+        carried out: 'linear' multiplies raw probabilities like the dict
+        implementation, 'scaled' renormalizes alpha at every step and 'log'
+        works with log probabilities. Only 'linear' underflows on long sequences."""
+        return self.forward_batch([sequence], numeric)[0]
+
+    def viterbi(self, sequence, numeric="linear"):
+        """returns the most likely state sequence, exactly as HMM.viterbi does.
+        numeric is as for forward; 'scaled' divides the scores by their
+        maximum at every step, which leaves the argmax unchanged."""
+        return self.viterbi_batch([sequence], numeric)[0]
+
+    def count_underflows(self, final, impossible, numeric):
+        """counts the sequences of a batch whose final scores are all zero
+        (-inf in log space). Those with a token no state can emit, as
+        impossible marks, and any in log space, which cannot underflow, have
+        zero probability; the rest underflowed."""
+        floor = -np.inf if numeric == "log" else 0.0
+        zero = final.max(axis=1) <= floor
+        underflows = zero & ~impossible if numeric != "log" else np.zeros_like(zero)
+        self.stats.count("underflows", int(underflows.sum()))
+        self.stats.count("zero_probability", int((zero & ~underflows).sum()))
+
+    def instrumented(self, stats):
+        """returns a copy of this model that records what it decodes in stats."""
+        model = copy.copy(self)
+        model.stats = stats
+        return model
+
+    def iter_forward(self, fileobj, numeric="linear", workers=1, chunk_size=DECODE_CHUNK):
+        """lazily yields a ForwardResult for each sequence in an .obs file
+        object, reading and decoding it one chunk of lines at a time."""
+        for observations, (state, probability) in decode_sequences(self, iter_sequences(fileobj), "forward", numeric,
+                                                                   workers, chunk_size):
+            yield ForwardResult(observations, state, probability)
+
+    def iter_viterbi(self, fileobj, numeric="linear", workers=1, chunk_size=DECODE_CHUNK):
+        """lazily yields a ViterbiResult for each sequence in an .obs file
+        object, reading and decoding it one chunk of lines at a time."""
+        for observations, states in decode_sequences(self, iter_sequences(fileobj), "viterbi", numeric,
+                                                     workers, chunk_size):
+            yield ViterbiResult(observations, states)
+
+
+# CompiledHMM - dense array form of an HMM. States and symbols are interned
+# to integer ids, so forward and viterbi become matrix-vector recurrences.
+# Symbols the model has never seen map to an extra all-zero emission column,
+# which is what .get(symbol, 0) does in the dict implementation.
+
+class CompiledHMM(DecodingModel):
+    def __init__(self, states, symbols, start, transitions, emissions):
+        """states and symbols are Vocabularies; start is (S,), transitions
+        is (S, S) indexed [prev, next], emissions is (S, V+1) with the last
+        column reserved for unknown symbols."""
+        self.states = states
+        self.symbols = symbols
+        self.start = start
+        self.transitions = transitions
+        self.emissions = emissions
+        self.unknown = len(symbols)
+        self.tie_order = tie_order(states)
+        with np.errstate(divide="ignore"):
+            self.log_start = np.log(start)
+            self.log_transitions = np.log(transitions)
+        # emissions laid out by symbol, so one fancy index gathers the
+        # likelihood rows of a whole batch of sequences
+        self.emissions_by_symbol = np.ascontiguousarray(emissions.T)
+        read_only(self.start, self.transitions, self.emissions, self.log_start, self.log_transitions,
+                  self.emissions_by_symbol)
+
+    @classmethod
+    def from_hmm(cls, hmm):
+        states, symbols, start, trans_entries, emit_entries = model_entries(hmm)
+        transitions = np.zeros((len(states), len(states)))
+        emissions = np.zeros((len(states), len(symbols) + 1))
+        rows, columns, probs = trans_entries
+        transitions[rows, columns] = probs
+        rows, columns, probs = emit_entries
+        emissions[rows, columns] = probs
+        return cls(states, symbols, start, transitions, emissions)
+
+    def likelihoods(self, sequence):
+        """returns the (T, S) array of emission probabilities of each
+        observation under each state."""
+        ids = self.encode(sequence)
+        lik = self.emissions_by_symbol[ids]
+        if self.oov is not None:
+            self.oov.fill(lik[None], ids[None], [sequence])
+        return lik
+
+    def length_batches(self, sequences):
+        """groups the indices of sequences by sequence length, in batches
+        that keep B * S * S under BATCH_ELEMENTS so the viterbi score tensor
+        stays a reasonable size."""
+        by_length = {}
+        for i, sequence in enumerate(sequences):
+            if len(sequence) == 0:
+                raise ValueError("Cannot decode an empty sequence.")
+            by_length.setdefault(len(sequence), []).append(i)
+        n_states = len(self.states)
+        batch_size = max(1, BATCH_ELEMENTS // (n_states * n_states))
+        for length in sorted(by_length):
+            indices = by_length[length]
+            for chunk in range(0, len(indices), batch_size):
+                yield indices[chunk:chunk + batch_size]
+
+    def buckets(self, sequences):
+        """yields (indices, likelihoods) for batches of equal-length
+        sequences, with likelihoods of shape (B, T, S)."""
+        for batch in self.length_batches(sequences):
+            ids = np.stack([self.encode(sequences[i]) for i in batch])
+            lik = self.emissions_by_symbol[ids]
+            if self.stats.enabled:
+                self.stats.count("sentences", len(batch))
+                self.stats.count("tokens", ids.size)
+                self.stats.count("oov", int((ids == self.unknown).sum()))
+            if self.oov is not None:
+                self.oov.fill(lik, ids, [sequences[i] for i in batch])
+            yield batch, lik
 
-            path = new_path
+    def forward_batch(self, sequences, numeric="linear"):
+        """runs forward on many sequences at once, returning one
+        (state, probability) pair per sequence in the order given."""
+        check_numeric(numeric)
+        results = [None] * len(sequences)
+        for batch, lik in self.buckets(sequences):
+            best, norm_prob = self.forward_kernel(lik, numeric)
+            for i, state, prob in zip(batch, best.tolist(), norm_prob.tolist()):
+                # HMM.forward reports a plain 0 when every state has zero probability
+                results[i] = (self.states[state], prob or 0)
+        return results
 
-        max_final_prob, best_final_state = max((viterbi_prob[-1][state], state) for state in self.emissions)
-        return path[best_final_state]
+    def forward_kernel(self, lik, numeric):
+        """forward recurrence over a (B, T, S) likelihood batch; returns the
+        best final state ids and their normalized probabilities."""
+        rows = np.arange(len(lik))
+        if numeric == "log":
+            with np.errstate(divide="ignore"):
+                log_lik = np.log(lik)
+            log_alpha = self.log_start + log_lik[:, 0]
+            for t in range(1, lik.shape[1]):
+                log_alpha = logsumexp(log_alpha[:, :, None] + self.log_transitions, axis=1) + log_lik[:, t]
+            best = np.argmax(log_alpha, axis=1)
+            total = logsumexp(log_alpha, axis=1)
+            if self.stats.enabled:
+                self.count_underflows(log_alpha, impossible_tokens(lik, "linear"), numeric)
+            with np.errstate(invalid="ignore"):
+                norm_prob = np.where(total > -np.inf, np.exp(log_alpha[rows, best] - total), 0.0)
+            return best, norm_prob
 
+        alpha = self.start * lik[:, 0]
+        for t in range(1, lik.shape[1]):
+            if numeric == "scaled":
+                total = alpha.sum(axis=1, keepdims=True)
+                alpha = np.divide(alpha, total, out=alpha, where=total > 0)
+            alpha = (alpha @ self.transitions) * lik[:, t]
+        best = np.argmax(alpha, axis=1)
+        total = alpha.sum(axis=1)
+        if self.stats.enabled:
+            self.count_underflows(alpha, impossible_tokens(lik, numeric), numeric)
+        norm_prob = np.divide(alpha[rows, best], total, out=np.zeros(len(lik)), where=total > 0)
+        return best, norm_prob
 
+    def viterbi_batch(self, sequences, numeric="linear"):
+        """runs viterbi on many sequences at once, returning one state
+        sequence per sequence in the order given."""
+        check_numeric(numeric)
+        results = [None] * len(sequences)
+        for batch, lik in self.buckets(sequences):
+            paths = self.viterbi_kernel(lik, numeric)
+            for i, path in zip(batch, paths.tolist()):
+                results[i] = [self.states[state] for state in path]
+        return results
 
+    def viterbi_kernel(self, lik, numeric):
+        """viterbi recurrence over a (B, T, S) likelihood batch; returns the
+        (B, T) array of best state ids."""
+        if self.beam is not None or self.beam_ratio is not None:
+            return self.beam_kernel(lik, numeric)
+        start, transitions = self.start, self.transitions
+        if numeric == "log":
+            with np.errstate(divide="ignore"):
+                lik = np.log(lik)
+            start, transitions = self.log_start, self.log_transitions
+
+        n_batch, n_steps, n_states = lik.shape
+        rows = np.arange(n_batch)
+        backpointers = np.zeros((n_steps, n_batch, n_states), dtype=np.int32)
+        if numeric == "log":
+            delta = start + lik[:, 0]
+        else:
+            delta = start * lik[:, 0]
+        for t in range(1, n_steps):
+            # scores[b, i, j]: best path to state i extended into state j
+            if numeric == "log":
+                scores = (delta[:, :, None] + transitions) + lik[:, t, None, :]
+            else:
+                if numeric == "scaled":
+                    top = delta.max(axis=1, keepdims=True)
+                    delta = np.divide(delta, top, out=delta, where=top > 0)
+                scores = (delta[:, :, None] * transitions) * lik[:, t, None, :]
+            best_prev = self.tie_order[np.argmax(scores[:, self.tie_order, :], axis=1)]
+            backpointers[t] = best_prev
+            delta = np.take_along_axis(scores, best_prev[:, None, :], axis=1)[:, 0, :]
+
+        if self.stats.enabled:
+            self.count_underflows(delta, impossible_tokens(lik, numeric), numeric)
+        paths = np.zeros((n_batch, n_steps), dtype=np.intp)
+        state = self.tie_order[np.argmax(delta[:, self.tie_order], axis=1)]
+        paths[:, -1] = state
+        for t in range(n_steps - 1, 0, -1):
+            state = backpointers[t, rows, state]
+            paths[:, t - 1] = state
+        return paths
+
+    def pruned(self, beam=None, ratio=None):
+        """returns a copy of this model whose viterbi is beam-pruned: at each
+        step only the beam best states, and of those only the ones scoring
+        at least ratio times the best, are extended. Each step then costs
+        O(K * S) instead of O(S^2), but the path found may not be the best."""
+        if beam is not None and beam < 1:
+            raise ValueError("The beam must keep at least one state.")
+        if ratio is not None and not 0 <= ratio <= 1:
+            raise ValueError("The beam ratio must be between 0 and 1.")
+        model = copy.copy(self)
+        model.beam, model.beam_ratio = beam, ratio
+        return model
+
+    def beam_kernel(self, lik, numeric):
+        """viterbi_kernel restricted to the states kept by the beam. The kept
+        states are scanned in tie_order, so with a beam covering every state
+        the result is exactly viterbi_kernel's."""
+        start, transitions = self.start, self.transitions
+        if numeric == "log":
+            with np.errstate(divide="ignore"):
+                lik = np.log(lik)
+            start, transitions = self.log_start, self.log_transitions
+            delta = start + lik[:, 0]
+        else:
+            delta = start * lik[:, 0]
+
+        n_batch, n_steps, n_states = lik.shape
+        rows = np.arange(n_batch)
+        width = min(self.beam or n_states, n_states)
+        backpointers = np.zeros((n_steps, n_batch, n_states), dtype=np.int32)
+        for t in range(1, n_steps):
+            if numeric == "scaled":
+                top = delta.max(axis=1, keepdims=True)
+                delta = np.divide(delta, top, out=delta, where=top > 0)
+            keep, kept = self.beam_states(delta, width, numeric)
+            # scores[b, k, j]: best path to the k-th kept state extended into state j
+            if numeric == "log":
+                scores = (kept[:, :, None] + transitions[keep]) + lik[:, t, None, :]
+            else:
+                scores = (kept[:, :, None] * transitions[keep]) * lik[:, t, None, :]
+            best = np.argmax(scores, axis=1)
+            backpointers[t] = np.take_along_axis(keep, best, axis=1)
+            delta = np.take_along_axis(scores, best[:, None, :], axis=1)[:, 0, :]
+
+        if self.stats.enabled:
+            self.count_underflows(delta, impossible_tokens(lik, numeric), numeric)
+        paths = np.zeros((n_batch, n_steps), dtype=np.intp)
+        state = self.tie_order[np.argmax(delta[:, self.tie_order], axis=1)]
+        paths[:, -1] = state
+        for t in range(n_steps - 1, 0, -1):
+            state = backpointers[t, rows, state]
+            paths[:, t - 1] = state
+        return paths
+
+    def beam_states(self, delta, width, numeric):
+        """returns the (B, K) ids of the states the beam keeps from a (B, S)
+        score batch, in tie_order, and their scores, with the ones below the
+        ratio threshold zeroed (or -inf in log space)."""
+        n_batch, n_states = delta.shape
+        floor = -np.inf if numeric == "log" else 0.0
+        if self.beam_ratio is not None:
+            top = delta.max(axis=1, keepdims=True)
+            with np.errstate(divide="ignore"):
+                threshold = top + np.log(self.beam_ratio) if numeric == "log" else top * self.beam_ratio
+            delta = np.where(delta >= threshold, delta, floor)
+            # every row gets the same width, so only as many as the widest row needs
+            width = max(1, min(width, int((delta > floor).sum(axis=1).max())))
+        if width < n_states:
+            # positions in tie_order of the best states; the stable sort keeps
+            # equal scores in the order viterbi prefers them
+            best = np.argsort(-delta[:, self.tie_order], axis=1, kind="stable")[:, :width]
+            keep = self.tie_order[np.sort(best, axis=1)]
+        else:
+            keep = np.broadcast_to(self.tie_order, (n_batch, n_states))
+        return keep, np.take_along_axis(delta, keep, axis=1)
+
+    def beam_report(self, sequences, beam=None, ratio=None, numeric="linear", chunk_size=DECODE_CHUNK):
+        """decodes sequences both exactly and with pruned(beam, ratio), and
+        returns how often they agree, by sequence and by token, and the time
+        each took."""
+        pruned = self.pruned(beam, ratio)
+        report = {"beam": beam, "ratio": ratio, "sequences": 0, "matching_sequences": 0,
+                  "tokens": 0, "matching_tokens": 0, "exact_seconds": 0.0, "beam_seconds": 0.0}
+        for chunk in chunked(sequences, chunk_size):
+            started = time.perf_counter()
+            exact = self.viterbi_batch(chunk, numeric)
+            report["exact_seconds"] += time.perf_counter() - started
+            started = time.perf_counter()
+            approximate = pruned.viterbi_batch(chunk, numeric)
+            report["beam_seconds"] += time.perf_counter() - started
+            for path, beam_path in zip(exact, approximate):
+                report["sequences"] += 1
+                report["matching_sequences"] += path == beam_path
+                report["tokens"] += len(path)
+                report["matching_tokens"] += sum(a == b for a, b in zip(path, beam_path))
+        report["sequence_agreement"] = report["matching_sequences"] / max(report["sequences"], 1)
+        report["token_agreement"] = report["matching_tokens"] / max(report["tokens"], 1)
+        return report
+
+    def posteriors(self, sequence):
+        """returns the (T, S) array of P(state at t | whole sequence),
+        computed by scaled forward-backward."""
+        lik = self.likelihoods(sequence)[None]
+        alpha, beta, scale = self.forward_backward(lik)
+        if not scale.all():
+            raise ValueError("Sequence has zero probability under this model.")
+        return (alpha * beta)[0]
+
+    def forward_backward(self, lik):
+        """scaled forward-backward over a (B, T, S) likelihood batch. Returns
+        alpha and beta, each normalized so alpha * beta is the state posterior,
+        and the (B, T) per-step scale factors, whose logs sum to the sequence
+        log likelihood. A zero scale marks a sequence of zero probability."""
+        n_batch, n_steps, n_states = lik.shape
+        alpha = np.zeros(lik.shape)
+        beta = np.ones(lik.shape)
+        scale = np.zeros((n_batch, n_steps))
+        step = self.start * lik[:, 0]
+        for t in range(n_steps):
+            if t > 0:
+                step = (alpha[:, t - 1] @ self.transitions) * lik[:, t]
+            scale[:, t] = step.sum(axis=1)
+            alpha[:, t] = step / np.where(scale[:, t] > 0, scale[:, t], 1)[:, None]
+        safe_scale = np.where(scale > 0, scale, 1)
+        for t in range(n_steps - 2, -1, -1):
+            beta[:, t] = ((lik[:, t + 1] * beta[:, t + 1]) @ self.transitions.T) / safe_scale[:, t + 1, None]
+        return alpha, beta, scale
+
+    def expected_counts(self, encoded):
+        """the Baum-Welch E-step over a list of symbol id arrays. Returns
+        (start, transitions, emissions, log likelihood, skipped), where the
+        first three are expected counts shaped like the model's arrays and
+        skipped counts sequences of zero probability, which add nothing.
+        Unknown symbols are treated as missing observations."""
+        emissions_by_symbol = self.emissions_by_symbol.copy()
+        emissions_by_symbol[self.unknown] = 1.0
+        start_counts = np.zeros(len(self.states))
+        transition_counts = np.zeros(self.transitions.shape)
+        emission_counts = np.zeros(emissions_by_symbol.shape)
+        log_likelihood = 0.0
+        skipped = 0
+        for batch in self.length_batches(encoded):
+            ids = np.stack([encoded[i] for i in batch])
+            lik = emissions_by_symbol[ids]
+            alpha, beta, scale = self.forward_backward(lik)
+            ok = scale.all(axis=1)
+            skipped += int((~ok).sum())
+            alpha, beta, scale, ids, lik = alpha[ok], beta[ok], scale[ok], ids[ok], lik[ok]
+            log_likelihood += float(np.log(scale).sum())
+            gamma = alpha * beta
+            start_counts += gamma[:, 0].sum(axis=0)
+            following = (lik * beta / scale[:, :, None])[:, 1:]
+            transition_counts += self.transitions * np.einsum("bti,btj->ij", alpha[:, :-1], following)
+            np.add.at(emission_counts, ids.ravel(), gamma.reshape(-1, gamma.shape[-1]))
+        emission_counts[self.unknown] = 0
+        return start_counts, transition_counts, emission_counts.T, log_likelihood, skipped
+
+    def reestimate(self, start_counts, transition_counts, emission_counts):
+        """the Baum-Welch M-step: returns a new CompiledHMM with the counts
+        normalized into probabilities. Rows without counts keep their old values."""
+        def normalize(counts, old):
+            total = counts.sum(axis=-1, keepdims=True)
+            return np.where(total > 0, counts / np.where(total > 0, total, 1), old)
+        return CompiledHMM(self.states, self.symbols, normalize(start_counts, self.start),
+                           normalize(transition_counts, self.transitions), normalize(emission_counts, self.emissions))
+
+    def sampler(self):
+        """returns a Sampler that draws sequences from this model."""
+        return Sampler(self)
+
+    def filter(self, lag=0):
+        """returns a ForwardFilter that tracks this model's belief online."""
+        return ForwardFilter(self, lag)
+
+    def viterbi_topk(self, sequence, k):
+        """returns up to k (path, log probability) pairs for the most likely
+        state sequences, best first. Each state keeps its k best partial paths
+        in log space, with a (T, S, k) backpointer table; paths with zero
+        probability are left out, and when every path has zero probability
+        the result is viterbi's path alone, with log probability -inf. The
+        first path is as likely as the one viterbi returns, but when paths
+        tie it can be another of them, since the sums of logs round
+        differently from viterbi's products."""
+        with np.errstate(divide="ignore"):
+            log_lik = np.log(self.likelihoods(sequence))
+        n_steps, n_states = log_lik.shape
+        # ties are broken by score, then by state name like viterbi, then by rank
+        rank_key = np.tile(np.arange(k), n_states)
+        name_key = np.repeat(np.argsort(self.tie_order), k)
+
+        delta = np.full((n_states, k), -np.inf)
+        delta[:, 0] = self.log_start + log_lik[0]
+        backpointers = np.zeros((n_steps, n_states, k), dtype=np.int32)
+        for t in range(1, n_steps):
+            # scores[j, i*k + r]: extend the r-th best path into state i with state j
+            scores = (delta.reshape(-1, 1) + np.repeat(self.log_transitions, k, axis=0) + log_lik[t]).T
+            order = np.lexsort((np.broadcast_to(rank_key, scores.shape),
+                                np.broadcast_to(name_key, scores.shape), -scores), axis=-1)[:, :k]
+            backpointers[t] = order
+            delta = np.take_along_axis(scores, order, axis=1)
+
+        final = delta.reshape(-1)
+        order = np.lexsort((rank_key, name_key, -final))[:k]
+        results = []
+        for flat in order:
+            if final[flat] == -np.inf:
+                break
+            state, rank = divmod(int(flat), k)
+            path = [state]
+            for t in range(n_steps - 1, 0, -1):
+                state, rank = divmod(int(backpointers[t, state, rank]), k)
+                path.append(state)
+            results.append(([self.states[i] for i in reversed(path)], float(final[flat])))
+        if not results:
+            results.append((self.viterbi(sequence), -np.inf))
+        return results
+
+
+
+
+
+# SparseHMM - CSR form of an HMM for large, mostly-zero models such as a
+# fine lander grid. Transitions are stored by source state, and emissions
+# are inverted into, for each symbol, the states that can emit it. A step
+# then only visits the transitions out of states with non-zero probability,
+# so it costs O(S + nnz) instead of O(S^2). Results are the same as
+# CompiledHMM's; 'log' forward is computed with per-step scaling, which
+# gives the same state and normalized probability. It only decodes: filtering,
+# sampling, top-k and beam viterbi, Baum-Welch and the decode cache need the
+# dense arrays.
+
+def csr_positions(indptr, rows):
+    """returns the positions of the entries of the given rows of a CSR table."""
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+def csr_table(rows, columns, values, n_rows):
+    """builds (indptr, columns, values) from entries, dropping zero values."""
+    keep = values > 0
+    rows, columns, values = rows[keep], columns[keep], values[keep]
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, columns[order], values[order]
+
+class SparseHMM(DecodingModel):
+    def __init__(self, states, symbols, start, trans_entries, emit_entries):
+        """trans_entries and emit_entries are (row ids, column ids, probabilities)
+        arrays as returned by model_entries."""
+        self.states = states
+        self.symbols = symbols
+        self.start = start
+        self.unknown = len(symbols)
+        self.tie_order = tie_order(states)
+        # rank of each state name, larger for names that win viterbi ties
+        self.name_rank = np.argsort(self.tie_order[::-1])
+        rows, columns, probs = trans_entries
+        self.trans_indptr, self.trans_next, self.trans_probs = csr_table(rows, columns, probs, len(states))
+        rows, columns, probs = emit_entries
+        self.emit_indptr, self.emit_states, self.emit_probs = csr_table(columns, rows, probs, len(symbols) + 1)
+        read_only(self.start, self.trans_indptr, self.trans_next, self.trans_probs,
+                  self.emit_indptr, self.emit_states, self.emit_probs)
+
+    @classmethod
+    def from_hmm(cls, hmm):
+        return cls(*model_entries(hmm))
+
+    def emission_vector(self, symbol_id):
+        """returns the (S,) emission probabilities of a symbol id."""
+        lik = np.zeros(len(self.states))
+        span = slice(self.emit_indptr[symbol_id], self.emit_indptr[symbol_id + 1])
+        lik[self.emit_states[span]] = self.emit_probs[span]
+        return lik
+
+    def likelihoods(self, sequence):
+        return np.array([self.emission_vector(i) for i in self.encode(sequence)]).reshape(-1, len(self.states))
+
+    def edges(self, active):
+        """returns (source, destination, probability) of the transitions out of active states."""
+        positions = csr_positions(self.trans_indptr, active)
+        sources = np.repeat(active, self.trans_indptr[active + 1] - self.trans_indptr[active])
+        return sources, self.trans_next[positions], self.trans_probs[positions]
+
+    def encode_counted(self, sequence):
+        """encodes a sequence to decode, counting it when instrumented, as
+        CompiledHMM.buckets does for a batch."""
+        if len(sequence) == 0:
+            raise ValueError("Cannot decode an empty sequence.")
+        ids = self.encode(sequence)
+        if self.stats.enabled:
+            self.stats.count("sentences")
+            self.stats.count("tokens", len(ids))
+            self.stats.count("oov", int((ids == self.unknown).sum()))
+        return ids
+
+    def forward_batch(self, sequences, numeric="linear"):
+        check_numeric(numeric)
+        results = []
+        for sequence in sequences:
+            ids = self.encode_counted(sequence)
+            alpha = self.start * self.emission_vector(ids[0])
+            for symbol_id in ids[1:]:
+                if numeric != "linear":
+                    total = alpha.sum()
+                    if total > 0:
+                        alpha = alpha / total
+                sources, destinations, probs = self.edges(np.flatnonzero(alpha))
+                alpha = (np.bincount(destinations, weights=alpha[sources] * probs, minlength=len(self.states))
+                         * self.emission_vector(symbol_id))
+            best = int(np.argmax(alpha))
+            total = alpha.sum()
+            if self.stats.enabled:
+                self.count_underflows(alpha[None], impossible_tokens(self.likelihoods(sequence)[None], "linear"),
+                                      numeric)
+            norm_prob = float(alpha[best] / total) if total > 0 else 0
+            results.append((self.states[best], norm_prob))
+        return results
+
+    def viterbi_batch(self, sequences, numeric="linear"):
+        check_numeric(numeric)
+        return [self.sparse_viterbi(sequence, numeric) for sequence in sequences]
+
+    def sparse_viterbi(self, sequence, numeric):
+        n_states = len(self.states)
+        ids = self.encode_counted(sequence)
+        use_log = numeric == "log"
+        # in log space a missing entry is -inf rather than 0
+        floor = -np.inf if use_log else 0.0
+        lik = self.emission_vector(ids[0])
+        with np.errstate(divide="ignore"):
+            delta = np.log(self.start) + np.log(lik) if use_log else self.start * lik
+        # columns with no path of positive probability point at the state
+        # that wins an all-zero tie, as they do in the dense implementation
+        backpointers = np.full((len(ids), n_states), self.tie_order[0], dtype=np.int32)
+        for t in range(1, len(ids)):
+            if numeric == "scaled":
+                top = delta.max()
+                if top > 0:
+                    delta = delta / top
+            sources, destinations, probs = self.edges(np.flatnonzero(delta > floor))
+            lik = self.emission_vector(ids[t])
+            if use_log:
+                with np.errstate(divide="ignore"):
+                    scores = (delta[sources] + np.log(probs)) + np.log(lik[destinations])
+            else:
+                scores = (delta[sources] * probs) * lik[destinations]
+            keep = scores > floor
+            sources, destinations, scores = sources[keep], destinations[keep], scores[keep]
+            # the last entry of each destination is its best score, ties going to the largest name
+            order = np.lexsort((self.name_rank[sources], scores, destinations))
+            ordered = destinations[order]
+            last = order[np.append(ordered[1:] != ordered[:-1], True)] if len(order) else order
+            delta = np.full(n_states, floor)
+            delta[destinations[last]] = scores[last]
+            backpointers[t, destinations[last]] = sources[last]
+
+        if self.stats.enabled:
+            self.count_underflows(delta[None], impossible_tokens(self.likelihoods(sequence)[None], "linear"), numeric)
+        state = int(self.tie_order[np.argmax(delta[self.tie_order])])
+        path = [state]
+        for t in range(len(ids) - 1, 0, -1):
+            state = int(backpointers[t, state])
+            path.append(state)
+        return [self.states[i] for i in reversed(path)]
+
+
+# Sampler - draws many sequences at once by inverse-CDF sampling. The
+# cumulative distribution of every row of a probability table is shifted by
+# its row number and flattened, so drawing from row r is one searchsorted
+# for r + u, and a whole batch of rows is drawn with a single call.
+
+class SampleTable:
+    def __init__(self, probs):
+        """probs is a (R, K) array of row distributions, not necessarily normalized."""
+        n_rows, self.width = probs.shape
+        mass = probs.sum(axis=1)
+        self.empty = mass == 0
+        cdf = np.cumsum(probs, axis=1) / np.where(self.empty, 1, mass)[:, None]
+        # pin each row's cdf to 1 from its last non-zero entry on, so rounding
+        # can never select an entry of zero probability
+        self.last = self.width - 1 - np.argmax(probs[:, ::-1] > 0, axis=1)
+        cdf[np.arange(self.width) >= self.last[:, None]] = 1.0
+        self.flat = (cdf + np.arange(n_rows)[:, None]).ravel()
+
+    def draw(self, rows, rng):
+        """returns one column id drawn from each of the given rows."""
+        if self.empty[rows].any():
+            raise ValueError("Cannot sample from a state with no outgoing probability.")
+        picks = np.searchsorted(self.flat, rows + rng.random(rows.shape), side="right") - rows * self.width
+        return np.minimum(picks, self.last[rows])
+
+class Sampler:
+    def __init__(self, model):
+        self.model = model
+        self.start = SampleTable(model.start[None, :])
+        self.transitions = SampleTable(model.transitions)
+        self.emissions = SampleTable(model.emissions)
+
+    def sample(self, n, count=1, rng=None):
+        """returns (states, outputs), two (count, n) arrays of state and
+        symbol ids for count independent sequences of length n."""
+        if rng is None:
+            rng = np.random.default_rng()
+        states = np.zeros((count, n), dtype=np.int32)
+        if n == 0:
+            return states, states.copy()
+        state = self.start.draw(np.zeros(count, dtype=np.intp), rng)
+        states[:, 0] = state
+        for t in range(1, n):
+            state = self.transitions.draw(state, rng)
+            states[:, t] = state
+        outputs = self.emissions.draw(states.ravel().astype(np.intp), rng).reshape(count, n).astype(np.int32)
+        return states, outputs
+
+    def sequences(self, n, count=1, rng=None):
+        """returns a labeled Corpus of count Sequences of length n."""
+        states, outputs = self.sample(n, count, rng)
+        return Corpus.from_arrays(states, outputs, self.model.states, self.model.symbols)
+
+
+# ForwardFilter - online forward filtering over an unbounded observation
+# stream, such as the lander's sensor feed. It keeps only the normalized
+# belief over states, so each update costs O(S^2) however long the stream
+# has run. With lag L it also keeps the last L+1 steps and smooths the
+# belief about the state L steps back using the readings that came after it.
+
+class ForwardFilter:
+    def __init__(self, model, lag=0):
+        self.model = model
+        self.lag = lag
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.belief = None   # P(current state | readings so far)
+        self.window = deque(maxlen=self.lag + 1)   # (belief, likelihood) of the last lag+1 steps
+
+    def update(self, symbol):
+        """folds one reading into the belief and returns it. Readings the
+        model has never seen, or that no reachable state could have emitted,
+        are treated as missing: the belief is only moved forward in time."""
+        model = self.model
+        if self.belief is None:
+            predicted = model.start
+        else:
+            predicted = self.belief @ model.transitions
+        symbol_id = model.symbols.get(symbol, model.unknown)
+        if model.stats.enabled:
+            model.stats.count("tokens")
+            model.stats.count("oov", symbol_id == model.unknown)
+        if symbol_id == model.unknown and model.oov is not None:
+            lik = model.oov.resolve(symbol)
+        else:
+            lik = model.emissions_by_symbol[symbol_id]
+        belief = predicted * lik
+        total = belief.sum()
+        if total == 0:
+            lik = np.ones_like(lik)
+            belief, total = predicted, predicted.sum()
+            if total == 0:
+                raise ValueError("No state is reachable from the current belief.")
+        self.belief = belief / total
+        self.window.append((self.belief, lik))
+        self.steps += 1
+        return self.belief
+
+    def state(self):
+        """returns the most probable current state and its probability."""
+        best = int(np.argmax(self.belief))
+        return self.model.states[best], float(self.belief[best])
+
+    def smoothed(self):
+        """returns (step, state, probability) for the step lag readings back,
+        using every reading up to now, or None until that many have arrived."""
+        if len(self.window) <= self.lag:
+            return None
+        beta = np.ones(len(self.model.states))
+        for belief, lik in list(self.window)[:0:-1]:
+            beta = self.model.transitions @ (lik * beta)
+            beta /= beta.sum()
+        posterior = self.window[0][0] * beta
+        posterior /= posterior.sum()
+        best = int(np.argmax(posterior))
+        return self.steps - 1 - self.lag, self.model.states[best], float(posterior[best])
+
+def iter_tokens(fileobj):
+    """lazily yields the whitespace-separated readings of a stream."""
+    for line in fileobj:
+        yield from line.split()
+
+
+# OOVModel - emission estimates for words the model has never seen, so an
+# unknown word does not zero out the whole lattice. It is built once from
+# the emission table: for every suffix of up to OOV_SUFFIX letters, and every
+# word shape class, the share of each state's known words that have it. An
+# unknown word is scored in state s as the probability s gives a word it has
+# seen once (its smallest emission), times the share of s's words with the
+# unknown word's longest well-attested suffix, times the share with its
+# shape. Suffixes are matched in lower case, and words known in lower case
+# use that column. Resolved vectors are
+# kept in an LRU cache, so repeated unknown words cost one dict lookup.
+
+OOV_SUFFIX = 4
+OOV_MIN_WORDS = 5     # known words a suffix needs before it is trusted
+OOV_CACHE = 1 << 16   # resolved words kept by the LRU cache
+WORD_SHAPES = ("lower", "capitalized", "upper", "number", "digits", "hyphen", "punct", "other")
+
+def word_shape(word):
+    """returns the shape class of a word, one of WORD_SHAPES."""
+    if not word.isalpha():
+        if any(c.isdigit() for c in word):
+            return "number" if all(c.isdigit() or c in ".,-/:" for c in word) else "digits"
+        if not any(c.isalnum() for c in word):
+            return "punct"
+        if "-" in word:
+            return "hyphen"
+    if word.islower():
+        return "lower"
+    if word.isupper():
+        return "upper"
+    return "capitalized" if word[0].isupper() else "other"
+
+class OOVModel:
+    def __init__(self, model):
+        self.model = model
+        emits = model.emissions[:, :model.unknown] > 0   # (S, V) which states emit which words
+        types = emits.sum(axis=1)
+        with np.errstate(invalid="ignore"):
+            singleton = np.where(emits, model.emissions[:, :model.unknown], np.inf).min(axis=1)
+        self.singleton = np.where(types > 0, singleton, 0.0)
+
+        words = model.symbols.items
+        suffix_index = {}   # suffixes of different lengths never collide, so one dict holds them all
+        suffix_ids, word_ids = [], []
+        for k in range(1, OOV_SUFFIX + 1):
+            long_enough = [j for j, word in enumerate(words) if len(word) >= k]
+            suffix_ids += [suffix_index.setdefault(words[j][-k:], len(suffix_index)) for j in long_enough]
+            word_ids += long_enough
+        self.suffixes = Vocabulary(suffix_index)
+        suffix_counts = np.stack([np.bincount(suffix_ids, weights=row[word_ids], minlength=len(self.suffixes))
+                                  for row in emits], axis=1)
+        self.suffix_words = np.bincount(suffix_ids, minlength=len(self.suffixes))
+        # add-one estimates, so a state without a matching word keeps a small share
+        self.suffix_share = (suffix_counts + 1) / (types + len(self.suffixes))
+
+        shape_ids = np.array([WORD_SHAPES.index(word_shape(word)) for word in words], dtype=np.intp)
+        shape_counts = np.stack([np.bincount(shape_ids, weights=row, minlength=len(WORD_SHAPES)) for row in emits], axis=1)
+        self.shape_share = (shape_counts + 1) / (types + len(WORD_SHAPES))
+        # a shape no known word has, such as capitals in a lower-cased model, says nothing
+        self.shape_share[shape_counts.sum(axis=1) == 0] = 1.0
+        self.resolve = functools.lru_cache(maxsize=OOV_CACHE)(self.estimate)
+
+    def __getstate__(self):
+        # the LRU of estimates cannot be pickled, so a worker starts its own
+        state = dict(self.__dict__)
+        del state["resolve"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.resolve = functools.lru_cache(maxsize=OOV_CACHE)(self.estimate)
+
+    def estimate(self, word):
+        """returns the (S,) emission estimates for a word the model lacks."""
+        lower = word.lower()
+        known = self.model.symbols.get(lower)
+        if known >= 0:
+            return self.model.emissions_by_symbol[known]
+        lik = self.singleton * self.shape_share[WORD_SHAPES.index(word_shape(word))]
+        for k in range(min(OOV_SUFFIX, len(word)), 0, -1):
+            suffix = self.suffixes.get(lower[-k:])
+            if suffix >= 0 and self.suffix_words[suffix] >= OOV_MIN_WORDS:
+                return lik * self.suffix_share[suffix]
+        return lik
+
+    def fill(self, lik, ids, sequences):
+        """replaces, in place, the all-zero (B, T, S) likelihood rows of
+        unknown symbols in a batch of encoded sequences with estimates."""
+        rows, steps = np.nonzero(ids == self.model.unknown)
+        for b, t in zip(rows.tolist(), steps.tolist()):
+            lik[b, t] = self.resolve(sequences[b][t])
+
+
+# DecodeCache - memoizes decoding for inputs that repeat, such as the short
+# cat and lander readings. Whole results are kept in a bounded LRU keyed on
+# the tuple of symbol ids. Forward also keeps a prefix trie of alpha vectors,
+# one node per distinct prefix seen, so a sequence that shares a prefix with
+# earlier input continues from the cached alpha instead of from t=0. When
+# the trie reaches its node limit it is cleared and grows again.
+
+DECODE_CACHE = 10000   # whole results kept by the LRU
+PREFIX_NODES = 1 << 16   # alpha vectors kept by the prefix trie
+
+class PrefixNode:
+    __slots__ = ("children", "alpha")
+
+    def __init__(self, alpha=None):
+        self.children = {}
+        self.alpha = alpha
+
+class DecodeCache:
+    def __init__(self, model, size=DECODE_CACHE, prefix_nodes=PREFIX_NODES):
+        self.model = model
+        self.size = size
+        self.prefix_nodes = prefix_nodes
+        self.results = OrderedDict()   # (mode, numeric, key) -> result, least recently used first
+        self.clear()
+
+    def clear(self):
+        self.results.clear()
+        self.roots = {}   # numeric -> PrefixNode
+        self.nodes = 0
+        self.hits = self.misses = self.prefix_hits = self.steps_reused = 0
+
+    @property
+    def stats(self):
+        return self.model.stats
+
+    def info(self):
+        """returns the hit and miss counts and the current sizes."""
+        return {"hits": self.hits, "misses": self.misses, "prefix_hits": self.prefix_hits,
+                "steps_reused": self.steps_reused, "results": len(self.results), "prefix_nodes": self.nodes}
+
+    def key(self, sequence):
+        """returns the tuple of symbol ids of a sequence. With an OOV model,
+        unknown symbols are kept as strings, as each has its own estimate."""
+        ids = self.model.encode(sequence).tolist()
+        if self.model.oov is not None:
+            unknown = self.model.unknown
+            return tuple(symbol if i == unknown else i for i, symbol in zip(ids, sequence))
+        return tuple(ids)
+
+    def lookup(self, mode, numeric, sequences):
+        """returns the cached results for sequences (None where missing), and
+        the misses as key -> positions; a sequence repeated within the batch
+        is a miss once and a hit after that."""
+        results = [None] * len(sequences)
+        missing = {}
+        hit_tokens = 0
+        for i, sequence in enumerate(sequences):
+            if len(sequence) == 0:
+                raise ValueError("Cannot decode an empty sequence.")
+            key = (mode, numeric, self.key(sequence))
+            result = self.results.get(key)
+            if result is None and key not in missing:
+                self.misses += 1
+                missing[key] = [i]
+                continue
+            self.hits += 1
+            hit_tokens += len(sequence)
+            if result is None:
+                missing[key].append(i)
+            else:
+                self.results.move_to_end(key)
+                results[i] = list(result) if mode == "viterbi" else result
+        if self.stats.enabled:
+            # the model counts what it decodes; hits are counted here
+            self.stats.count("sentences", len(sequences) - len(missing))
+            self.stats.count("tokens", hit_tokens)
+        return results, missing
+
+    def store(self, key, result):
+        self.results[key] = result
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def forward(self, sequence, numeric="linear"):
+        return self.forward_batch([sequence], numeric)[0]
+
+    def viterbi(self, sequence, numeric="linear"):
+        return self.viterbi_batch([sequence], numeric)[0]
+
+    def forward_batch(self, sequences, numeric="linear"):
+        """CompiledHMM.forward_batch, answering repeated sequences from the
+        LRU and continuing new ones from their longest cached prefix."""
+        check_numeric(numeric)
+        results, missing = self.lookup("forward", numeric, sequences)
+        for key, positions in missing.items():
+            result = self.forward_prefix(sequences[positions[0]], key[2], numeric)
+            self.store(key, result)
+            for i in positions:
+                results[i] = result
+        return results
+
+    def viterbi_batch(self, sequences, numeric="linear"):
+        """CompiledHMM.viterbi_batch, answering repeated sequences from the
+        LRU and decoding the rest together in one batch."""
+        results, missing = self.lookup("viterbi", numeric, sequences)
+        if missing:
+            decoded = self.model.viterbi_batch([sequences[positions[0]] for positions in missing.values()], numeric)
+            for (key, positions), path in zip(missing.items(), decoded):
+                self.store(key, path)
+                for i in positions:
+                    results[i] = list(path)
+        return results
+
+    def forward_prefix(self, sequence, key, numeric):
+        """runs forward over a sequence one step at a time, as forward_kernel
+        does, starting after the longest prefix of key in the trie and adding
+        the alpha of every new prefix to it."""
+        model = self.model
+        node = self.roots.setdefault(numeric, PrefixNode())
+        t = 0
+        while t < len(key) and key[t] in node.children:
+            node = node.children[key[t]]
+            t += 1
+        if t:
+            self.prefix_hits += 1
+            self.steps_reused += t
+        alpha = node.alpha
+        lik = model.likelihoods(sequence[t:])
+        if numeric == "log":
+            with np.errstate(divide="ignore"):
+                lik = np.log(lik)
+        for step in range(t, len(key)):
+            if step == 0:
+                alpha = (model.log_start + lik[0]) if numeric == "log" else model.start * lik[0]
+            elif numeric == "log":
+                alpha = logsumexp(alpha[:, None] + model.log_transitions, axis=0) + lik[step - t]
+            else:
+                if numeric == "scaled":
+                    total = alpha.sum()
+                    if total > 0:
+                        alpha = alpha / total
+                alpha = (alpha @ model.transitions) * lik[step - t]
+            if node is None:
+                continue
+            if self.nodes >= self.prefix_nodes:
+                # full: start again, and leave the rest of this sequence out
+                self.roots, self.nodes, node = {}, 0, None
+            else:
+                node = node.children.setdefault(key[step], PrefixNode(alpha))
+                self.nodes += 1
+
+        best = int(np.argmax(alpha))
+        if numeric == "log":
+            total = logsumexp(alpha)
+            norm_prob = float(np.exp(alpha[best] - total)) if total > -np.inf else 0.0
+        else:
+            total = alpha.sum()
+            norm_prob = float(alpha[best] / total) if total > 0 else 0.0
+        if model.stats.enabled:
+            model.stats.count("sentences")
+            model.stats.count("tokens", len(key))
+            model.stats.count("oov", len(key) - sum(symbol in model.symbols for symbol in sequence))
+            model.count_underflows(alpha[None], impossible_tokens(model.likelihoods(sequence)[None], "linear"),
+                                   numeric)
+        # HMM.forward reports a plain 0 when every state has zero probability
+        return model.states[best], norm_prob or 0
+
+    # streaming goes through decode_sequences, which only needs the batch methods
+    iter_forward = CompiledHMM.iter_forward
+    iter_viterbi = CompiledHMM.iter_viterbi
+
+
+# Supervised training - counts transitions and emissions in a tagged corpus,
+# where each line of tags is followed by its line of words, as in
+# ambiguous_sents.tagged.obs. Each shard interns its own tags and words and
+# counts pairs in Counters keyed by (first id << 32 | second id); shards are
+# merged by remapping their ids to global ones.
+
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+
+def iter_tagged(fileobj):
+    """lazily yields (tags, words) pairs from a tagged corpus."""
+    lines = iter_sequences(fileobj)
+    for tags in lines:
+        words = next(lines, None)
+        if words is None or len(words) != len(tags):
+            raise ValueError(f"Tags '{' '.join(tags)}' do not line up with the words that follow them.")
+        yield tags, words
+
+def count_tagged(chunk):
+    """counts a shard of (tags, words) pairs, returning (tag names, word
+    names, transition counts, emission counts). Tag id 0 is the start '#'."""
+    tags = Vocabulary(["#"])
+    words = Vocabulary()
+    transitions = Counter()
+    emissions = Counter()
+    for tag_sequence, word_sequence in chunk:
+        prev = 0
+        for tag, word in zip(tag_sequence, word_sequence):
+            current = tags.add(tag)
+            transitions[prev << PAIR_SHIFT | current] += 1
+            emissions[current << PAIR_SHIFT | words.add(word)] += 1
+            prev = current
+    return tags.items, words.items, transitions, emissions
+
+def remap_pairs(counter, first_map, second_map):
+    """returns the keys of a pair Counter translated to global ids, and its counts."""
+    keys = np.fromiter(counter.keys(), dtype=np.int64, count=len(counter))
+    counts = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+    return first_map[keys >> PAIR_SHIFT] << PAIR_SHIFT | second_map[keys & PAIR_MASK], counts
+
+def merge_pairs(keys, counts):
+    """sums the counts of repeated keys; returns sorted unique keys and totals."""
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    unique, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    return unique, np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+
+
+# ModelRegistry - keeps every model a process has loaded, by basename, so
+# cat, lander and partofspeech can be served side by side without being
+# reloaded. Each is loaded once and compiled; compiled models have read-only
+# arrays, so one copy is shared by every caller and thread. hmm() hands out
+# an HMM with its own copies of the dicts, which callers may change freely.
+# A model is reloaded when its .trans or .emit file changes.
+
+class ModelRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}   # basename -> (source signatures, HMM, CompiledHMM)
+
+    def entry(self, basename):
+        with self.lock:
+            entry = self.models.get(basename)
+            if entry is None or not sources_unchanged(entry[0]):
+                hmm = HMM()
+                hmm.load(basename)
+                sources = {filename: file_signature(filename) for filename in (f"{basename}.trans", f"{basename}.emit")}
+                entry = (sources, hmm, hmm.compile())
+                self.models[basename] = entry
+            return entry
+
+    def compiled(self, basename):
+        """returns the shared, read-only CompiledHMM of a model."""
+        return self.entry(basename)[2]
+
+    def hmm(self, basename):
+        """returns a new HMM of a model, independent of every other one; it
+        compiles its own arrays, so they follow any edits made to it."""
+        shared = self.entry(basename)[1]
+        return HMM({state: dict(row) for state, row in shared.transitions.items()},
+                   {state: dict(row) for state, row in shared.emissions.items()})
+
+    def names(self):
+        with self.lock:
+            return list(self.models)
+
+    def evict(self, basename):
+        with self.lock:
+            self.models.pop(basename, None)
+
+    def __contains__(self, basename):
+        return basename in self.models
+
+
+# Decoding - runs forward or viterbi over an iterable of sequences in chunks,
+# optionally sharded across a process pool. Each worker gets the parent's
+# compiled model once, as the pool's initializer argument: forked workers
+# inherit it, and spawned ones unpickle it, so it is never sent per task and
+# workers decode with exactly the model the parent has, trained or not.
+
+
+worker_model = None
+
+def init_worker(model):
+    global worker_model
+    worker_model = model
+
+def decode_chunk(chunk, mode, numeric, stats=False):
+    """decodes a chunk with the worker's model; with stats set, also returns
+    the counters it recorded, for the parent to merge."""
+    model = worker_model.instrumented(Stats()) if stats else worker_model
+    if mode == "forward":
+        results = model.forward_batch(chunk, numeric)
+    else:
+        results = model.viterbi_batch(chunk, numeric)
+    return (results, model.stats.counts) if stats else results
+
+def expected_counts_task(args):
+    model, encoded = args
+    return model.expected_counts(encoded)
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def pool_map(pool, function, chunks, limit, **kwargs):
+    """yields (chunk, function(chunk=chunk, **kwargs)) for each chunk, in
+    order, running them on pool with at most limit chunks in flight, so a
+    long input is never read far ahead of the results."""
+    pending = deque()
+    for chunk in chunks:
+        pending.append((chunk, pool.apply_async(function, (), dict(kwargs, chunk=chunk))))
+        if len(pending) >= limit:
+            chunk, result = pending.popleft()
+            yield chunk, result.get()
+    while pending:
+        chunk, result = pending.popleft()
+        yield chunk, result.get()
+
+def decode_sequences(model, sequences, mode, numeric="linear", workers=1, chunk_size=DECODE_CHUNK):
+    """yields (sequence, result) pairs in input order, where mode is 'forward'
+    or 'viterbi'. With workers > 1, chunks are decoded by a process pool
+    given model; at most two chunks per worker are in flight at once."""
+    if workers <= 1:
+        for chunk in chunked(sequences, chunk_size):
+            if mode == "forward":
+                yield from zip(chunk, model.forward_batch(chunk, numeric))
+            else:
+                yield from zip(chunk, model.viterbi_batch(chunk, numeric))
+        return
+
+    # the workers count into their own Stats, which the parent merges
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(model.instrumented(NULL_STATS),)) as pool:
+        for chunk, results in pool_map(pool, decode_chunk, chunked(sequences, chunk_size), 2 * workers,
+                                       mode=mode, numeric=numeric, stats=model.stats.enabled):
+            if model.stats.enabled:
+                results, counts = results
+                model.stats.counts.update(counts)
+            yield from zip(chunk, results)
+
+def finish_run(args, profiler, stats):
+    """writes the --profile dump and prints the --stats report to stderr."""
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile written to {args.profile} (read it with python -m pstats {args.profile})", file=sys.stderr)
+    if stats.enabled:
+        stats.switch()
+        if args.format == "jsonl":
+            print(json.dumps(stats.as_dict()), file=sys.stderr)
+        else:
+            print(stats.summary(), file=sys.stderr)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Hidden Markov Model Sequence Generator")
     parser.add_argument("domain", help="Domain name (cat, partofspeech, lander)")
     parser.add_argument("--generate", type=int, help="Number of states to generate")
-    parser.add_argument("--forward", help="File with sequence of emissions to run forward algorithm")
+    parser.add_argument("--forward", nargs="?", const="-",
+                        help="File with sequence of emissions to run forward algorithm ('-' for stdin)")
     parser.add_argument("--output_file", help="Output file to save generated emissions", default="generated_sequence.obs")
-    parser.add_argument("--viterbi", help="File with sequence of emissions to run viterbi algorithm")
+    parser.add_argument("--count", type=int, default=1, help="Number of sequences to generate, one per output line")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible generation")
+    parser.add_argument("--viterbi", nargs="?", const="-",
+                        help="File with sequence of emissions to run viterbi algorithm ('-' for stdin)")
+    parser.add_argument("--filter", nargs="?", const="-",
+                        help="File (or '-' for stdin) of readings to track online, one decision per reading")
+    parser.add_argument("--lag", type=int, default=0, help="Readings of fixed-lag smoothing for --filter")
+    parser.add_argument("--fit", help="File of unlabeled emissions to re-estimate the model from with Baum-Welch")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of Baum-Welch iterations for --fit")
+    parser.add_argument("--train", help="Tagged corpus (tags line, then words line) to build the model from")
+    parser.add_argument("--smoothing", type=float, default=0.0, help="Additive smoothing for --train counts")
+    parser.add_argument("--save", help="Basename to write the re-estimated or trained .trans/.emit files to (required by --train)")
+    parser.add_argument("--numeric", choices=NUMERIC_MODES, default="linear",
+                        help="Arithmetic for forward/viterbi: raw probabilities, log space, or per-step scaling")
+    parser.add_argument("--backend", choices=["dense", "sparse"], default="dense",
+                        help="Array layout for forward/viterbi: dense matrices or sparse CSR tables")
+    parser.add_argument("--oov", action="store_true",
+                        help="Estimate emissions of unknown words from their suffix and shape instead of using 0")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to decode forward/viterbi files with")
+    parser.add_argument("--topk", type=int, default=1, help="Number of most likely state sequences to print for viterbi")
+    parser.add_argument("--beam", type=int, help="Keep only the K best states per step in viterbi")
+    parser.add_argument("--beam_ratio", type=float,
+                        help="Keep only states scoring at least this fraction of the best one per step in viterbi")
+    parser.add_argument("--beam_report", action="store_true",
+                        help="Report how often the --beam/--beam_ratio viterbi matches exact viterbi, and the time each took")
+    parser.add_argument("--stdin", action="store_true", help="Read forward/viterbi emissions from standard input")
+    parser.add_argument("--format", choices=["text", "jsonl"], default="text",
+                        help="Print forward/viterbi results as text or as one JSON object per line")
+    parser.add_argument("--chunk_size", type=int, default=DECODE_CHUNK,
+                        help="Number of lines decoded together when streaming forward/viterbi input")
+    parser.add_argument("--cache", type=int, default=0,
+                        help="Remember this many forward/viterbi results, and forward prefixes, for repeated input")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run a tagging server answering JSON-lines forward/viterbi requests on a socket")
+    parser.add_argument("--domains", nargs="+", default=[], help="More models for --serve to load next to domain")
+    parser.add_argument("--host", default="127.0.0.1", help="Address for --serve to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port for --serve to listen on")
+    parser.add_argument("--socket", help="Unix socket path for --serve to listen on instead of a TCP port")
+    parser.add_argument("--batch_window", type=float, default=2.0,
+                        help="Milliseconds --serve waits to gather requests into one batch")
+    parser.add_argument("--max_batch", type=int, default=256, help="Most requests --serve decodes in one batch")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print per-phase timings and counters (sentences, tokens, unknown symbols, underflows) to stderr")
+    parser.add_argument("--profile", help="File to write a cProfile dump of the run to, for python -m pstats")
     args = parser.parse_args()
+    if args.train and not args.save:
+        parser.error("--train needs --save, so the trained model does not overwrite the domain's files")
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    stats = Stats() if args.stats else NULL_STATS
+
+    if args.serve:
+        import asyncio
+        from hmm_server import TaggingServer   # only needed by the server, so imported here
+        server = TaggingServer([args.domain] + args.domains, numeric=args.numeric,
+                               batch_window=args.batch_window / 1000, max_batch=args.max_batch, stats=stats)
+        try:
+            with stats.phase("serve"):
+                asyncio.run(server.serve(args.host, args.port, args.socket))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        finish_run(args, profiler, stats)
+        sys.exit(0)
 
     hmm = HMM()
-    hmm.load(args.domain)
+    if args.train:
+        with stats.phase("train"):
+            sentences, tokens = hmm.train_supervised(args.train, args.smoothing, args.workers)
+            hmm.save(args.save)
+        print(f"Trained on {sentences} sentences ({tokens} tokens), saved to {args.save}.trans and .emit")
+    else:
+        with stats.phase("load"):
+            hmm.load(args.domain)
 
-    if args.generate:
-        sequence = hmm.generate(args.generate)
+    if args.generate and args.count > 1:
+        random.seed(args.seed)
+        with open(args.output_file, "w") as f:
+            for sequence in hmm.generate_batch(args.generate, args.count, args.seed):
+                f.write(' '.join(sequence.outputseq) + " .\n")
+        print(f"Generated {args.count} sequences saved to {args.output_file}")
+    elif args.generate:
+        random.seed(args.seed)
+        sequence = hmm.generate(args.generate, args.seed)
         print("Generated States:\n", ' '.join(sequence.stateseq))
         print("Generated Emissions:\n", ' '.join(sequence.outputseq))
 
@@ -192,28 +2117,108 @@ if __name__ == "__main__":
         run python hmm.py lander --generate 20 --output_file lander_sequence.obs
     '''
 
+    if args.fit:
+        with open(args.fit, "r") as f:
+            sequences = Corpus.read(f)
+        with stats.phase("fit"):
+            history = hmm.fit(sequences, args.iterations, args.workers, args.save)
+        for iteration, log_likelihood in enumerate(history):
+            print(f"ITERATION {iteration}: LOG LIKELIHOOD {log_likelihood:.4f}")
+        if args.save:
+            print(f"Model saved to {args.save}.trans and {args.save}.emit")
+
+    if args.stdin and not (args.forward or args.viterbi or args.filter):
+        parser.error("--stdin needs --forward, --viterbi or --filter")
+    if args.stdin and any(name not in (None, "-") for name in (args.forward, args.viterbi, args.filter)):
+        parser.error("--stdin reads standard input; it cannot be combined with a file for --forward, --viterbi or --filter")
+    if args.cache and args.workers > 1:
+        parser.error("--cache decodes in this process; it cannot be combined with --workers")
+    if args.forward or args.viterbi or args.filter:
+        beam = args.beam is not None or args.beam_ratio is not None
+        with stats.phase("compile"):
+            dense = args.filter or args.topk > 1 or args.oov or beam or args.beam_report or args.cache
+            model = hmm.compile("dense" if dense else args.backend, args.oov)
+        if stats.enabled:
+            model = model.instrumented(stats)
+
     if args.forward:
-        safe_spots = ["4,3", "3,4", "4,4", "2,5", "5,5"]
-        with open(args.forward, "r") as f:
-            for line in f:
-                emissions = line.strip().split()
-                if emissions:
-                    final_state, probability = hmm.forward(emissions)
-                    print(f"SEQUENCE: {emissions}")
-                    print(f"FINAL PREDICTED STATE: {final_state}")
-                    print(f"PROBABILITY: {probability}")
+        with open_observations("-" if args.stdin else args.forward) as f:
+            decoder = DecodeCache(model, args.cache) if args.cache else model
+            results = decoder.iter_forward(stats.timed("parse", f), args.numeric, args.workers, args.chunk_size)
+            for result in stats.timed("decode", results):
+                with stats.phase("output"):
+                    record = result._asdict()
+                    if args.domain == "lander":
+                        record["safe"] = result.state in LANDER_SAFE_SPOTS
+                    if args.format == "jsonl":
+                        print(json.dumps(record))
+                        continue
+                    print(f"SEQUENCE: {result.observations}")
+                    print(f"FINAL PREDICTED STATE: {result.state}")
+                    print(f"PROBABILITY: {result.probability}")
                     if args.domain == "lander":
-                        status = "SAFE" if final_state in safe_spots else "NOT safe"
+                        status = "SAFE" if record["safe"] else "NOT safe"
                         print(f"Lander is: {status}")
 
     if args.viterbi:
-        with open(args.viterbi, "r") as f:
-            for line in f:
-                emissions = line.strip().split()
-                if emissions:
-                    most_likely_sequence = hmm.viterbi(emissions)
-                    print(f"{' '.join(most_likely_sequence)}")
+        with open_observations("-" if args.stdin else args.viterbi) as f:
+            if args.beam_report:
+                report = model.beam_report(iter_sequences(f), args.beam, args.beam_ratio, args.numeric, args.chunk_size)
+                if args.format == "jsonl":
+                    print(json.dumps(report))
+                else:
+                    print(f"BEAM {args.beam} RATIO {args.beam_ratio}: {report['matching_sequences']} of "
+                          f"{report['sequences']} sequences ({report['sequence_agreement']:.2%}) and "
+                          f"{report['matching_tokens']} of {report['tokens']} tokens "
+                          f"({report['token_agreement']:.2%}) match exact viterbi")
+                    print(f"EXACT: {report['exact_seconds']:.3f}s BEAM: {report['beam_seconds']:.3f}s")
+            elif args.topk > 1:
+                for emissions in iter_sequences(f):
+                    paths = model.viterbi_topk(emissions, args.topk)
+                    if args.format == "jsonl":
+                        print(json.dumps({"observations": emissions,
+                                          "paths": [{"states": path, "log_prob": log_prob if log_prob > -np.inf else None}
+                                                    for path, log_prob in paths]}))
+                        continue
+                    for path, log_prob in paths:
+                        print(f"{' '.join(path)}  (log p = {log_prob:.4f})")
                     print(f"{' '.join(emissions)}")
+            else:
+                if beam:
+                    model = model.pruned(args.beam, args.beam_ratio)
+                decoder = DecodeCache(model, args.cache) if args.cache else model
+                results = decoder.iter_viterbi(stats.timed("parse", f), args.numeric, args.workers, args.chunk_size)
+                for result in stats.timed("decode", results):
+                    with stats.phase("output"):
+                        if args.format == "jsonl":
+                            print(json.dumps(result._asdict()))
+                            continue
+                        print(f"{' '.join(result.states)}")
+                        print(f"{' '.join(result.observations)}")
+
+    if args.filter:
+        tracker = model.filter(args.lag)
+        with open_observations("-" if args.stdin else args.filter) as f:
+            for reading in stats.timed("parse", iter_tokens(f)):
+                with stats.phase("decode"):
+                    tracker.update(reading)
+                with stats.phase("output"):
+                    state, probability = tracker.state()
+                    record = {"step": tracker.steps - 1, "reading": reading, "state": state, "probability": probability}
+                    if args.domain == "lander":
+                        record["safe"] = state in LANDER_SAFE_SPOTS
+                    smoothed = tracker.smoothed() if args.lag else None
+                    if smoothed:
+                        record["smoothed"] = dict(zip(["step", "state", "probability"], smoothed))
+                    if args.format == "jsonl":
+                        print(json.dumps(record), flush=True)
+                        continue
+                    line = f"STEP {record['step']}: READING {reading} STATE {state} PROBABILITY {probability:.4f}"
+                    if args.domain == "lander":
+                        line += " Lander is: " + ("SAFE" if record["safe"] else "NOT safe")
+                    if smoothed:
+                        line += f" (STEP {smoothed[0]} SMOOTHED {smoothed[1]} {smoothed[2]:.4f})"
+                    print(line, flush=True)
 
     '''
         run -> python hmm.py cat --viterbi cat_sequence.obs    
@@ -256,3 +2261,7 @@ if __name__ == "__main__":
             PRON VERB DET NOUN .
             i love this book !
     '''
+
+    if stats.enabled and args.cache and (args.forward or args.viterbi):
+        stats.counts.update({f"cache_{name}": count for name, count in decoder.info().items()})
+    finish_run(args, profiler, stats)
@@ -1,62 +1,84 @@
-from pgmpy.models import BayesianNetwork
-from pgmpy.inference import VariableElimination
+import functools
 
-alarm_model = BayesianNetwork(
-    [
-        ("Burglary", "Alarm"),
-        ("Earthquake", "Alarm"),
-        ("Alarm", "JohnCalls"),
-        ("Alarm", "MaryCalls"),
-    ]
-)
 
-# Defining the parameters using CPT
-from pgmpy.factors.discrete import TabularCPD
+# The network and its inference engine are built on first use, not at
+# import, and pgmpy is only imported then. alarm_model and alarm_infer
+# still work as module attributes.
 
-cpd_burglary = TabularCPD(
-    variable="Burglary", variable_card=2, values=[[0.999], [0.001]],
-    state_names={"Burglary":['no','yes']},
-)
-cpd_earthquake = TabularCPD(
-    variable="Earthquake", variable_card=2, values=[[0.998], [0.002]],
-    state_names={"Earthquake":["no","yes"]},
-)
-cpd_alarm = TabularCPD(
-    variable="Alarm",
-    variable_card=2,
-    values=[[0.999, 0.71, 0.06, 0.05], [0.001, 0.29, 0.94, 0.95]],
-    evidence=["Burglary", "Earthquake"],
-    evidence_card=[2, 2],
-    state_names={"Burglary":['no','yes'], "Earthquake":['no','yes'], 'Alarm':['yes','no']},
-)
-cpd_johncalls = TabularCPD(
-    variable="JohnCalls",
-    variable_card=2,
-    values=[[0.95, 0.1], [0.05, 0.9]],
-    evidence=["Alarm"],
-    evidence_card=[2],
-    state_names={"Alarm":['yes','no'], "JohnCalls":['yes', 'no']},
-)
-cpd_marycalls = TabularCPD(
-    variable="MaryCalls",
-    variable_card=2,
-    values=[[0.1, 0.7], [0.9, 0.3]],
-    evidence=["Alarm"],
-    evidence_card=[2],
-state_names={"Alarm":['yes','no'], "MaryCalls":['yes', 'no']},
-)
+@functools.lru_cache(maxsize=None)
+def alarm_network():
+    """returns the alarm BayesianNetwork, built the first time it is asked for."""
+    from pgmpy.models import BayesianNetwork
+    from pgmpy.factors.discrete import TabularCPD
 
-# Associating the parameters with the model structure
-alarm_model.add_cpds(
-    cpd_burglary, cpd_earthquake, cpd_alarm, cpd_johncalls, cpd_marycalls)
+    alarm_model = BayesianNetwork(
+        [
+            ("Burglary", "Alarm"),
+            ("Earthquake", "Alarm"),
+            ("Alarm", "JohnCalls"),
+            ("Alarm", "MaryCalls"),
+        ]
+    )
 
-alarm_infer = VariableElimination(alarm_model)
+    # Defining the parameters using CPT
+    cpd_burglary = TabularCPD(
+        variable="Burglary", variable_card=2, values=[[0.999], [0.001]],
+        state_names={"Burglary":['no','yes']},
+    )
+    cpd_earthquake = TabularCPD(
+        variable="Earthquake", variable_card=2, values=[[0.998], [0.002]],
+        state_names={"Earthquake":["no","yes"]},
+    )
+    cpd_alarm = TabularCPD(
+        variable="Alarm",
+        variable_card=2,
+        values=[[0.999, 0.71, 0.06, 0.05], [0.001, 0.29, 0.94, 0.95]],
+        evidence=["Burglary", "Earthquake"],
+        evidence_card=[2, 2],
+        state_names={"Burglary":['no','yes'], "Earthquake":['no','yes'], 'Alarm':['yes','no']},
+    )
+    cpd_johncalls = TabularCPD(
+        variable="JohnCalls",
+        variable_card=2,
+        values=[[0.95, 0.1], [0.05, 0.9]],
+        evidence=["Alarm"],
+        evidence_card=[2],
+        state_names={"Alarm":['yes','no'], "JohnCalls":['yes', 'no']},
+    )
+    cpd_marycalls = TabularCPD(
+        variable="MaryCalls",
+        variable_card=2,
+        values=[[0.1, 0.7], [0.9, 0.3]],
+        evidence=["Alarm"],
+        evidence_card=[2],
+        state_names={"Alarm":['yes','no'], "MaryCalls":['yes', 'no']},
+    )
+
+    # Associating the parameters with the model structure
+    alarm_model.add_cpds(
+        cpd_burglary, cpd_earthquake, cpd_alarm, cpd_johncalls, cpd_marycalls)
+    return alarm_model
+
+
+@functools.lru_cache(maxsize=None)
+def alarm_inference():
+    """returns the compiled inference engine for alarm_network()."""
+    from bn_inference import CompiledInference
+    return CompiledInference(alarm_network())
+
+def __getattr__(name):
+    if name == "alarm_model":
+        return alarm_network()
+    if name == "alarm_infer":
+        return alarm_inference()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # print(alarm_infer.query(variables=["JohnCalls"],evidence={"Earthquake":"yes"}))
 # q = alarm_infer.query(variables=["JohnCalls", "Earthquake"],evidence={"Burglary":"yes","MaryCalls":"yes"}))
 # print(q)
 
 def main():
+    alarm_infer = alarm_inference()
     query_mary = alarm_infer.query(variables=["MaryCalls"], evidence={"JohnCalls": "yes"})
     query_mary_john = alarm_infer.query(variables=["JohnCalls", "MaryCalls"], evidence={"Alarm": "yes"})
     query_alarm = alarm_infer.query(variables=["Alarm"], evidence={"MaryCalls": "yes"})
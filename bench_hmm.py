@@ -0,0 +1,125 @@
+
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from HMM import HMM
+
+
+# Benchmarks - times HMM.load, generate, forward and viterbi on the cat,
+# lander and partofspeech models over generated sequences of growing length
+# and batch size, for each decoding engine: the dict HMM methods, the dense
+# CompiledHMM and the sparse SparseHMM. Each case is timed as the best of
+# several runs, after a first run under tracemalloc for its peak memory.
+# Results are printed (or written) as JSON, one record per case, along with
+# tokens/sec curves over sequence length for each domain, engine and batch.
+
+DOMAINS = ["cat", "lander", "partofspeech"]
+LENGTHS = [10, 100, 1000]
+BATCHES = [1, 16, 256]
+ENGINES = ["dict", "dense", "sparse"]
+
+# the dict engine is pure Python, so it only runs cases up to this many tokens
+DICT_TOKEN_LIMIT = 20000
+
+def measure(function, repeat):
+    """returns the peak bytes allocated by a first call to function, which
+    also warms it up, and the best wall time of repeat calls after that."""
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best, peak
+
+def record(benchmark, domain, seconds, peak, tokens=None, **case):
+    result = {"benchmark": benchmark, "domain": domain, **case, "seconds": seconds, "peak_bytes": peak}
+    if tokens is not None:
+        result["tokens"] = tokens
+        result["tokens_per_second"] = tokens / seconds if seconds > 0 else None
+    return result
+
+def bench_load(domain, repeat):
+    """times parsing the .trans/.emit files and reading them from the cache."""
+    def parse():
+        HMM().load(domain, cache=False)
+
+    def cached():
+        HMM().load(domain)
+
+    cached()   # makes sure the cache is there
+    return [record("load", domain, *measure(parse, repeat), source="parse"),
+            record("load", domain, *measure(cached, repeat), source="cache")]
+
+def decoder(hmm, engine, mode):
+    """returns a function decoding a list of sequences with an engine."""
+    if engine == "dict":
+        method = hmm.forward if mode == "forward" else hmm.viterbi
+        return lambda sequences: [method(sequence) for sequence in sequences]
+    model = hmm.compile(engine)
+    return model.forward_batch if mode == "forward" else model.viterbi_batch
+
+def bench_domain(domain, lengths, batches, engines, repeat, seed):
+    hmm = HMM()
+    hmm.load(domain)
+    results = bench_load(domain, repeat)
+    for length in lengths:
+        for batch in batches:
+            tokens = length * batch
+            results.append(record("generate", domain, *measure(lambda: hmm.generate_batch(length, batch, seed), repeat),
+                                  tokens, length=length, batch=batch))
+            sequences = [sequence.outputseq for sequence in hmm.generate_batch(length, batch, seed)]
+            for engine in engines:
+                if engine == "dict" and tokens > DICT_TOKEN_LIMIT:
+                    continue
+                for mode in ("forward", "viterbi"):
+                    decode = decoder(hmm, engine, mode)
+                    results.append(record(mode, domain, *measure(lambda: decode(sequences), repeat),
+                                          tokens, engine=engine, length=length, batch=batch))
+    return results
+
+def curves(results):
+    """groups tokens/sec by sequence length for each benchmark, domain,
+    engine and batch size."""
+    grouped = {}
+    for result in results:
+        if "length" not in result:
+            continue
+        key = "/".join(str(part) for part in (result["benchmark"], result["domain"],
+                                              result.get("engine", "sampler"), f"batch={result['batch']}"))
+        grouped.setdefault(key, []).append([result["length"], result["tokens_per_second"]])
+    return grouped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark HMM load, generate, forward and viterbi")
+    parser.add_argument("--domains", nargs="+", default=DOMAINS, help="Models to benchmark")
+    parser.add_argument("--lengths", nargs="+", type=int, default=LENGTHS, help="Sequence lengths")
+    parser.add_argument("--batches", nargs="+", type=int, default=BATCHES, help="Numbers of sequences decoded together")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES, help="Decoding engines")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the best time is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated sequences")
+    parser.add_argument("--output", help="File to write the JSON results to instead of standard output")
+    args = parser.parse_args()
+
+    results = []
+    for domain in args.domains:
+        results += bench_domain(domain, args.lengths, args.batches, args.engines, args.repeat, args.seed)
+        print(f"{domain}: done", file=sys.stderr)
+    report = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+              "repeat": args.repeat, "results": results, "curves": curves(results)}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,77 @@
+
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+
+# Startup benchmark - times importing alarm, carnet and sklearn_decisiontrees
+# in a fresh interpreter, and then the first real use of each (building the
+# network and answering a query, or loading the data and running the grid
+# search), which is what importing them used to cost. Also lists which of
+# the heavy libraries were loaded by the import alone. Each case is timed
+# as the best of several runs, and printed (or written) as JSON.
+
+HEAVY = ["pgmpy", "sklearn", "pandas", "plotly", "scipy", "numpy"]
+
+# the statement each module's first use is timed with
+FIRST_USE = {
+    "alarm": "alarm.alarm_inference().query(['MaryCalls'], {'JohnCalls': 'yes'})",
+    "carnet": "carnet.car_inference().query(['Battery'], {'Moves': 'no'})",
+    # without the sweep cache, so every run fits the grid
+    "sklearn_decisiontrees": "sklearn_decisiontrees.grid_search_results(cache_dir=None)",
+}
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+heavy = [name for name in {heavy!r} if name in sys.modules]
+{use}
+used = time.perf_counter()
+print(json.dumps({{"import": imported - started, "first_use": used - imported, "heavy": heavy}}))
+"""
+
+def run(code):
+    """runs code in a new interpreter and returns its wall time and the
+    JSON it printed, if any."""
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    seconds = time.perf_counter() - started
+    return seconds, json.loads(out) if out.strip() else None
+
+def bench_module(module, repeat, use=True):
+    best = None
+    for _ in range(repeat):
+        seconds, child = run(CHILD.format(module=module, heavy=HEAVY, use=FIRST_USE[module] if use else "pass"))
+        if best is None or seconds < best["process_seconds"]:
+            best = {"module": module, "process_seconds": seconds, "import_seconds": child["import"],
+                    "first_use_seconds": child["first_use"] if use else None,
+                    "heavy_modules_after_import": child["heavy"]}
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark import and first-use time of the BN and sklearn scripts")
+    parser.add_argument("--modules", nargs="+", choices=list(FIRST_USE), default=list(FIRST_USE), help="Modules to time")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the best time is reported")
+    parser.add_argument("--import_only", action="store_true", help="Only time the imports, not the first use")
+    parser.add_argument("--output", help="File to write the JSON results to instead of standard output")
+    args = parser.parse_args()
+
+    interpreter = min(run("pass")[0] for _ in range(args.repeat))
+    results = []
+    for module in args.modules:
+        results.append(bench_module(module, args.repeat, not args.import_only))
+        print(f"{module}: done", file=sys.stderr)
+    report = {"python": platform.python_version(), "machine": platform.machine(), "repeat": args.repeat,
+              "interpreter_seconds": interpreter, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,414 @@
+
+
+from collections import OrderedDict
+import multiprocessing
+from statistics import NormalDist
+import numpy as np
+from pgmpy.factors.discrete import DiscreteFactor
+from pgmpy.inference import BeliefPropagation
+from HMM import SampleTable
+
+
+# CompiledInference - answers query(variables, evidence) on a pgmpy
+# BayesianNetwork like VariableElimination does, but compiles the network
+# once instead of eliminating variables again on every query. A network
+# whose joint distribution has at most MAX_JOINT entries (alarm and car
+# have 32 and 128) is multiplied out into one dense table, so a query is an
+# index into it, a sum and a normalization; a bigger one falls back to a
+# BeliefPropagation over its junction tree. Results are kept in an LRU keyed
+# on the query variables and the evidence, and query_batch answers a list
+# of evidence assignments with one vectorized pass per set of evidence
+# variables.
+
+MAX_JOINT = 1 << 20   # entries in the largest joint table compiled
+QUERY_CACHE = 10000   # results kept by the LRU
+
+def state_names_of(model):
+    """returns variable -> list of states, in the order of its own CPD."""
+    return {variable: list(model.get_cpds(variable).state_names[variable]) for variable in model.nodes()}
+
+def cpd_values(cpd, state_names):
+    """returns the values of a CPD, one axis per variable of cpd.variables,
+    with the states of every axis in the order of state_names."""
+    values = cpd.values
+    for i, variable in enumerate(cpd.variables):
+        states = cpd.state_names[variable]
+        if states != state_names[variable]:
+            values = np.take(values, [states.index(state) for state in state_names[variable]], axis=i)
+    return values
+
+class CompiledInference:
+    def __init__(self, model, max_joint=MAX_JOINT, size=QUERY_CACHE):
+        model.check_model()
+        self.model = model
+        self.size = size
+        self.variables = list(model.nodes())
+        self.axis = {variable: i for i, variable in enumerate(self.variables)}
+        self.state_names = state_names_of(model)
+        self.state_index = {variable: {state: i for i, state in enumerate(states)}
+                            for variable, states in self.state_names.items()}
+        self.cardinality = [len(self.state_names[variable]) for variable in self.variables]
+        if np.prod(self.cardinality, dtype=float) <= max_joint:
+            self.joint = self.multiply()
+            self.engine = None
+        else:
+            self.joint = None
+            self.engine = BeliefPropagation(model)
+            self.engine.calibrate()
+        self.results = OrderedDict()   # (variables, evidence) -> probabilities, least recently used first
+        self.hits = self.misses = 0
+
+    def multiply(self):
+        """returns the joint distribution, one axis per variable, as the
+        product of the CPDs. A CPD can list the states of its parents in
+        another order than the parents' own CPDs, so each of its axes is
+        put in the order of the variable's own CPD first."""
+        operands = []
+        for cpd in self.model.get_cpds():
+            operands += [cpd_values(cpd, self.state_names), [self.axis[variable] for variable in cpd.variables]]
+        joint = np.einsum(*operands, list(range(len(self.variables))))
+        joint.setflags(write=False)
+        return joint
+
+    def info(self):
+        """returns the hit and miss counts, the cache size and the engine."""
+        return {"hits": self.hits, "misses": self.misses, "results": len(self.results),
+                "engine": "joint" if self.joint is not None else "belief_propagation"}
+
+    def check(self, variables, evidence):
+        for variable in list(variables) + list(evidence):
+            if variable not in self.axis:
+                raise ValueError(f"Unknown variable '{variable}'.")
+        if len(set(variables)) != len(variables):
+            raise ValueError("Query variables must be distinct.")
+        if set(variables) & set(evidence):
+            raise ValueError("Can't have the same variables in both `variables` and `evidence`.")
+        for variable, state in evidence.items():
+            if state not in self.state_index[variable]:
+                raise ValueError(f"Unknown state '{state}' for variable '{variable}'.")
+
+    def query(self, variables, evidence=None, virtual_evidence=None, elimination_order="greedy", joint=True,
+              show_progress=True):
+        """returns P(variables | evidence) as a DiscreteFactor over variables,
+        as VariableElimination.query does, or with joint False a dict of the
+        marginal of each variable. elimination_order and show_progress are
+        accepted for the same calls and ignored, since nothing is eliminated."""
+        if virtual_evidence is not None:
+            raise ValueError("CompiledInference does not support virtual evidence; use VariableElimination.")
+        if not joint:
+            return {variable: self.query_batch([variable], [evidence])[0] for variable in variables}
+        return self.query_batch(variables, [evidence])[0]
+
+    def query_batch(self, variables, evidences):
+        """returns query(variables, evidence) for each evidence dict in a list.
+        Repeated queries are answered from the LRU; the rest are grouped by
+        their evidence variables and computed together."""
+        variables = list(variables)
+        results = [None] * len(evidences)
+        missing = {}   # key -> positions, as in DecodeCache.lookup
+        for i, evidence in enumerate(evidences):
+            evidence = evidence or {}
+            self.check(variables, evidence)
+            key = (tuple(variables), tuple(sorted(evidence.items())))
+            values = self.results.get(key)
+            if values is None and key not in missing:
+                self.misses += 1
+                missing[key] = [i]
+                continue
+            self.hits += 1
+            if values is None:
+                missing[key].append(i)
+            else:
+                self.results.move_to_end(key)
+                results[i] = self.factor(variables, values)
+        groups = {}
+        for key in missing:
+            groups.setdefault(tuple(variable for variable, _ in key[1]), []).append(key)
+        for observed, keys in groups.items():
+            for key, values in zip(keys, self.probabilities(variables, observed, [key[1] for key in keys])):
+                self.store(key, values)
+                for i in missing[key]:
+                    results[i] = self.factor(variables, values)
+        return results
+
+    def probabilities(self, variables, observed, assignments):
+        """returns the normalized table over variables for each assignment,
+        a sorted tuple of (variable, state) pairs to the observed variables."""
+        if self.joint is None:
+            tables = []
+            for assignment in assignments:
+                factor = self.engine.query(variables, dict(assignment), joint=True, show_progress=False)
+                tables.append(self.reorder(factor, variables))
+            return tables
+        # move the observed axes first, index them with one array per axis,
+        # then sum out what is neither observed nor queried
+        rest = [variable for variable in self.variables if variable not in observed]
+        joint = self.joint.transpose([self.axis[variable] for variable in observed + tuple(rest)])
+        index = tuple(np.array([self.state_index[variable][assignment[j][1]] for assignment in assignments])
+                      for j, variable in enumerate(observed))
+        tables = joint[index] if observed else joint[None]
+        hidden = tuple(1 + j for j, variable in enumerate(rest) if variable not in variables)
+        tables = tables.sum(axis=hidden)
+        kept = [variable for variable in rest if variable in variables]
+        tables = tables.transpose([0] + [1 + kept.index(variable) for variable in variables])
+        totals = tables.reshape(len(assignments), -1).sum(axis=1)
+        if not np.all(totals > 0):
+            raise ValueError("The evidence has zero probability.")
+        tables = tables / totals.reshape((-1,) + (1,) * len(variables))
+        return list(tables)
+
+    def reorder(self, factor, variables):
+        """returns the values of a factor with its axes and states in the
+        order of variables and of their CPDs."""
+        values = factor.values
+        for i, variable in enumerate(factor.variables):
+            states = factor.state_names[variable]
+            if states != self.state_names[variable]:
+                values = np.take(values, [states.index(state) for state in self.state_names[variable]], axis=i)
+        values = values.transpose([factor.variables.index(variable) for variable in variables])
+        return values / values.sum()
+
+    def store(self, key, values):
+        values.setflags(write=False)
+        self.results[key] = values
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def factor(self, variables, values):
+        # a new factor each time, as the caller may change it in place
+        return DiscreteFactor(variables, values.shape, values.copy(),
+                              state_names={variable: self.state_names[variable] for variable in variables})
+
+
+# SamplingInference - approximate query(variables, evidence) for networks
+# too big for exact inference. The CPDs are compiled into NetworkTables, one
+# (parent configurations, states) array per variable in topological order,
+# so a batch of samples is drawn one variable at a time with numpy, for all
+# samples at once. Two methods:
+#   likelihood_weighting - draws the unobserved variables from their CPDs,
+#       clamps the evidence and weights each sample by its likelihood
+#   gibbs - runs chains over the unobserved variables, each resampled from
+#       its Markov blanket, started from likelihood weighted samples
+# Samples are drawn in rounds of batch per worker (across a process pool
+# when workers > 1) until the confidence interval of every estimated
+# probability is narrower than +-tolerance, or max_samples is reached. The
+# interval comes from the effective sample size of the weights, or, for
+# gibbs, from the spread of the estimates of the independent chains.
+
+SAMPLE_BATCH = 10000   # samples drawn by a worker per round
+MAX_SAMPLES = 1000000
+GIBBS_CHAINS = 100   # chains per worker
+GIBBS_BURN_IN = 50   # sweeps thrown away before a chain is counted
+SAMPLING_METHODS = ["likelihood_weighting", "gibbs"]
+
+class NetworkTables:
+    def __init__(self, model):
+        self.state_names = state_names_of(model)
+        order, placed = [], set()
+        while len(order) < len(self.state_names):
+            for variable in model.nodes():
+                if variable not in placed and all(parent in placed for parent in model.get_parents(variable)):
+                    order.append(variable)
+                    placed.add(variable)
+        self.variables = order
+        self.axis = {variable: i for i, variable in enumerate(order)}
+        self.cardinality = np.array([len(self.state_names[variable]) for variable in order])
+        self.parents, self.strides, self.tables, self.log_tables = [], [], [], []
+        for variable in order:
+            cpd = model.get_cpds(variable)
+            values = cpd_values(cpd, self.state_names)
+            parents = [self.axis[parent] for parent in cpd.variables[1:]]
+            # rows are parent configurations, as np.ravel_multi_index numbers them
+            table = np.moveaxis(values, 0, -1).reshape(-1, values.shape[0])
+            self.parents.append(parents)
+            self.strides.append(np.cumprod([1] + [self.cardinality[p] for p in parents[:0:-1]])[::-1])
+            self.tables.append(SampleTable(table))
+            with np.errstate(divide="ignore"):
+                self.log_tables.append(np.log(table))
+        self.children = [[child for child in range(len(order)) if v in self.parents[child]]
+                         for v in range(len(order))]
+
+    def rows(self, samples, v):
+        """returns the row of variable v's table that each sample selects."""
+        row = np.zeros(len(samples), dtype=np.intp)
+        for parent, stride in zip(self.parents[v], self.strides[v]):
+            row += samples[:, parent] * stride
+        return row
+
+    def weighted(self, n, evidence, rng):
+        """returns n likelihood weighted samples, a (n, V) array of state
+        ids, and their weights. evidence maps axes to state ids."""
+        samples = np.zeros((n, len(self.variables)), dtype=np.intp)
+        weights = np.ones(n)
+        for v in range(len(self.variables)):
+            rows = self.rows(samples, v)
+            if v in evidence:
+                samples[:, v] = evidence[v]
+                weights *= np.exp(self.log_tables[v][rows, evidence[v]])
+            else:
+                samples[:, v] = self.tables[v].draw(rows, rng)
+        return samples, weights
+
+    def sweep(self, samples, evidence, rng):
+        """resamples, in place, every unobserved variable of each chain from
+        its distribution given the rest of its Markov blanket."""
+        for v in range(len(self.variables)):
+            if v in evidence:
+                continue
+            logp = self.log_tables[v][self.rows(samples, v)]
+            for child in self.children[v]:
+                for state in range(self.cardinality[v]):
+                    samples[:, v] = state
+                    logp[:, state] += self.log_tables[child][self.rows(samples, child), samples[:, child]]
+            top = logp.max(axis=1, keepdims=True)
+            p = np.exp(logp - np.where(np.isfinite(top), top, 0))
+            cdf = np.cumsum(p, axis=1)
+            picks = (cdf < rng.random((len(samples), 1)) * cdf[:, -1:]).sum(axis=1)
+            samples[:, v] = np.minimum(picks, self.cardinality[v] - 1)
+
+    def cells(self, samples, query):
+        """returns the cell of the (query variables) table each sample is in."""
+        return np.ravel_multi_index(tuple(samples[:, v] for v in query), self.cardinality[query])
+
+worker_tables = None   # the NetworkTables of a pool worker
+
+def init_sampler(tables):
+    global worker_tables
+    worker_tables = tables
+
+def sample_task(method, query, evidence, n, seed, chains=None, burn_in=0, tables=None):
+    """draws one round of samples and returns the statistics to accumulate:
+    for likelihood_weighting, the weight of every cell and the sums of the
+    weights and squared weights; for gibbs, the (chains, cells) counts of
+    each chain and the chains, to carry on from in the next round."""
+    tables = tables if tables is not None else worker_tables
+    rng = np.random.default_rng(seed)
+    size = int(np.prod(tables.cardinality[query]))
+    if method == "likelihood_weighting":
+        samples, weights = tables.weighted(n, evidence, rng)
+        sums = np.bincount(tables.cells(samples, query), weights, minlength=size)
+        return sums, weights.sum(), np.square(weights).sum()
+    if chains is None:
+        # start the chains from samples resampled by their likelihood weights
+        samples, weights = tables.weighted(max(n, GIBBS_CHAINS), evidence, rng)
+        if weights.sum() == 0:
+            raise ValueError("The evidence has zero probability.")
+        chains = samples[rng.choice(len(samples), GIBBS_CHAINS, p=weights / weights.sum())]
+        for _ in range(burn_in):
+            tables.sweep(chains, evidence, rng)
+    counts = np.zeros((len(chains), size))
+    rows = np.arange(len(chains))
+    for _ in range(max(1, n // len(chains))):
+        tables.sweep(chains, evidence, rng)
+        counts[rows, tables.cells(chains, query)] += 1
+    return counts, chains
+
+class SamplingInference:
+    def __init__(self, model, method="likelihood_weighting", tolerance=0.01, confidence=0.95,
+                 batch=SAMPLE_BATCH, max_samples=MAX_SAMPLES, burn_in=GIBBS_BURN_IN, workers=1, seed=None):
+        if method not in SAMPLING_METHODS:
+            raise ValueError(f"Unknown sampling method '{method}', expected one of {', '.join(SAMPLING_METHODS)}.")
+        model.check_model()
+        self.tables = NetworkTables(model)
+        self.state_names = self.tables.state_names
+        self.method = method
+        self.tolerance = tolerance
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.batch = batch
+        self.max_samples = max_samples
+        self.burn_in = burn_in
+        self.workers = workers
+        self.seeds = np.random.SeedSequence(seed)
+        self.pool = None
+        self.last = {}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def info(self):
+        """returns the samples drawn, the effective sample size and the
+        interval half-width of the last query."""
+        return dict(self.last)
+
+    def query(self, variables, evidence=None):
+        """returns an estimate of P(variables | evidence) as a DiscreteFactor
+        over variables, as VariableElimination.query does."""
+        tables = self.tables
+        variables, evidence = list(variables), evidence or {}
+        for variable in variables + list(evidence):
+            if variable not in tables.axis:
+                raise ValueError(f"Unknown variable '{variable}'.")
+        if set(variables) & set(evidence):
+            raise ValueError("Can't have the same variables in both `variables` and `evidence`.")
+        for variable, state in evidence.items():
+            if state not in self.state_names[variable]:
+                raise ValueError(f"Unknown state '{state}' for variable '{variable}'.")
+        query = [tables.axis[variable] for variable in variables]
+        observed = {tables.axis[variable]: self.state_names[variable].index(state)
+                    for variable, state in evidence.items()}
+
+        if self.workers > 1 and self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, initializer=init_sampler, initargs=(tables,))
+        tasks = max(1, self.workers)
+        chains = [None] * tasks
+        totals = None
+        samples = 0
+        while True:
+            arguments = [(self.method, query, observed, self.batch, seed, chains[k], self.burn_in)
+                         for k, seed in enumerate(self.seeds.spawn(tasks))]
+            if self.pool is not None:
+                rounds = self.pool.starmap(sample_task, arguments)
+            else:
+                rounds = [sample_task(*task, tables=tables) for task in arguments]
+            if self.method == "gibbs":
+                chains = [chain for _, chain in rounds]
+                counts = np.concatenate([counts for counts, _ in rounds])
+                totals = counts if totals is None else totals + counts
+                samples = int(totals.sum())
+                estimate, effective, half_width = self.chain_estimate(totals)
+            else:
+                for sums, weight, square in rounds:
+                    totals = [sums, weight, square] if totals is None else \
+                        [totals[0] + sums, totals[1] + weight, totals[2] + square]
+                samples += self.batch * tasks
+                estimate, effective, half_width = self.weighted_estimate(*totals)
+            if half_width <= self.tolerance or samples >= self.max_samples:
+                break
+        if estimate is None:
+            raise ValueError("The evidence has zero probability.")
+        self.last = {"method": self.method, "samples": samples, "effective_samples": effective,
+                     "half_width": half_width}
+        shape = [len(self.state_names[variable]) for variable in variables]
+        return DiscreteFactor(variables, shape, estimate,
+                              state_names={variable: self.state_names[variable] for variable in variables})
+
+    def weighted_estimate(self, sums, weight, square):
+        """returns the normalized weights of the cells, the effective sample
+        size (sum w)^2 / sum w^2 and the widest interval half-width."""
+        if weight == 0:
+            return None, 0.0, np.inf
+        estimate = sums / weight
+        effective = weight * weight / square
+        return estimate, float(effective), float(self.z * np.sqrt(estimate * (1 - estimate) / effective).max())
+
+    def chain_estimate(self, counts):
+        """returns the pooled estimate of the chains, and the effective sample
+        size and interval half-width of its least certain cell, from the
+        spread of the chains' own estimates."""
+        estimate = counts.sum(axis=0) / counts.sum()
+        per_chain = counts / counts.sum(axis=1, keepdims=True)
+        spread = per_chain.std(axis=0, ddof=1) / np.sqrt(len(counts))
+        widest = int(np.argmax(spread))
+        if spread[widest] == 0:
+            return estimate, float(counts.sum()), 0.0
+        effective = estimate[widest] * (1 - estimate[widest]) / spread[widest] ** 2
+        return estimate, float(effective), float(self.z * spread[widest])
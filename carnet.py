@@ -1,89 +1,110 @@
-from pgmpy.models import BayesianNetwork
-from pgmpy.inference import VariableElimination
-
-car_model = BayesianNetwork(
-    [
-        ("Battery", "Radio"),
-        ("Battery", "Ignition"),
-        ("Ignition","Starts"),
-        ("Gas","Starts"),
-        ("Starts","Moves"),
-        ("KeyPresent", "Starts")
-    ]
-)
-
-# Defining the parameters using CPT
-from pgmpy.factors.discrete import TabularCPD
-
-cpd_battery = TabularCPD(
-    variable="Battery", variable_card=2, values=[[0.70], [0.30]],
-    state_names={"Battery":['Works',"Doesn't work"]},
-)
-
-cpd_gas = TabularCPD(
-    variable="Gas", variable_card=2, values=[[0.40], [0.60]],
-    state_names={"Gas":['Full',"Empty"]},
-)
-
-cpd_radio = TabularCPD(
-    variable=  "Radio", variable_card=2,
-    values=[[0.75, 0.01],[0.25, 0.99]],
-    evidence=["Battery"],
-    evidence_card=[2],
-    state_names={"Radio": ["turns on", "Doesn't turn on"],
-                 "Battery": ['Works',"Doesn't work"]}
-)
-
-cpd_ignition = TabularCPD(
-    variable=  "Ignition", variable_card=2,
-    values=[[0.75, 0.01],[0.25, 0.99]],
-    evidence=["Battery"],
-    evidence_card=[2],
-    state_names={"Ignition": ["Works", "Doesn't work"],
-                 "Battery": ['Works',"Doesn't work"]}
-)
-
-cpd_starts = TabularCPD(
-    variable="Starts",
-    variable_card=2,
-    values=[
-        [0.99, 0.01, 0.01, 0.01, 0.01, 0.01, 0.01, 0.01],
-        [0.01, 0.99, 0.99, 0.99, 0.99, 0.99, 0.99, 0.99]
-    ],
-    evidence=["Ignition", "Gas", "KeyPresent"],
-    evidence_card=[2, 2, 2],
-    state_names={
-        "Starts": ["yes", "no"],
-        "Ignition": ["Works", "Doesn't work"],
-        "Gas": ["Full", "Empty"],
-        "KeyPresent": ["yes", "no"]
-    }
-)
-
-cpd_moves = TabularCPD(
-    variable="Moves", variable_card=2,
-    values=[[0.8, 0.01],[0.2, 0.99]],
-    evidence=["Starts"],
-    evidence_card=[2],
-    state_names={"Moves": ["yes", "no"],
-                 "Starts": ['yes', 'no'] }
-)
-
-cpd_key_present = TabularCPD(
-    variable="KeyPresent", variable_card=2, values=[[0.7], [0.3]],
-    state_names={"KeyPresent": ["yes", "no"]}
-)
-
-
-
-# Associating the parameters with the model structure
-car_model.add_cpds( cpd_starts, cpd_ignition, cpd_gas, cpd_radio, cpd_battery, cpd_moves, cpd_key_present)
-
-car_infer = VariableElimination(car_model)
+import functools
+
+
+# The network and its inference engine are built on first use, not at
+# import, and pgmpy is only imported then. car_model and car_infer still
+# work as module attributes.
+
+@functools.lru_cache(maxsize=None)
+def car_network():
+    """returns the car BayesianNetwork, built the first time it is asked for."""
+    from pgmpy.models import BayesianNetwork
+    from pgmpy.factors.discrete import TabularCPD
+
+    car_model = BayesianNetwork(
+        [
+            ("Battery", "Radio"),
+            ("Battery", "Ignition"),
+            ("Ignition","Starts"),
+            ("Gas","Starts"),
+            ("Starts","Moves"),
+            ("KeyPresent", "Starts")
+        ]
+    )
+
+    # Defining the parameters using CPT
+    cpd_battery = TabularCPD(
+        variable="Battery", variable_card=2, values=[[0.70], [0.30]],
+        state_names={"Battery":['Works',"Doesn't work"]},
+    )
+
+    cpd_gas = TabularCPD(
+        variable="Gas", variable_card=2, values=[[0.40], [0.60]],
+        state_names={"Gas":['Full',"Empty"]},
+    )
+
+    cpd_radio = TabularCPD(
+        variable=  "Radio", variable_card=2,
+        values=[[0.75, 0.01],[0.25, 0.99]],
+        evidence=["Battery"],
+        evidence_card=[2],
+        state_names={"Radio": ["turns on", "Doesn't turn on"],
+                     "Battery": ['Works',"Doesn't work"]}
+    )
+
+    cpd_ignition = TabularCPD(
+        variable=  "Ignition", variable_card=2,
+        values=[[0.75, 0.01],[0.25, 0.99]],
+        evidence=["Battery"],
+        evidence_card=[2],
+        state_names={"Ignition": ["Works", "Doesn't work"],
+                     "Battery": ['Works',"Doesn't work"]}
+    )
+
+    cpd_starts = TabularCPD(
+        variable="Starts",
+        variable_card=2,
+        values=[
+            [0.99, 0.01, 0.01, 0.01, 0.01, 0.01, 0.01, 0.01],
+            [0.01, 0.99, 0.99, 0.99, 0.99, 0.99, 0.99, 0.99]
+        ],
+        evidence=["Ignition", "Gas", "KeyPresent"],
+        evidence_card=[2, 2, 2],
+        state_names={
+            "Starts": ["yes", "no"],
+            "Ignition": ["Works", "Doesn't work"],
+            "Gas": ["Full", "Empty"],
+            "KeyPresent": ["yes", "no"]
+        }
+    )
+
+    cpd_moves = TabularCPD(
+        variable="Moves", variable_card=2,
+        values=[[0.8, 0.01],[0.2, 0.99]],
+        evidence=["Starts"],
+        evidence_card=[2],
+        state_names={"Moves": ["yes", "no"],
+                     "Starts": ['yes', 'no'] }
+    )
+
+    cpd_key_present = TabularCPD(
+        variable="KeyPresent", variable_card=2, values=[[0.7], [0.3]],
+        state_names={"KeyPresent": ["yes", "no"]}
+    )
+
+    # Associating the parameters with the model structure
+    car_model.add_cpds( cpd_starts, cpd_ignition, cpd_gas, cpd_radio, cpd_battery, cpd_moves, cpd_key_present)
+    return car_model
+
+
+@functools.lru_cache(maxsize=None)
+def car_inference():
+    """returns the compiled inference engine for car_network()."""
+    from bn_inference import CompiledInference
+    return CompiledInference(car_network())
+
+def __getattr__(name):
+    if name == "car_model":
+        return car_network()
+    if name == "car_infer":
+        return car_inference()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # print(car_infer.query(variables=["Moves"],evidence={"Radio":"turns on", "Starts":"yes"}))
 
 if __name__ == "__main__":
+    car_infer = car_inference()
+
     q1 = car_infer.query(variables=["Battery"], evidence={"Moves": "no"})
     print(q1)
 
@@ -0,0 +1,177 @@
+
+
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+
+# ForestSweep - cross-validates a RandomForestClassifier over a grid of
+# parameters, as the KFold loop and the GridSearchCV in
+# sklearn_decisiontrees.py do, with three shortcuts:
+#   - every (params, fold) result is saved in cache_dir, keyed by the
+#     parameters, the folds and a hash of the data, so a rerun, or a run
+#     over a bigger grid, only fits the cells it has not seen before
+#   - cells that differ only in n_estimators are fitted as one forest grown
+#     with warm_start, smallest first. A forest grown from 5 to 10 trees
+#     draws the same tree seeds as one fitted with 10, so the scores match
+#   - the fits run as joblib jobs, one per (other params, fold)
+# run returns one record per cell with its fit and score times (fit time is
+# the whole time to grow the forest to its size, as if fitted alone), and table
+# summarizes them with the columns of GridSearchCV.cv_results_.
+# sklearn and joblib are imported when a sweep first runs.
+
+SWEEP_CACHE = "sweep_cache"
+SWEEP_VERSION = 2   # 1 recorded only the time to add each step's trees
+
+def data_hash(X, y):
+    """returns a sha1 of the values, shapes and dtypes of X and y."""
+    digest = hashlib.sha1()
+    for array in (X, y):
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.shape} {array.dtype}".encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+def fit_forest(X, y, train, test, params, sizes):
+    """fits a forest with params on the train rows for each n_estimators in
+    sizes, growing one forest with warm_start, and returns a record per size
+    with its test and train accuracy and the seconds spent scoring and
+    fitting. fit_time is the time to grow the forest to that size from
+    nothing, so it is what fitting it alone would take."""
+    from sklearn.ensemble import RandomForestClassifier
+
+    clf = RandomForestClassifier(**params, warm_start=True)
+    records = []
+    fit_time = 0.0
+    for size in sorted(sizes):
+        clf.set_params(n_estimators=size)
+        started = time.perf_counter()
+        clf.fit(X[train], y[train])
+        fitted = time.perf_counter()
+        fit_time += fitted - started
+        test_score = clf.score(X[test], y[test])
+        scored = time.perf_counter()
+        records.append({"n_estimators": size, "test_score": test_score, "train_score": clf.score(X[train], y[train]),
+                        "fit_time": fit_time, "score_time": scored - fitted})
+    return records
+
+class ForestSweep:
+    def __init__(self, X, y, param_grid, n_splits=5, random_state=0, estimator_params=None,
+                 cache_dir=SWEEP_CACHE, n_jobs=1):
+        """param_grid maps RandomForestClassifier parameters to the values to
+        try, as for GridSearchCV; estimator_params are the fixed ones. The
+        folds are KFold(n_splits, shuffle=True, random_state). With cache_dir
+        None nothing is saved."""
+        self.X, self.y = np.asarray(X), np.asarray(y)
+        self.param_grid = {name: list(values) for name, values in param_grid.items()}
+        self.n_splits = n_splits
+        self.random_state = random_state
+        self.estimator_params = dict(estimator_params or {})
+        self.cache_dir = cache_dir
+        self.n_jobs = n_jobs
+        self.data = data_hash(self.X, self.y)
+        self.hits = self.misses = 0
+
+    def grid(self):
+        """returns the parameter dicts of the grid, in GridSearchCV's order."""
+        names = sorted(self.param_grid)
+        return [dict(self.estimator_params, **dict(zip(names, values)))
+                for values in itertools.product(*(self.param_grid[name] for name in names))]
+
+    def folds(self):
+        from sklearn.model_selection import KFold
+        return list(KFold(n_splits=self.n_splits, shuffle=True, random_state=self.random_state).split(self.X))
+
+    def key(self, params, fold):
+        cell = {"version": SWEEP_VERSION, "params": params, "fold": fold, "n_splits": self.n_splits,
+                "random_state": self.random_state, "data": self.data}
+        return hashlib.sha1(json.dumps(cell, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, key + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, record):
+        """writes a cell's record to the cache; like the model cache, this
+        is best effort."""
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, suffix=".json", delete=False) as f:
+                json.dump(record, f)
+            os.replace(f.name, os.path.join(self.cache_dir, key + ".json"))
+        except OSError:
+            pass
+
+    def run(self):
+        """returns a record per (params, fold) cell, in grid then fold order,
+        fitting only the cells not in the cache."""
+        grid = self.grid()
+        records = {}
+        jobs = {}   # (other params, fold) -> (params, n_estimators values to fit)
+        for i, params in enumerate(grid):
+            for fold in range(self.n_splits):
+                key = self.key(params, fold)
+                record = self.load(key)
+                if record is not None:
+                    self.hits += 1
+                    records[i, fold] = dict(record, cached=True)
+                    continue
+                self.misses += 1
+                others = {name: value for name, value in params.items() if name != "n_estimators"}
+                job = jobs.setdefault((json.dumps(others, sort_keys=True), fold), (others, {}))
+                job[1][params.get("n_estimators", 100)] = i
+
+        if jobs:
+            from joblib import Parallel, delayed
+
+            folds = self.folds()
+            keys = list(jobs)
+            fitted = Parallel(n_jobs=self.n_jobs)(
+                delayed(fit_forest)(self.X, self.y, *folds[fold], jobs[others, fold][0], list(jobs[others, fold][1]))
+                for others, fold in keys)
+            for (others, fold), results in zip(keys, fitted):
+                cells = jobs[others, fold][1]
+                for result in results:
+                    i = cells[result["n_estimators"]]
+                    record = {"params": grid[i], "fold": fold, "test_score": result["test_score"],
+                              "train_score": result["train_score"], "fit_time": result["fit_time"],
+                              "score_time": result["score_time"]}
+                    self.save(self.key(grid[i], fold), record)
+                    records[i, fold] = dict(record, cached=False)
+        return [records[i, fold] for i in range(len(grid)) for fold in range(self.n_splits)]
+
+    def table(self, records=None):
+        """returns a pandas DataFrame with a row per parameter setting and
+        the columns of GridSearchCV.cv_results_ (param_*, mean/std of
+        fit_time, score_time, test_score and train_score, rank_test_score),
+        plus cached_folds."""
+        import pandas as pd
+
+        if records is None:
+            records = self.run()
+        rows = []
+        for i, params in enumerate(self.grid()):
+            cells = records[i * self.n_splits:(i + 1) * self.n_splits]
+            row = {"params": {name: params[name] for name in sorted(self.param_grid)}}
+            for name in sorted(self.param_grid):
+                row["param_" + name] = params[name]
+            for column in ("fit_time", "score_time", "test_score", "train_score"):
+                values = np.array([cell[column] for cell in cells])
+                row["mean_" + column] = values.mean()
+                row["std_" + column] = values.std()
+            row["cached_folds"] = sum(cell["cached"] for cell in cells)
+            rows.append(row)
+        frame = pd.DataFrame(rows)
+        frame["rank_test_score"] = frame["mean_test_score"].rank(method="min", ascending=False).astype(int)
+        return frame
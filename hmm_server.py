@@ -0,0 +1,209 @@
+
+
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+import numpy as np
+from HMM import NULL_STATS, ModelRegistry, check_numeric
+
+
+# TaggingServer - a long-lived asyncio service that keeps models loaded and
+# answers forward/viterbi requests over a TCP or Unix socket, one JSON object
+# per line each way. Requests from every connection go into one bounded
+# queue; a batcher takes whatever arrives within batch_window seconds (up to
+# max_batch requests), groups it by domain and mode, and decodes each group
+# with one batched call on a worker thread, so the event loop keeps reading.
+# When the queue is full, connections stop being read until it drains, which
+# pushes back on clients through the socket. Responses on a connection come
+# back in request order.
+#
+# request:  {"id": 1, "observations": ["i", "shot", "the", "elephant", "."]}
+#           optional "mode" ("viterbi" or "forward"), "domain", and "sentence"
+#           (a string split on whitespace) in place of "observations"
+# response: {"id": 1, "states": [...]} or {"id": 1, "state": ..., "probability": ...},
+#           or {"id": 1, "error": "..."}; {"command": "stats"} returns the counters
+#           and latency percentiles
+
+BATCH_WINDOW = 0.002   # seconds a batch waits for more requests
+MAX_BATCH = 256
+MAX_PENDING = 4096   # requests queued before connections stop being read
+LATENCY_SAMPLES = 10000   # latest request latencies kept for the percentiles
+PERCENTILES = (50, 90, 99)
+
+class TaggingServer:
+    def __init__(self, domains, registry=None, numeric="linear", batch_window=BATCH_WINDOW,
+                 max_batch=MAX_BATCH, max_pending=MAX_PENDING, stats=NULL_STATS):
+        """domains are the model basenames that may be requested; the first
+        is the default. They are all loaded before the server starts.
+        stats, if given, records the decode time and the models' counters."""
+        check_numeric(numeric)
+        self.registry = registry if registry is not None else ModelRegistry()
+        self.domains = list(domains)
+        for domain in self.domains:
+            self.registry.compiled(domain)
+        self.numeric = numeric
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.decode_stats = stats
+        self.queue = None
+        self.batch_task = None
+        self.path = None
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.counts = {"requests": 0, "errors": 0, "batches": 0, "connections": 0}
+
+    def parse(self, request):
+        """returns (domain, mode, observations) for a request, or raises ValueError."""
+        domain = request.get("domain", self.domains[0])
+        if domain not in self.domains:
+            raise ValueError(f"Unknown domain '{domain}', expected one of {', '.join(self.domains)}.")
+        mode = request.get("mode", "viterbi")
+        if mode not in ("viterbi", "forward"):
+            raise ValueError(f"Unknown mode '{mode}', expected viterbi or forward.")
+        observations = request.get("observations")
+        if observations is None:
+            observations = str(request.get("sentence", "")).split()
+        if (not isinstance(observations, list) or not observations
+                or not all(isinstance(symbol, str) for symbol in observations)):
+            raise ValueError("A request needs a non-empty list of observations.")
+        return domain, mode, observations
+
+    def stats(self):
+        """returns the counters and the latency percentiles in milliseconds."""
+        report = dict(self.counts)
+        report["pending"] = self.queue.qsize() if self.queue is not None else 0
+        if self.latencies:
+            values = np.percentile(np.array(self.latencies) * 1000, PERCENTILES)
+            report["latency_ms"] = {f"p{p}": float(v) for p, v in zip(PERCENTILES, values)}
+        return report
+
+    async def handle(self, reader, writer):
+        """reads requests from a connection, queueing each with a future for
+        its response, while a writer task sends the responses in order."""
+        self.counts["connections"] += 1
+        outbox = asyncio.Queue(self.max_pending)
+        sender = asyncio.create_task(self.send(outbox, writer))
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                started = time.perf_counter()
+                response = loop.create_future()
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("A request must be a JSON object.")
+                    request_id = request.get("id")
+                    if request.get("command") == "stats":
+                        response.set_result(self.stats())
+                    else:
+                        await self.queue.put((self.parse(request), response))
+                        self.counts["requests"] += 1
+                except ValueError as e:   # json.JSONDecodeError is a ValueError
+                    self.counts["errors"] += 1
+                    response.set_result({"error": str(e)})
+                await outbox.put((request_id, started, response))
+        finally:
+            await outbox.put(None)
+            await sender
+
+    async def send(self, outbox, writer):
+        try:
+            while True:
+                item = await outbox.get()
+                if item is None:
+                    break
+                request_id, started, response = item
+                result = await response
+                self.latencies.append(time.perf_counter() - started)
+                writer.write((json.dumps({"id": request_id, **result}) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def batcher(self):
+        """takes micro-batches off the queue and decodes them, forever."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.counts["batches"] += 1
+            groups = {}
+            for (domain, mode, observations), response in batch:
+                groups.setdefault((domain, mode), []).append((observations, response))
+            for (domain, mode), requests in groups.items():
+                sequences = [observations for observations, _ in requests]
+                try:
+                    results = await loop.run_in_executor(None, self.decode, domain, mode, sequences)
+                except Exception as e:   # fail the batch, not the server
+                    self.counts["errors"] += len(requests)
+                    results = [{"error": str(e)}] * len(requests)
+                for (_, response), result in zip(requests, results):
+                    if not response.done():
+                        response.set_result(result)
+
+    def decode(self, domain, mode, sequences):
+        model = self.registry.compiled(domain)
+        if self.decode_stats.enabled:
+            model = model.instrumented(self.decode_stats)
+            with self.decode_stats.phase("decode"):
+                return self.decode_with(model, mode, sequences)
+        return self.decode_with(model, mode, sequences)
+
+    def decode_with(self, model, mode, sequences):
+        if mode == "forward":
+            return [{"state": state, "probability": probability}
+                    for state, probability in model.forward_batch(sequences, self.numeric)]
+        return [{"states": states} for states in model.viterbi_batch(sequences, self.numeric)]
+
+    async def start(self, host="127.0.0.1", port=8765, path=None):
+        """starts listening on a Unix socket at path, or else on host:port,
+        and returns the asyncio server. Stop it with stop."""
+        self.queue = asyncio.Queue(self.max_pending)
+        self.path = path
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        self.batch_task = asyncio.create_task(self.batcher())
+        return server
+
+    async def stop(self, server):
+        server.close()
+        await server.wait_closed()
+        self.batch_task.cancel()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        """serves until cancelled (by SIGINT or SIGTERM), then prints the stats to stderr."""
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, asyncio.current_task().cancel)
+        server = await self.start(host, port, path)
+        where = path or "%s:%d" % server.sockets[0].getsockname()[:2]
+        print(f"Serving {', '.join(self.domains)} on {where}", file=sys.stderr)
+        try:
+            await server.serve_forever()
+        finally:
+            await self.stop(server)
+            print(json.dumps(self.stats()), file=sys.stderr)
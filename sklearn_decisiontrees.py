@@ -1,147 +1,214 @@
-from sklearn.datasets import load_breast_cancer
-from sklearn import tree
-from sklearn.model_selection import KFold
-from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
-import pandas as pd
-from sklearn.model_selection import GridSearchCV, KFold
-import joblib
+import functools
 
 
 ### This code shows how to use KFold to do cross_validation.
 ### This is just one of many ways to manage training and test sets in sklearn.
 
-cancer = load_breast_cancer()
-X, y = cancer.data, cancer.target
+# Each part is a function, run by main(), so importing this file does no
+# work: sklearn, pandas and plotly are imported by the functions that use
+# them, and the data, models and grid search results are built on first
+# use and kept. The old module globals (cancer, X, y, N_CORES, models, cv,
+# results) are still there, built when first read.
+
 hyperparams_estimators = [10, 25, 50]
 hyperparams_separators = ["gini", "entropy"]
+forest_params = {"min_samples_leaf": 5, "random_state": 0}
+SWEEP_CACHE = "sweep_cache"   # as forest_sweep.SWEEP_CACHE, which is only imported when a sweep runs
+param_grids = {
+    "Random Forest": {"n_estimators": [5, 10, 15, 20]},
+    "Hist Gradient Boosting": {"max_iter": [25, 50, 75, 100]},
+}
 
-for estimators in hyperparams_estimators:
-    for separator in hyperparams_separators:
-        scores = []
-        kf = KFold(n_splits=5, shuffle=True, random_state=0)
-        for train_index, test_index in kf.split(X):
-            X_train, X_test = X[train_index], X[test_index]
-            y_train, y_test = y[train_index], y[test_index]
-            clf = RandomForestClassifier(
-                n_estimators=estimators,
-                criterion=separator,
-                random_state=0
-            )
-            clf.fit(X_train, y_train)
-            scores.append(clf.score(X_test, y_test))
-        print(f"Estimators = {estimators}, Criterion = {separator}, Scores = {scores}")
+@functools.lru_cache(maxsize=None)
+def load_cancer():
+    """returns the breast cancer dataset as a Bunch of arrays."""
+    from sklearn.datasets import load_breast_cancer
+    return load_breast_cancer()
+
+@functools.lru_cache(maxsize=None)
+def load_cancer_frame():
+    """returns the breast cancer dataset as (X, y) pandas objects."""
+    from sklearn.datasets import load_breast_cancer
+    return load_breast_cancer(return_X_y=True, as_frame=True)
+
+def kfold_scores(n_jobs=None, cache_dir=SWEEP_CACHE):
+    """returns (estimators, criterion, scores) for each random forest setting,
+    with one test score per KFold split. The folds are fitted by a
+    ForestSweep, across n_jobs processes (all physical cores by default),
+    and only the ones not already in cache_dir (None for no cache)."""
+    from forest_sweep import ForestSweep
+
+    cancer = load_cancer()
+    sweep = ForestSweep(cancer.data, cancer.target,
+                        {"n_estimators": hyperparams_estimators, "criterion": hyperparams_separators},
+                        n_splits=5, random_state=0, estimator_params={"random_state": 0},
+                        cache_dir=cache_dir, n_jobs=n_jobs or physical_cores())
+    scores = {}
+    for record in sweep.run():
+        params = record["params"]
+        scores.setdefault((params["n_estimators"], params["criterion"]), []).append(record["test_score"])
+    return [(estimators, separator, scores[estimators, separator])
+            for estimators in hyperparams_estimators for separator in hyperparams_separators]
 
 ## Part 2. This code (from https://scikit-learn.org/1.5/auto_examples/ensemble/plot_forest_hist_grad_boosting_comparison.html)
 ## shows how to use GridSearchCV to do a hyperparameter search to compare two techniques.
-from sklearn.datasets import load_breast_cancer
-
-X,y = load_breast_cancer(return_X_y=True, as_frame=True)
 
-N_CORES = joblib.cpu_count(only_physical_cores=True)
-print(f"Number of physical cores: {N_CORES}")
-
-models = {
-    "Random Forest": RandomForestClassifier(
-        min_samples_leaf=5, random_state=0, n_jobs=N_CORES
-    ),
-    "Hist Gradient Boosting": HistGradientBoostingClassifier(
-        max_leaf_nodes=15, random_state=0, early_stopping=False
-    ),
-}
-param_grids = {
-    "Random Forest": {"n_estimators": [5, 10, 15, 20]},
-    "Hist Gradient Boosting": {"max_iter": [25, 50, 75, 100]},
-}
-cv = KFold(n_splits=5, shuffle=True, random_state=0)
-
-results = []
-for name, model in models.items():
-    grid_search = GridSearchCV(
-        estimator=model,
-        param_grid=param_grids[name],
-        return_train_score=True,
-        cv=cv,
-    ).fit(X, y)
-    result = {"model": name, "cv_results": pd.DataFrame(grid_search.cv_results_)}
-    results.append(result)
-
-for result in results:
-    print(f"\nResults for {result['model']}:")
-    param_column = "param_n_estimators" if result['model'] == "Random Forest" else "param_max_iter"
-    print(result["cv_results"][[param_column, "mean_test_score", "std_test_score"]])
+@functools.lru_cache(maxsize=None)
+def physical_cores():
+    import joblib
+    return joblib.cpu_count(only_physical_cores=True)
+
+def make_models():
+    """returns the two estimators the grid search compares, by name."""
+    from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+    return {
+        "Random Forest": RandomForestClassifier(
+            **forest_params, n_jobs=physical_cores()
+        ),
+        "Hist Gradient Boosting": HistGradientBoostingClassifier(
+            max_leaf_nodes=15, random_state=0, early_stopping=False
+        ),
+    }
+
+def make_cv():
+    from sklearn.model_selection import KFold
+    return KFold(n_splits=5, shuffle=True, random_state=0)
+
+@functools.lru_cache(maxsize=None)
+def grid_search_results(cache_dir=SWEEP_CACHE):
+    """returns [{"model": name, "cv_results": DataFrame}] for each model.
+    The random forest grid is run by a ForestSweep, which grows one forest
+    per fold through the n_estimators values and caches the folds in
+    cache_dir (None for no cache); its table has the cv_results_ columns
+    GridSearchCV gives the other model."""
+    import pandas as pd
+    from sklearn.model_selection import GridSearchCV
+    from forest_sweep import ForestSweep
+
+    X, y = load_cancer_frame()
+    cv = make_cv()
+    results = []
+    for name, model in make_models().items():
+        if name == "Random Forest":
+            sweep = ForestSweep(X, y, param_grids[name], n_splits=cv.n_splits, random_state=cv.random_state,
+                                estimator_params=forest_params, cache_dir=cache_dir, n_jobs=physical_cores())
+            results.append({"model": name, "cv_results": sweep.table()})
+            continue
+        grid_search = GridSearchCV(
+            estimator=model,
+            param_grid=param_grids[name],
+            return_train_score=True,
+            cv=cv,
+        ).fit(X, y)
+        result = {"model": name, "cv_results": pd.DataFrame(grid_search.cv_results_)}
+        results.append(result)
+    return results
 
 #### Part 3: This shows how to generate a scatter plot of your results
 
-import plotly.colors as colors
-import plotly.express as px
-from plotly.subplots import make_subplots
-
-fig = make_subplots(
-    rows=1,
-    cols=2,
-    shared_yaxes=True,
-    subplot_titles=["Train time vs score", "Predict time vs score"],
-)
-model_names = [result["model"] for result in results]
-colors_list = colors.qualitative.Plotly * (
-    len(model_names) // len(colors.qualitative.Plotly) + 1
-)
-
-for idx, result in enumerate(results):
-    cv_results = result["cv_results"].round(3)
-    model_name = result["model"]
-    param_name = list(param_grids[model_name].keys())[0]
-    cv_results[param_name] = cv_results["param_" + param_name]
-    cv_results["model"] = model_name
-
-    scatter_fig = px.scatter(
-        cv_results,
-        x="mean_fit_time",
-        y="mean_test_score",
-        error_x="std_fit_time",
-        error_y="std_test_score",
-        hover_data=param_name,
-        color="model",
+def speed_score_figure(results):
+    """returns the plotly figure of score against fit and predict time."""
+    import plotly.colors as colors
+    import plotly.express as px
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(
+        rows=1,
+        cols=2,
+        shared_yaxes=True,
+        subplot_titles=["Train time vs score", "Predict time vs score"],
     )
-    line_fig = px.line(
-        cv_results,
-        x="mean_fit_time",
-        y="mean_test_score",
+    model_names = [result["model"] for result in results]
+    colors_list = colors.qualitative.Plotly * (
+        len(model_names) // len(colors.qualitative.Plotly) + 1
     )
 
-    scatter_trace = scatter_fig["data"][0]
-    line_trace = line_fig["data"][0]
-    scatter_trace.update(marker=dict(color=colors_list[idx]))
-    line_trace.update(line=dict(color=colors_list[idx]))
-    fig.add_trace(scatter_trace, row=1, col=1)
-    fig.add_trace(line_trace, row=1, col=1)
-
-    scatter_fig = px.scatter(
-        cv_results,
-        x="mean_score_time",
-        y="mean_test_score",
-        error_x="std_score_time",
-        error_y="std_test_score",
-        hover_data=param_name,
-    )
-    line_fig = px.line(
-        cv_results,
-        x="mean_score_time",
-        y="mean_test_score",
+    for idx, result in enumerate(results):
+        cv_results = result["cv_results"].round(3)
+        model_name = result["model"]
+        param_name = list(param_grids[model_name].keys())[0]
+        cv_results[param_name] = cv_results["param_" + param_name]
+        cv_results["model"] = model_name
+
+        scatter_fig = px.scatter(
+            cv_results,
+            x="mean_fit_time",
+            y="mean_test_score",
+            error_x="std_fit_time",
+            error_y="std_test_score",
+            hover_data=param_name,
+            color="model",
+        )
+        line_fig = px.line(
+            cv_results,
+            x="mean_fit_time",
+            y="mean_test_score",
+        )
+
+        scatter_trace = scatter_fig["data"][0]
+        line_trace = line_fig["data"][0]
+        scatter_trace.update(marker=dict(color=colors_list[idx]))
+        line_trace.update(line=dict(color=colors_list[idx]))
+        fig.add_trace(scatter_trace, row=1, col=1)
+        fig.add_trace(line_trace, row=1, col=1)
+
+        scatter_fig = px.scatter(
+            cv_results,
+            x="mean_score_time",
+            y="mean_test_score",
+            error_x="std_score_time",
+            error_y="std_test_score",
+            hover_data=param_name,
+        )
+        line_fig = px.line(
+            cv_results,
+            x="mean_score_time",
+            y="mean_test_score",
+        )
+
+        scatter_trace = scatter_fig["data"][0]
+        line_trace = line_fig["data"][0]
+        scatter_trace.update(marker=dict(color=colors_list[idx]))
+        line_trace.update(line=dict(color=colors_list[idx]))
+        fig.add_trace(scatter_trace, row=1, col=2)
+        fig.add_trace(line_trace, row=1, col=2)
+
+    fig.update_layout(
+        xaxis=dict(title="Train time (s) - lower is better"),
+        yaxis=dict(title="Test R2 score - higher is better"),
+        xaxis2=dict(title="Predict time (s) - lower is better"),
+        legend=dict(x=0.72, y=0.05, traceorder="normal", borderwidth=1),
+        title=dict(x=0.5, text="Speed-score trade-off of tree-based ensembles"),
     )
+    return fig
+
+def __getattr__(name):
+    lazy = {
+        "cancer": load_cancer,
+        "X": lambda: load_cancer_frame()[0],
+        "y": lambda: load_cancer_frame()[1],
+        "N_CORES": physical_cores,
+        "models": make_models,
+        "cv": make_cv,
+        "results": grid_search_results,
+    }
+    if name in lazy:
+        return lazy[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def main():
+    for estimators, separator, scores in kfold_scores():
+        print(f"Estimators = {estimators}, Criterion = {separator}, Scores = {scores}")
+
+    print(f"Number of physical cores: {physical_cores()}")
+    results = grid_search_results()
+    for result in results:
+        print(f"\nResults for {result['model']}:")
+        param_column = "param_n_estimators" if result['model'] == "Random Forest" else "param_max_iter"
+        print(result["cv_results"][[param_column, "mean_test_score", "std_test_score"]])
+
+    speed_score_figure(results).show()
+
 
-    scatter_trace = scatter_fig["data"][0]
-    line_trace = line_fig["data"][0]
-    scatter_trace.update(marker=dict(color=colors_list[idx]))
-    line_trace.update(line=dict(color=colors_list[idx]))
-    fig.add_trace(scatter_trace, row=1, col=2)
-    fig.add_trace(line_trace, row=1, col=2)
-
-fig.update_layout(
-    xaxis=dict(title="Train time (s) - lower is better"),
-    yaxis=dict(title="Test R2 score - higher is better"),
-    xaxis2=dict(title="Predict time (s) - lower is better"),
-    legend=dict(x=0.72, y=0.05, traceorder="normal", borderwidth=1),
-    title=dict(x=0.5, text="Speed-score trade-off of tree-based ensembles"),
-)
-fig.show()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import importlib.util
+import unittest
+import numpy as np
+
+HAVE_PGMPY = importlib.util.find_spec("pgmpy") is not None
+if HAVE_PGMPY:
+    from pgmpy.inference import VariableElimination
+    from alarm import alarm_model
+    from carnet import car_model
+    from bn_inference import CompiledInference, SamplingInference
+
+
+@unittest.skipUnless(HAVE_PGMPY, "pgmpy is not installed")
+class TestCompiledInference(unittest.TestCase):
+    def assert_matches(self, engine, model):
+        exact = VariableElimination(model)
+        for variable in engine.variables:
+            for observed in engine.variables:
+                if observed == variable:
+                    continue
+                for state in engine.state_names[observed]:
+                    expected = exact.query([variable], {observed: state}, show_progress=False)
+                    result = engine.query([variable], {observed: state})
+                    self.assertEqual(result.state_names, expected.state_names)
+                    np.testing.assert_allclose(result.values, expected.values)
+
+    def test_joint_matches_variable_elimination(self):
+        for model in (alarm_model, car_model):
+            engine = CompiledInference(model)
+            self.assertEqual(engine.info()["engine"], "joint")
+            self.assert_matches(engine, model)
+
+    def test_belief_propagation_matches_variable_elimination(self):
+        engine = CompiledInference(car_model, max_joint=1)
+        self.assertEqual(engine.info()["engine"], "belief_propagation")
+        self.assert_matches(engine, car_model)
+
+    def test_joint_query_over_several_variables(self):
+        engine = CompiledInference(car_model)
+        expected = VariableElimination(car_model).query(["Moves", "Battery"], {"Gas": "Empty"}, show_progress=False)
+        result = engine.query(["Moves", "Battery"], {"Gas": "Empty"})
+        self.assertEqual(result.variables, ["Moves", "Battery"])
+        np.testing.assert_allclose(result.values, expected.values)
+
+    def test_variable_elimination_arguments(self):
+        engine = CompiledInference(alarm_model)
+        exact = VariableElimination(alarm_model)
+        result = engine.query(["MaryCalls"], {"JohnCalls": "yes"}, elimination_order="MinFill", show_progress=False)
+        expected = exact.query(["MaryCalls"], {"JohnCalls": "yes"}, show_progress=False)
+        np.testing.assert_allclose(result.values, expected.values)
+        marginals = engine.query(["MaryCalls", "Alarm"], {"JohnCalls": "yes"}, joint=False)
+        expected = exact.query(["MaryCalls", "Alarm"], {"JohnCalls": "yes"}, joint=False, show_progress=False)
+        self.assertEqual(sorted(marginals), sorted(expected))
+        for variable, factor in marginals.items():
+            np.testing.assert_allclose(factor.values, expected[variable].values)
+        with self.assertRaises(ValueError):
+            engine.query(["MaryCalls"], virtual_evidence=[object()])
+
+    def test_batch_and_cache(self):
+        engine = CompiledInference(car_model)
+        evidences = [{"Moves": moves, "Gas": gas} for moves in ("yes", "no") for gas in ("Full", "Empty")]
+        batch = engine.query_batch(["Battery"], evidences + [{"Gas": "Full", "Moves": "no"}, {"Radio": "turns on"}])
+        self.assertEqual(engine.info()["misses"], 5)
+        self.assertEqual(engine.info()["hits"], 1)
+        for evidence, result in zip(evidences, batch):
+            np.testing.assert_allclose(result.values, CompiledInference(car_model).query(["Battery"], evidence).values)
+        np.testing.assert_allclose(batch[-2].values, batch[2].values)
+        batch[0].values[:] = 0   # results are copies
+        self.assertGreater(engine.query(["Battery"], evidences[0]).values.sum(), 0.99)
+        self.assertEqual(engine.info()["hits"], 2)
+
+    def test_errors(self):
+        engine = CompiledInference(alarm_model)
+        with self.assertRaises(ValueError):
+            engine.query(["Alarm"], {"Alarm": "yes"})
+        with self.assertRaises(ValueError):
+            engine.query(["Alarm"], {"Burglary": "maybe"})
+        with self.assertRaises(ValueError):
+            engine.query(["Fire"])
+
+
+@unittest.skipUnless(HAVE_PGMPY, "pgmpy is not installed")
+class TestSamplingInference(unittest.TestCase):
+    def assert_close(self, model, variables, evidence, **kwargs):
+        exact = CompiledInference(model).query(variables, evidence)
+        with SamplingInference(model, seed=0, **kwargs) as sampler:
+            estimate = sampler.query(variables, evidence)
+            info = sampler.info()
+        self.assertEqual(estimate.variables, variables)
+        self.assertEqual(estimate.state_names, exact.state_names)
+        np.testing.assert_allclose(estimate.values, exact.values, atol=0.03)
+        return info
+
+    def test_likelihood_weighting(self):
+        self.assert_close(car_model, ["Battery"], {"Moves": "no"})
+        info = self.assert_close(alarm_model, ["JohnCalls", "MaryCalls"], {"Alarm": "yes"})
+        self.assertLessEqual(info["half_width"], 0.01)
+
+    def test_gibbs(self):
+        self.assert_close(car_model, ["Starts"], {"Radio": "Doesn't turn on"}, method="gibbs", tolerance=0.02)
+        self.assert_close(alarm_model, ["Alarm"], {"MaryCalls": "yes"}, method="gibbs", tolerance=0.02)
+
+    def test_stops_early(self):
+        info = self.assert_close(car_model, ["Battery"], {"Moves": "no"}, tolerance=0.05, batch=1000)
+        self.assertEqual(info["samples"], 1000)
+        info = self.assert_close(car_model, ["Battery"], {"Moves": "no"}, tolerance=0.0, batch=1000, max_samples=5000)
+        self.assertEqual(info["samples"], 5000)
+
+    def test_process_pool(self):
+        info = self.assert_close(car_model, ["Ignition"], {"Moves": "no", "Gas": "Empty"}, workers=2)
+        self.assertLessEqual(info["half_width"], 0.01)
+        info = self.assert_close(car_model, ["Battery"], {"Moves": "no"}, tolerance=0.05, batch=1000, workers=2)
+        self.assertEqual(info["samples"], 2000)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            SamplingInference(alarm_model, method="rejection")
+        with self.assertRaises(ValueError):
+            SamplingInference(alarm_model).query(["Alarm"], {"Alarm": "yes"})
+
+
+if __name__ == "__main__":
+    unittest.main()
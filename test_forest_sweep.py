@@ -0,0 +1,70 @@
+import importlib.util
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+HAVE_SKLEARN = importlib.util.find_spec("sklearn") is not None
+if HAVE_SKLEARN:
+    from sklearn.datasets import load_breast_cancer
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import GridSearchCV, KFold
+    from forest_sweep import ForestSweep, fit_forest
+
+
+@unittest.skipUnless(HAVE_SKLEARN, "sklearn is not installed")
+class TestForestSweep(unittest.TestCase):
+    def setUp(self):
+        self.X, self.y = load_breast_cancer(return_X_y=True)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.fixed = {"min_samples_leaf": 5, "random_state": 0}
+
+    def sweep(self, grid, **kwargs):
+        kwargs.setdefault("cache_dir", self.directory)
+        return ForestSweep(self.X, self.y, grid, estimator_params=self.fixed, **kwargs)
+
+    def test_matches_grid_search(self):
+        grid = {"n_estimators": [5, 10, 15, 20], "criterion": ["gini", "entropy"]}
+        table = self.sweep(grid).table()
+        search = GridSearchCV(RandomForestClassifier(**self.fixed), grid, return_train_score=True,
+                              cv=KFold(n_splits=5, shuffle=True, random_state=0)).fit(self.X, self.y)
+        self.assertEqual(list(table["params"]), search.cv_results_["params"])
+        for column in ("mean_test_score", "std_test_score", "mean_train_score", "rank_test_score"):
+            np.testing.assert_allclose(table[column], search.cv_results_[column])
+        self.assertIn("mean_fit_time", table)
+        self.assertIn("std_score_time", table)
+
+    def test_warm_start_matches_separate_fits(self):
+        train, test = next(KFold(n_splits=5, shuffle=True, random_state=0).split(self.X))
+        grown = fit_forest(self.X, self.y, train, test, self.fixed, [10, 5])
+        self.assertEqual([record["n_estimators"] for record in grown], [5, 10])
+        for record in grown:
+            alone, = fit_forest(self.X, self.y, train, test, self.fixed, [record["n_estimators"]])
+            self.assertEqual(record["test_score"], alone["test_score"])
+        # fit times are of the whole forest, so they grow with its size
+        self.assertGreater(grown[1]["fit_time"], grown[0]["fit_time"])
+
+    def test_cache_only_fits_new_cells(self):
+        first = self.sweep({"n_estimators": [5, 10]})
+        records = first.run()
+        self.assertEqual((first.hits, first.misses), (0, 10))
+        self.assertFalse(any(record["cached"] for record in records))
+        extended = self.sweep({"n_estimators": [5, 10, 15]})
+        table = extended.table()
+        self.assertEqual((extended.hits, extended.misses), (10, 5))
+        self.assertEqual(list(table["cached_folds"]), [5, 5, 0])
+        np.testing.assert_allclose(table["mean_test_score"][:2], first.table(records)["mean_test_score"])
+        other_data = ForestSweep(self.X[:-1], self.y[:-1], {"n_estimators": [5]}, estimator_params=self.fixed,
+                                 cache_dir=self.directory)
+        other_data.run()
+        self.assertEqual(other_data.hits, 0)
+
+    def test_parallel_jobs(self):
+        serial = self.sweep({"n_estimators": [5, 10]}, cache_dir=None).run()
+        parallel = self.sweep({"n_estimators": [5, 10]}, cache_dir=None, n_jobs=2).run()
+        self.assertEqual([record["test_score"] for record in parallel], [record["test_score"] for record in serial])
+
+
+if __name__ == "__main__":
+    unittest.main()
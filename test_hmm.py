@@ -0,0 +1,623 @@
+import io
+import itertools
+import os
+import pickle
+import tempfile
+import unittest
+from HMM import *
+
+
+def read_obs(filename):
+    with open(filename, "r") as f:
+        return [line.split() for line in f if line.split()]
+
+
+class TestCompiledHMM(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("partofspeech")
+        self.compiled = self.hmm.compile()
+        self.sentences = read_obs("ambiguous_sents.obs")
+
+    def test_compile_arrays(self):
+        cat = HMM()
+        cat.load("cat")
+        compiled = cat.compile()
+        self.assertEqual(list(compiled.states), ['happy', 'grumpy', 'hungry'])
+        self.assertEqual(compiled.start.tolist(), [0.5, 0.5, 0.0])
+        self.assertEqual(compiled.transitions[compiled.states.index['happy']].tolist(), [0.5, 0.1, 0.4])
+        self.assertEqual(compiled.emissions.shape, (3, 4))
+        self.assertEqual(compiled.emissions[:, compiled.unknown].tolist(), [0, 0, 0])
+
+    def test_forward_matches_dict(self):
+        for sentence in self.sentences:
+            state, prob = self.hmm.forward(sentence)
+            compiled_state, compiled_prob = self.compiled.forward(sentence)
+            self.assertEqual(compiled_state, state)
+            self.assertAlmostEqual(compiled_prob, prob)
+
+    def test_viterbi_matches_dict(self):
+        for sentence in self.sentences:
+            self.assertEqual(self.compiled.viterbi(sentence), self.hmm.viterbi(sentence))
+
+    def test_unknown_symbols(self):
+        lander = HMM()
+        lander.load("lander")
+        sequence = ['5,5', '5,5', '.']
+        self.assertEqual(lander.compile().forward(sequence), lander.forward(sequence))
+        self.assertEqual(lander.compile().viterbi(sequence), lander.viterbi(sequence))
+
+    def test_numeric_modes_agree(self):
+        for sentence in self.sentences:
+            state, prob = self.compiled.forward(sentence)
+            path = self.compiled.viterbi(sentence)
+            for numeric in ("log", "scaled"):
+                numeric_state, numeric_prob = self.compiled.forward(sentence, numeric=numeric)
+                self.assertEqual(numeric_state, state)
+                self.assertAlmostEqual(numeric_prob, prob)
+                self.assertEqual(self.compiled.viterbi(sentence, numeric=numeric), path)
+
+    def test_long_sequence_no_underflow(self):
+        document = [word for sentence in self.sentences for word in sentence] * 10
+        self.assertEqual(self.compiled.forward(document), ('ADV', 0))
+        expected = [tag for sentence in self.sentences for tag in self.compiled.viterbi(sentence)] * 10
+        for numeric in ("log", "scaled"):
+            self.assertEqual(self.compiled.forward(document, numeric=numeric)[0], '.')
+            self.assertEqual(self.compiled.viterbi(document, numeric=numeric), expected)
+
+    def test_viterbi_topk(self):
+        for sentence in self.sentences:
+            paths = self.compiled.viterbi_topk(sentence, 4)
+            self.assertTrue(1 <= len(paths) <= 4)
+            self.assertEqual(paths[0][0], self.hmm.viterbi(sentence))
+            log_probs = [log_prob for path, log_prob in paths]
+            self.assertEqual(log_probs, sorted(log_probs, reverse=True))
+            self.assertEqual(len({tuple(path) for path, log_prob in paths}), len(paths))
+
+    def test_viterbi_topk_ties(self):
+        lander = HMM()
+        lander.load("lander")
+        compiled = lander.compile()
+        sequence = ['1,1', '1,2', '2,3', '4,5', '5,4', '5,4', '4,5']
+        # two paths, ending in 4,5 and 5,5, are equally likely
+        paths = compiled.viterbi_topk(sequence, 2)
+        viterbi_path = compiled.viterbi(sequence)
+        self.assertIn(viterbi_path, [path for path, log_prob in paths])
+        self.assertAlmostEqual(paths[0][1], paths[1][1])
+        self.assertEqual({path[-1] for path, log_prob in paths}, {'4,5', '5,5'})
+
+    def test_viterbi_topk_exhausts_paths(self):
+        cat = HMM()
+        cat.load("cat")
+        # hungry has no start probability, so only happy and grumpy are possible
+        paths = cat.compile().viterbi_topk(["meow"], 5)
+        self.assertEqual([path for path, log_prob in paths], [['grumpy'], ['happy']])
+
+    def test_viterbi_topk_without_possible_path(self):
+        cat = HMM()
+        cat.load("cat")
+        compiled = cat.compile()
+        sequence = ["purr", "meow", "."]
+        self.assertEqual(compiled.viterbi_topk(sequence, 3), [(compiled.viterbi(sequence), -np.inf)])
+
+    def test_batch_matches_single(self):
+        sequences = self.sentences + [sentence[:2] for sentence in self.sentences] + [["the"]]
+        for numeric in ("linear", "log", "scaled"):
+            paths = self.hmm.viterbi_batch(sequences, numeric=numeric)
+            results = self.hmm.forward_batch(sequences, numeric=numeric)
+            self.assertEqual(len(paths), len(sequences))
+            for sequence, path, (state, prob) in zip(sequences, paths, results):
+                self.assertEqual(path, self.hmm.viterbi(sequence))
+                expected_state, expected_prob = self.hmm.forward(sequence)
+                self.assertEqual(state, expected_state)
+                self.assertAlmostEqual(prob, expected_prob)
+
+    def test_batch_rejects_empty_sequence(self):
+        with self.assertRaises(ValueError):
+            self.compiled.viterbi_batch([["the"], []])
+
+    def test_decode_sequences_in_order(self):
+        sequences = self.sentences * 3
+        expected = self.compiled.viterbi_batch(sequences)
+        for workers in (1, 2):
+            decoded = list(decode_sequences(self.compiled, iter(sequences), "viterbi", workers=workers, chunk_size=4))
+            self.assertEqual([sequence for sequence, path in decoded], sequences)
+            self.assertEqual([path for sequence, path in decoded], expected)
+
+    def test_iter_viterbi(self):
+        with open("ambiguous_sents.obs") as f:
+            results = list(self.hmm.iter_viterbi(f))
+        self.assertEqual([result.observations for result in results], self.sentences)
+        self.assertEqual([result.states for result in results], self.compiled.viterbi_batch(self.sentences))
+
+    def test_iter_forward(self):
+        results = list(self.compiled.iter_forward(io.StringIO("i shot the elephant .\n\nthey book the ticket .\n")))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]._asdict(), {"observations": ["they", "book", "the", "ticket", "."],
+                                                 "state": ".", "probability": 1.0})
+
+    def test_iter_viterbi_is_lazy(self):
+        lines = iter(["the plane .\n"] * 1000)
+        results = self.compiled.iter_viterbi(lines, chunk_size=10)
+        self.assertEqual(next(results).states, ['DET', 'NOUN', '.'])
+        self.assertEqual(len(list(lines)), 990)
+
+    def test_sparse_matches_dense(self):
+        sparse = self.hmm.compile("sparse")
+        sequences = self.sentences + [["the", "zzyzx", "plane"]]
+        for numeric in ("linear", "log", "scaled"):
+            self.assertEqual(sparse.viterbi_batch(sequences, numeric), self.compiled.viterbi_batch(sequences, numeric))
+            for (state, prob), (dense_state, dense_prob) in zip(sparse.forward_batch(sequences, numeric),
+                                                                 self.compiled.forward_batch(sequences, numeric)):
+                self.assertEqual(state, dense_state)
+                self.assertAlmostEqual(prob, dense_prob)
+
+    def test_sparse_storage(self):
+        lander = HMM()
+        lander.load("lander")
+        sparse = lander.compile("sparse")
+        dense = lander.compile()
+        self.assertEqual(len(sparse.trans_probs), np.count_nonzero(dense.transitions))
+        self.assertEqual(len(sparse.emit_probs), np.count_nonzero(dense.emissions))
+        sequence = ['1,1', '2,2', '3,3', '3,4', '.']
+        np.testing.assert_array_equal(sparse.likelihoods(sequence), dense.likelihoods(sequence))
+        self.assertEqual(sparse.viterbi(sequence), lander.viterbi(sequence))
+        # the sparse model only decodes; it has none of the dense arrays
+        for name in ("transitions", "posteriors", "expected_counts", "filter"):
+            self.assertFalse(hasattr(sparse, name))
+
+    def test_unknown_numeric_mode(self):
+        with self.assertRaises(ValueError):
+            self.compiled.forward(["the"], numeric="fast")
+
+
+class TestSampler(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("cat")
+        self.compiled = self.hmm.compile()
+
+    def test_sample_shapes_and_support(self):
+        states, outputs = self.compiled.sampler().sample(30, 500, np.random.default_rng(0))
+        self.assertEqual(states.shape, (500, 30))
+        self.assertEqual(outputs.shape, (500, 30))
+        # hungry has zero start probability and no state emits the unknown column
+        self.assertNotIn(self.compiled.states.index['hungry'], states[:, 0])
+        self.assertTrue((outputs < self.compiled.unknown).all())
+
+    def test_sample_frequencies(self):
+        states, outputs = self.compiled.sampler().sample(200, 500, np.random.default_rng(1))
+        happy = self.compiled.states.index['happy']
+        counts = np.bincount(outputs[states == happy], minlength=self.compiled.unknown + 1)
+        np.testing.assert_allclose(counts / counts.sum(), self.compiled.emissions[happy], atol=0.01)
+        follows = np.bincount(states[:, 1:][states[:, :-1] == happy], minlength=3)
+        np.testing.assert_allclose(follows / follows.sum(), self.compiled.transitions[happy], atol=0.01)
+
+    def test_generate_is_reproducible(self):
+        first = self.hmm.generate_batch(10, 4, seed=7)
+        second = self.hmm.generate_batch(10, 4, seed=7)
+        self.assertEqual([str(sequence) for sequence in first], [str(sequence) for sequence in second])
+        self.assertEqual([len(sequence) for sequence in first], [10] * 4)
+        self.assertEqual(len(self.hmm.generate(20)), 20)
+
+
+class TestCorpus(unittest.TestCase):
+    def test_sequence_compat(self):
+        sequence = Sequence(['happy', 'grumpy', 'happy'], ['purr', 'meow', 'purr'])
+        self.assertEqual(sequence.stateseq, ['happy', 'grumpy', 'happy'])
+        self.assertEqual(sequence.outputseq, ['purr', 'meow', 'purr'])
+        self.assertEqual(str(sequence), "happy grumpy happy\npurr meow purr\n")
+        self.assertEqual(len(sequence), 3)
+        with self.assertRaises(AttributeError):
+            sequence.extra = 1
+
+    def test_sequences_share_vocabularies(self):
+        states, symbols = Vocabulary(), Vocabulary()
+        first = Sequence(['happy', 'grumpy'], ['purr', 'meow'], states, symbols)
+        second = Sequence(['grumpy'], ['meow'], states, symbols)
+        self.assertIs(first.states, second.states)
+        self.assertIs(first.symbols, second.symbols)
+        self.assertEqual(second.state_ids[0], first.state_ids[1])
+        # without them, nothing is kept beyond the sequence itself
+        alone = Sequence(['hungry'], ['hiss'])
+        self.assertEqual(list(alone.states), ['hungry'])
+        self.assertNotIn('hiss', symbols)
+        hmm = HMM()
+        hmm.load("cat")
+        model = hmm.compile()
+        own = Sequence(['happy'], ['purr'], model.states, model.symbols)
+        self.assertIs(own.symbols, model.symbols)
+        self.assertEqual(own.output_ids[0], model.symbols.index['purr'])
+
+    def test_read_and_index(self):
+        with open("ambiguous_sents.obs") as f:
+            corpus = Corpus.read(f)
+        sentences = read_obs("ambiguous_sents.obs")
+        self.assertEqual(len(corpus), len(sentences))
+        self.assertEqual(list(corpus.observations()), sentences)
+        self.assertEqual(corpus[-1].outputseq, sentences[-1])
+        self.assertEqual(corpus[0].stateseq, [])
+        self.assertEqual(corpus.nbytes(), 4 * sum(map(len, sentences)) + 8 * (len(sentences) + 1))
+        with self.assertRaises(IndexError):
+            corpus[len(sentences)]
+
+    def test_labeled(self):
+        corpus = Corpus(states=Vocabulary())
+        corpus.append(['i', 'shot'], ['PRON', 'VERB'])
+        self.assertEqual(str(corpus[0]), "PRON VERB\ni shot\n")
+        with self.assertRaises(ValueError):
+            corpus.append(['i'])
+        with self.assertRaises(ValueError):
+            corpus.append(['i', 'shot'], ['PRON'])
+
+    def test_generated_corpus_shares_vocabularies(self):
+        hmm = HMM()
+        hmm.load("cat")
+        corpus = hmm.generate_batch(5, 3, seed=1)
+        self.assertIsInstance(corpus, Corpus)
+        self.assertIs(corpus[0].symbols, corpus[2].symbols)
+        self.assertEqual([len(sequence) for sequence in corpus], [5] * 3)
+
+    def test_encode_and_fit(self):
+        hmm = HMM()
+        hmm.load("cat")
+        model = hmm.compile()
+        corpus = Corpus()
+        for sequence in (['purr', 'meow'], ['hiss', 'purr', 'silent']):
+            corpus.append(sequence)
+        encoded = corpus.encode(model)
+        np.testing.assert_array_equal(encoded[1], model.encode(['hiss', 'purr', 'silent']))
+        lists = HMM()
+        lists.load("cat")
+        self.assertEqual(hmm.fit(corpus, iterations=2), lists.fit(list(corpus.observations()), iterations=2))
+
+
+class TestBaumWelch(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("cat", cache=False)
+        self.sequences = read_obs("cat_sequence.obs")
+
+    def test_posteriors_match_enumeration(self):
+        compiled = self.hmm.compile()
+        sequence = ['purr', 'meow', 'silent', 'meow']
+        lik = compiled.likelihoods(sequence)
+        expected = np.zeros(lik.shape)
+        for path in itertools.product(range(len(compiled.states)), repeat=len(sequence)):
+            prob = compiled.start[path[0]] * lik[0, path[0]]
+            for t in range(1, len(sequence)):
+                prob *= compiled.transitions[path[t - 1], path[t]] * lik[t, path[t]]
+            expected[np.arange(len(sequence)), path] += prob
+        expected /= expected.sum(axis=1, keepdims=True)
+        np.testing.assert_allclose(compiled.posteriors(sequence), expected)
+
+    def test_fit_increases_likelihood(self):
+        history = self.hmm.fit(self.sequences, iterations=5)
+        self.assertEqual(len(history), 5)
+        self.assertEqual(history, sorted(history))
+        self.assertEqual(self.hmm.transitions['#']['hungry'], 0.0)
+        for row in list(self.hmm.transitions.values()) + list(self.hmm.emissions.values()):
+            self.assertAlmostEqual(sum(row.values()), 1.0)
+
+    def test_fit_in_parallel(self):
+        serial = HMM()
+        serial.load("cat", cache=False)
+        expected = serial.fit(self.sequences, iterations=3)
+        history = self.hmm.fit(self.sequences, iterations=3, workers=2)
+        np.testing.assert_allclose(history, expected)
+        for state, row in serial.emissions.items():
+            for symbol, prob in row.items():
+                self.assertAlmostEqual(self.hmm.emissions[state][symbol], prob)
+
+    def test_fit_saves_model(self):
+        with tempfile.TemporaryDirectory() as directory:
+            basename = os.path.join(directory, "cat")
+            self.hmm.fit(self.sequences, iterations=2, basename=basename)
+            saved = HMM()
+            saved.load(basename, cache=False)
+        self.assertEqual(saved.transitions, self.hmm.transitions)
+        self.assertEqual(saved.emissions, self.hmm.emissions)
+
+
+class TestSupervisedTraining(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.sentences, self.tokens = self.hmm.train_supervised("ambiguous_sents.tagged.obs")
+
+    def test_counts(self):
+        tagged = read_obs("ambiguous_sents.tagged.obs")
+        self.assertEqual(self.sentences, len(tagged) // 2)
+        self.assertEqual(self.tokens, sum(len(tags) for tags in tagged[::2]))
+        starts = [tags[0] for tags in tagged[::2]]
+        self.assertAlmostEqual(self.hmm.transitions['#']['PRON'], starts.count('PRON') / len(starts))
+        self.assertNotIn('#', self.hmm.transitions['PRON'])
+        self.assertNotIn('elephant', self.hmm.emissions['VERB'])
+
+    def test_rows_sum_to_one(self):
+        smoothed = HMM()
+        smoothed.train_supervised("ambiguous_sents.tagged.obs", smoothing=0.5)
+        # '.' ends every sentence, so unsmoothed it has an empty transition row
+        self.assertEqual(self.hmm.transitions['.'], {})
+        for model in (self.hmm, smoothed):
+            for state, row in itertools.chain(model.transitions.items(), model.emissions.items()):
+                if model is not self.hmm or state != '.' or row:
+                    self.assertAlmostEqual(sum(row.values()), 1.0)
+        self.assertGreater(smoothed.emissions['VERB']['elephant'], 0)
+
+    def test_parallel_matches_serial(self):
+        parallel = HMM()
+        parallel.train_supervised("ambiguous_sents.tagged.obs", workers=2, chunk_size=3)
+        self.assertEqual(parallel.transitions, self.hmm.transitions)
+        self.assertEqual(parallel.emissions, self.hmm.emissions)
+
+    def test_saved_model_decodes_with_dicts(self):
+        sentence = "i shot the elephant .".split()
+        with tempfile.TemporaryDirectory() as directory:
+            basename = os.path.join(directory, "pos")
+            self.hmm.save(basename)
+            for cache in (False, True):
+                hmm = HMM()
+                hmm.load(basename, cache=cache)
+                self.assertEqual(hmm.transitions['.'], {})
+                self.assertEqual(hmm.viterbi(sentence), ['PRON', 'VERB', 'DET', 'NOUN', '.'])
+                self.assertEqual(hmm.forward(sentence), hmm.compile().forward(sentence))
+                self.assertEqual(hmm.forward(sentence)[0], '.')
+
+    def test_mismatched_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bad.tagged.obs")
+            with open(path, "w") as f:
+                f.write("PRON VERB\ni shot the elephant\n")
+            with self.assertRaises(ValueError):
+                HMM().train_supervised(path)
+
+
+class TestUnknownWords(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("partofspeech")
+        self.model = self.hmm.compile(oov=True)
+
+    def test_off_by_default(self):
+        self.assertIsNone(self.hmm.compile().oov)
+        self.assertEqual(self.hmm.compile().forward(['zqelephant']), (self.hmm.compile().states[0], 0))
+
+    def test_workers_decode_the_trained_model(self):
+        model = self.hmm.compile()
+        sentences = read_obs("ambiguous_sents.obs")
+        decoded = decode_sequences(model, sentences, "viterbi", workers=2, chunk_size=3)
+        self.assertEqual([states for _, states in decoded], model.viterbi_batch(sentences))
+
+    def test_unseen_words_are_tagged(self):
+        self.assertEqual(self.model.viterbi("i shot the zqelephant .".split()), ['PRON', 'VERB', 'DET', 'NOUN', '.'])
+        self.assertEqual(self.model.viterbi("the blorfing man ran .".split()), ['DET', 'ADJ', 'NOUN', 'VERB', '.'])
+        self.assertEqual(self.model.viterbi("she saw 1,234 cats .".split())[2], 'NUM')
+        # known words decode exactly as without the model
+        for sentence in read_obs("ambiguous_sents.obs"):
+            self.assertEqual(self.model.viterbi(sentence), self.hmm.viterbi(sentence))
+
+    def test_estimates_are_cached(self):
+        np.testing.assert_array_equal(self.model.oov.resolve('Elephant'),
+                                      self.model.emissions_by_symbol[self.model.symbols.get('elephant')])
+        self.model.oov.resolve('zqelephant')
+        self.model.oov.resolve('zqelephant')
+        self.assertEqual(self.model.oov.resolve.cache_info().hits, 1)
+
+    def test_batch_and_workers(self):
+        sentences = ["i shot the zqelephant .".split(), "the blorfing man ran .".split()] * 3
+        expected = [self.model.viterbi(sentence) for sentence in sentences]
+        self.assertEqual(self.model.viterbi_batch(sentences), expected)
+        decoded = decode_sequences(self.model, sentences, "viterbi", workers=2, chunk_size=2)
+        self.assertEqual([states for _, states in decoded], expected)
+        # spawned workers get the model pickled, with a fresh LRU of estimates
+        copied = pickle.loads(pickle.dumps(self.model))
+        self.assertEqual(copied.viterbi_batch(sentences), expected)
+
+    def test_sparse_backend_rejected(self):
+        with self.assertRaises(ValueError):
+            self.hmm.compile("sparse", oov=True)
+
+    def test_word_shape(self):
+        self.assertEqual([word_shape(word) for word in ["cat", "Cat", "CAT", "1,234", "b52", "--", "well-known"]],
+                         ["lower", "capitalized", "upper", "number", "digits", "punct", "hyphen"])
+
+
+class TestBeamViterbi(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("lander")
+        self.model = self.hmm.compile()
+        self.sequences = [sequence.outputseq for sequence in self.hmm.generate_batch(12, 50, seed=3)]
+
+    def test_full_beam_is_exact(self):
+        for numeric in NUMERIC_MODES:
+            expected = self.model.viterbi_batch(self.sequences, numeric)
+            self.assertEqual(self.model.pruned(len(self.model.states)).viterbi_batch(self.sequences, numeric), expected)
+            self.assertEqual(self.model.pruned(ratio=0.0).viterbi_batch(self.sequences, numeric), expected)
+
+    def test_narrow_beam_keeps_best_states(self):
+        greedy = self.model.pruned(1)
+        for sequence, path in zip(self.sequences, greedy.viterbi_batch(self.sequences)):
+            # with one state kept, each step extends the best state of the step before
+            lik = self.model.likelihoods(sequence)
+            delta = self.model.start * lik[0]
+            for t in range(1, len(sequence)):
+                best = self.model.tie_order[np.argmax(delta[self.model.tie_order])]
+                self.assertEqual(path[t - 1], self.model.states[best])
+                delta = delta[best] * self.model.transitions[best] * lik[t]
+
+    def test_beam_report(self):
+        report = self.model.beam_report(self.sequences, beam=2)
+        self.assertEqual(report["sequences"], len(self.sequences))
+        self.assertEqual(report["tokens"], 12 * len(self.sequences))
+        self.assertLessEqual(report["matching_sequences"], report["sequences"])
+        self.assertEqual(self.model.beam_report(self.sequences, beam=25)["sequence_agreement"], 1.0)
+
+    def test_invalid_beam(self):
+        with self.assertRaises(ValueError):
+            self.model.pruned(0)
+        with self.assertRaises(ValueError):
+            self.model.pruned(ratio=2.0)
+        self.assertFalse(hasattr(self.hmm.compile("sparse"), "pruned"))
+
+
+class TestDecodeCache(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("lander")
+        self.model = self.hmm.compile()
+        sequences = [sequence.outputseq for sequence in self.hmm.generate_batch(6, 20, seed=5)]
+        self.sequences = sequences + [sequence[:3] for sequence in sequences] + sequences[:5]
+
+    def test_matches_model(self):
+        for numeric in NUMERIC_MODES:
+            cache = DecodeCache(self.model, size=8, prefix_nodes=30)
+            for expected, (state, prob) in zip(self.model.forward_batch(self.sequences, numeric),
+                                               cache.forward_batch(self.sequences, numeric)):
+                self.assertEqual(state, expected[0])
+                self.assertAlmostEqual(prob, expected[1])
+            self.assertEqual(cache.viterbi_batch(self.sequences, numeric), self.model.viterbi_batch(self.sequences, numeric))
+
+    def test_hits_and_prefixes(self):
+        cache = DecodeCache(self.model)
+        cache.forward(['1,1', '2,2'])
+        cache.forward(['1,1', '2,2', '3,3'])
+        cache.forward(['1,1', '2,2'])
+        self.assertEqual(cache.info(), {"hits": 1, "misses": 2, "prefix_hits": 1, "steps_reused": 2,
+                                        "results": 2, "prefix_nodes": 3})
+        cache.viterbi_batch([['1,1'], ['1,1']])
+        self.assertEqual((cache.info()["hits"], cache.info()["misses"]), (2, 3))
+
+    def test_bounded(self):
+        cache = DecodeCache(self.model, size=2, prefix_nodes=4)
+        cache.forward_batch(self.sequences)
+        self.assertEqual(len(cache.results), 2)
+        self.assertLessEqual(cache.nodes, 4)
+        cache.viterbi(['1,1'])[0] = 'changed'
+        self.assertEqual(cache.viterbi(['1,1']), self.model.viterbi(['1,1']))
+
+    def test_streaming(self):
+        cache = DecodeCache(self.model)
+        lines = io.StringIO("1,1 2,2 .\n1,1 2,2 .\n")
+        results = list(cache.iter_viterbi(lines))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(cache.info()["hits"], 1)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("partofspeech")
+        self.sentences = read_obs("ambiguous_sents.obs") + [["i", "zzz", "."]]
+
+    def test_phases_are_exclusive(self):
+        stats = Stats()
+        with stats.phase("outer"):
+            with stats.phase("inner"):
+                pass
+            items = list(stats.timed("parse", iter([1, 2, 3])))
+        self.assertEqual(items, [1, 2, 3])
+        self.assertEqual(set(stats.seconds), {"outer", "inner", "parse"})
+        self.assertIn("PHASE outer", stats.summary())
+
+    def test_null_stats(self):
+        items = [1, 2]
+        self.assertIs(NULL_STATS.timed("parse", items), items)
+        self.assertIs(self.hmm.compile().stats, NULL_STATS)
+
+    def test_decode_counters(self):
+        for workers in (1, 2):
+            stats = Stats()
+            model = self.hmm.compile().instrumented(stats)
+            list(decode_sequences(model, self.sentences, "viterbi", workers=workers, chunk_size=4))
+            self.assertEqual(stats.counts["sentences"], len(self.sentences))
+            self.assertEqual(stats.counts["tokens"], sum(map(len, self.sentences)))
+            self.assertEqual(stats.counts["oov"], 1)
+            # the sentence with the unknown word has zero probability; it did not underflow
+            self.assertEqual(stats.counts["underflows"], 0)
+            self.assertEqual(stats.counts["zero_probability"], 1)
+        self.assertIs(self.hmm.compile().stats, NULL_STATS)
+
+    def test_underflows_only_in_linear(self):
+        known = [sentence for sentence in self.sentences if all(word in self.hmm.compile().symbols for word in sentence)]
+        document = [word for sentence in known for word in sentence] * 10
+        for numeric, underflows in (("linear", 1), ("scaled", 0), ("log", 0)):
+            for backend in ("dense", "sparse"):
+                stats = Stats()
+                model = self.hmm.compile(backend).instrumented(stats)
+                model.forward_batch([document], numeric)
+                model.viterbi_batch([document], numeric)
+                self.assertEqual(stats.counts["underflows"], 2 * underflows)
+                self.assertEqual(stats.counts["zero_probability"], 0)
+
+    def test_sparse_counters_match_dense(self):
+        for mode in ("forward", "viterbi"):
+            counts = []
+            for backend in ("dense", "sparse"):
+                stats = Stats()
+                model = self.hmm.compile(backend).instrumented(stats)
+                getattr(model, mode + "_batch")(self.sentences)
+                counts.append(stats.counts)
+            self.assertEqual(counts[1], counts[0])
+            self.assertEqual(counts[1]["sentences"], len(self.sentences))
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_bench_domain(self):
+        import bench_hmm
+        results = bench_hmm.bench_domain("cat", [5], [2], bench_hmm.ENGINES, repeat=1, seed=0)
+        cases = {(result["benchmark"], result.get("engine", result.get("source"))) for result in results}
+        self.assertEqual(cases, {("load", "parse"), ("load", "cache"), ("generate", None)} |
+                         {(mode, engine) for mode in ("forward", "viterbi") for engine in bench_hmm.ENGINES})
+        for result in results:
+            self.assertGreater(result["seconds"], 0)
+            if result["benchmark"] != "load":
+                self.assertEqual(result["tokens"], 10)
+        self.assertEqual(len(bench_hmm.curves(results)["viterbi/cat/dense/batch=2"]), 1)
+
+
+class TestForwardFilter(unittest.TestCase):
+    def setUp(self):
+        self.hmm = HMM()
+        self.hmm.load("lander")
+        self.compiled = self.hmm.compile()
+        self.readings = ['1,1', '2,2', '3,3', '3,4', '3,5', '4,5', '4,4', '5,5']
+
+    def test_filter_matches_forward(self):
+        tracker = self.compiled.filter()
+        for t, reading in enumerate(self.readings):
+            tracker.update(reading)
+            state, prob = self.compiled.forward(self.readings[:t + 1], numeric="scaled")
+            self.assertEqual(tracker.state()[0], state)
+            self.assertAlmostEqual(tracker.state()[1], prob)
+        self.assertEqual(tracker.steps, len(self.readings))
+
+    def test_unknown_reading_only_predicts(self):
+        tracker = self.compiled.filter()
+        tracker.update('1,1')
+        belief = tracker.update('.')
+        np.testing.assert_allclose(belief, self.compiled.start @ self.compiled.transitions)
+
+    def test_fixed_lag_smoothing(self):
+        # with the lag covering the whole stream, the smoothed estimate of
+        # the first step is the forward-backward posterior
+        lag = len(self.readings) - 1
+        tracker = self.compiled.filter(lag)
+        for reading in self.readings[:-1]:
+            tracker.update(reading)
+            self.assertIsNone(tracker.smoothed())
+        tracker.update(self.readings[-1])
+        lik = self.compiled.likelihoods(self.readings)
+        beta = np.ones(len(self.compiled.states))
+        for t in range(len(self.readings) - 1, 0, -1):
+            beta = self.compiled.transitions @ (lik[t] * beta)
+        posterior = self.compiled.start * lik[0] * beta
+        posterior /= posterior.sum()
+        step, state, prob = tracker.smoothed()
+        self.assertEqual(step, 0)
+        self.assertEqual(state, self.compiled.states[int(np.argmax(posterior))])
+        self.assertAlmostEqual(prob, posterior.max())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,7 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
 from HMM import *
 
@@ -26,5 +30,124 @@ class TestHMM(unittest.TestCase):
         self.assertEqual(self.hmm.emissions, expected_emissions, "Emissions do not match expected values")
 
 
+class TestModelCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.basename = os.path.join(self.directory, "cat")
+        for extension in (".trans", ".emit"):
+            shutil.copy("cat" + extension, self.basename + extension)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        hmm = HMM()
+        hmm.load(self.basename)
+        return hmm
+
+    def test_cache_round_trip(self):
+        parsed = HMM()
+        parsed.load(self.basename, cache=False)
+        self.assertFalse(os.path.exists(self.basename + ".cache.npz"))
+        self.load()
+        self.assertTrue(os.path.exists(self.basename + ".cache.npz"))
+        cached = self.load()
+        self.assertEqual(cached.transitions, parsed.transitions)
+        self.assertEqual(cached.emissions, parsed.emissions)
+        self.assertEqual(cached.compile().forward(['purr', 'meow']), parsed.compile().forward(['purr', 'meow']))
+
+    def test_cached_dicts_built_on_first_use(self):
+        self.load()
+        cached = self.load()
+        self.assertIsNotNone(cached.cached_rows)
+        self.assertEqual(cached.compile().viterbi(['purr', 'meow']), ['happy', 'hungry'])
+        self.assertIsNotNone(cached.cached_rows)
+        self.assertEqual(cached.emissions['happy']['purr'], 0.5)
+        self.assertIsNone(cached.cached_rows)
+        cached.load(self.basename)
+        self.assertIsNone(cached.compiled)
+
+    def test_edits_after_load_are_compiled(self):
+        for cache in (True, False):
+            hmm = HMM()
+            hmm.load(self.basename, cache=cache)
+            hmm.transitions['#'] = {'hungry': 1.0}
+            self.assertEqual(hmm.compile().forward(['meow']), hmm.forward(['meow']))
+            self.assertEqual(hmm.generate(3, seed=0).stateseq[0], 'hungry')
+
+    def test_cache_reused_when_only_mtime_changes(self):
+        self.load()
+        os.utime(self.basename + ".emit", ns=(0, 0))
+        hmm = HMM()
+        self.assertIsNotNone(hmm.load_cache(self.basename))
+        # the touch is recorded, so the next load does not hash the file
+        with np.load(self.basename + ".cache.npz") as data:
+            sources = json.loads(str(data["meta"]))["sources"]
+        self.assertEqual(sources[self.basename + ".emit"]["mtime_ns"], 0)
+
+    def test_cache_invalidated_when_source_changes(self):
+        self.load()
+        with open(self.basename + ".emit", "a") as f:
+            f.write("hungry hiss 0.0\n")
+        hmm = HMM()
+        self.assertIsNone(hmm.load_cache(self.basename))
+        hmm.load(self.basename)
+        self.assertEqual(hmm.emissions['hungry']['hiss'], 0.0)
+        self.assertIsNotNone(HMM().load_cache(self.basename))
+
+
+class TestModelRegistry(unittest.TestCase):
+    def test_default_dicts_are_not_shared(self):
+        first, second = HMM(), HMM()
+        first.load("cat")
+        self.assertEqual(second.transitions, {})
+        second.load("lander")
+        self.assertNotIn('1,1', first.transitions)
+
+    def test_models_side_by_side(self):
+        registry = ModelRegistry()
+        cat, lander = registry.compiled("cat"), registry.compiled("lander")
+        self.assertIs(registry.compiled("cat"), cat)
+        self.assertEqual(sorted(registry.names()), ["cat", "lander"])
+        self.assertEqual(cat.viterbi(['purr', 'meow']), registry.hmm("cat").viterbi(['purr', 'meow']))
+        self.assertNotIn('purr', lander.symbols)
+        with self.assertRaises(ValueError):
+            cat.transitions[0, 0] = 1.0
+
+    def test_independent_instances(self):
+        registry = ModelRegistry()
+        first = registry.hmm("cat")
+        first.transitions['happy']['happy'] = 0.0
+        self.assertEqual(registry.hmm("cat").transitions['happy']['happy'], 0.5)
+        cat = registry.compiled("cat")
+        happy = cat.states.index['happy']
+        self.assertEqual(cat.transitions[happy, happy], 0.5)
+
+    def test_touched_source_is_recorded(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        basename = os.path.join(directory, "cat")
+        for extension in (".trans", ".emit"):
+            shutil.copy("cat" + extension, basename + extension)
+        registry = ModelRegistry()
+        before = registry.compiled(basename)
+        os.utime(basename + ".emit", ns=(0, 0))
+        self.assertIs(registry.compiled(basename), before)
+        self.assertEqual(registry.models[basename][0][basename + ".emit"]["mtime_ns"], 0)
+
+    def test_reloaded_when_source_changes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        basename = os.path.join(directory, "cat")
+        for extension in (".trans", ".emit"):
+            shutil.copy("cat" + extension, basename + extension)
+        registry = ModelRegistry()
+        before = registry.compiled(basename)
+        with open(basename + ".emit", "a") as f:
+            f.write("hungry hiss 0.0\n")
+        self.assertIsNot(registry.compiled(basename), before)
+        self.assertIn('hiss', registry.compiled(basename).symbols)
+
+
 if __name__ == "__main__":
     unittest.main()
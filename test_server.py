@@ -0,0 +1,68 @@
+import asyncio
+import json
+import unittest
+from HMM import *
+from hmm_server import TaggingServer
+
+
+class TestTaggingServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.registry = ModelRegistry()
+        self.tagger = TaggingServer(["partofspeech", "cat"], self.registry, batch_window=0.01, max_pending=4)
+        self.server = await self.tagger.start(port=0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        await self.tagger.stop(self.server)
+
+    async def exchange(self, requests):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        for request in requests:
+            writer.write((request if isinstance(request, str) else json.dumps(request)).encode() + b"\n")
+        await writer.drain()
+        responses = [json.loads(await reader.readline()) for _ in requests]
+        writer.close()
+        await writer.wait_closed()
+        return responses
+
+    async def test_concurrent_requests_are_batched(self):
+        sentences = [line.split() for line in open("ambiguous_sents.obs") if line.split()]
+        clients = [[{"id": i, "observations": sentence} for i, sentence in enumerate(sentences)] for _ in range(5)]
+        results = await asyncio.gather(*(self.exchange(requests) for requests in clients))
+        expected = self.registry.compiled("partofspeech").viterbi_batch(sentences)
+        for responses in results:
+            self.assertEqual([response["id"] for response in responses], list(range(len(sentences))))
+            self.assertEqual([response["states"] for response in responses], expected)
+        stats = self.tagger.stats()
+        self.assertEqual(stats["requests"], 5 * len(sentences))
+        self.assertLess(stats["batches"], stats["requests"])
+
+    async def test_domains_modes_and_errors(self):
+        responses = await self.exchange([{"id": "a", "domain": "cat", "mode": "forward", "sentence": "purr meow"},
+                                         {"id": "b", "domain": "lander", "sentence": "1,1"},
+                                         {"id": "c", "observations": []},
+                                         {"id": "d", "observations": "purr meow"},
+                                         "not json"])
+        state, probability = self.registry.compiled("cat").forward(["purr", "meow"])
+        self.assertEqual(responses[0], {"id": "a", "state": state, "probability": probability})
+        self.assertIn("error", responses[1])
+        self.assertIn("error", responses[2])
+        self.assertIn("error", responses[3])
+        self.assertEqual(responses[4]["id"], None)
+        self.assertIn("error", responses[4])
+        stats, = await self.exchange([{"command": "stats"}])
+        self.assertEqual(stats["errors"], 4)
+        self.assertIn("p99", stats["latency_ms"])
+
+    async def test_records_decode_stats(self):
+        stats = Stats()
+        self.tagger.decode_stats = stats
+        await self.exchange([{"id": 1, "sentence": "i shot the elephant ."}, {"id": 2, "sentence": "i zzz ."}])
+        self.assertEqual(stats.counts["sentences"], 2)
+        self.assertEqual(stats.counts["tokens"], 8)
+        self.assertEqual(stats.counts["oov"], 1)
+        self.assertIn("decode", stats.seconds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import importlib.util
+import json
+import subprocess
+import sys
+import unittest
+from bench_startup import HEAVY
+
+HAVE_PGMPY = importlib.util.find_spec("pgmpy") is not None
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_import_loads_nothing_heavy(self):
+        code = ("import json, sys, alarm, carnet, sklearn_decisiontrees; "
+                f"print(json.dumps([name for name in {HEAVY!r} if name in sys.modules]))")
+        out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+        self.assertEqual(json.loads(out), [])
+
+    @unittest.skipUnless(HAVE_PGMPY, "pgmpy is not installed")
+    def test_factories_are_memoized(self):
+        import alarm
+        import carnet
+        self.assertIs(alarm.alarm_network(), alarm.alarm_network())
+        self.assertIs(alarm.alarm_model, alarm.alarm_network())
+        self.assertIs(carnet.car_infer, carnet.car_inference())
+        self.assertIs(carnet.car_infer.model, carnet.car_model)
+        with self.assertRaises(AttributeError):
+            alarm.alarm_sampler
+
+
+if __name__ == "__main__":
+    unittest.main()